@@ -23,5 +23,4 @@ class AccessOrganizationMeta(models.Model, GroupManagementMixin):
         verbose_name = _('access management settings')
 
     def get_group(self, suffix):
-        group_name = self.make_group_name(self.organization, suffix)
-        return Group.objects.get(name=group_name)
+        return self.get_cached_group(self.organization, suffix)
@@ -11,7 +11,7 @@ from django.views.decorators.http import require_http_methods, require_safe
 
 from core.batches_view import batches_view
 from core.utils import url, initialize_form, groupby_strict
-from core.csv_export import csv_response, CSV_EXPORT_FORMATS
+from core.csv_export import export_job_response, CSV_EXPORT_FORMATS
 from labour.models import PersonnelClass
 
 from ..forms import CreateBatchForm, BadgeForm, HiddenBadgeCrouchingForm
@@ -79,7 +79,7 @@ def badges_admin_export_view(request, vars, event, batch_id, format='csv'):
         format=format,
     )
 
-    return csv_response(event, Badge, badges, filename=filename, dialect=CSV_EXPORT_FORMATS[format])
+    return export_job_response(request, event, Badge, badges, filename=filename, dialect=CSV_EXPORT_FORMATS[format])
 
 
 def badges_admin_menu_items(request, event):
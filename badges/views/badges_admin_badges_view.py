@@ -12,7 +12,7 @@ from django.views.decorators.http import require_http_methods, require_safe
 
 from core.batches_view import batches_view
 from core.utils import url, initialize_form, groupby_strict
-from core.csv_export import csv_response, CSV_EXPORT_FORMATS
+from core.csv_export import export_job_response, CSV_EXPORT_FORMATS
 from labour.models import PersonnelClass
 
 from ..forms import CreateBatchForm, BadgeForm, HiddenBadgeCrouchingForm
@@ -116,7 +116,7 @@ def badges_admin_badges_view(request, vars, event, personnel_class_slug=None):
                 format=format,
             )
 
-            return csv_response(event, Badge, badges, filename=filename, dialect=CSV_EXPORT_FORMATS[format])
+            return export_job_response(request, event, Badge, badges, filename=filename, dialect=CSV_EXPORT_FORMATS[format])
         elif format in BADGE_LIST_TEMPLATES:
             page_template = BADGE_LIST_TEMPLATES[format][template_subtype]
 
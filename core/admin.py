@@ -6,7 +6,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import GroupAdmin
 from django.contrib.auth.models import User, Group
 
-from .models import Organization, Event, Person, Venue
+from .models import Organization, Event, Person, Venue, OutboxEmail
 
 
 organization_admin_inlines = []
@@ -150,10 +150,19 @@ class MyGroupAdmin(GroupAdmin):
         return GroupForm
 
 
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'domain', 'state', 'num_attempts', 'created_at', 'sent_at')
+    list_filter = ('state',)
+    search_fields = ('subject', 'domain')
+    readonly_fields = ('created_at', 'sent_at', 'num_attempts', 'last_error')
+    ordering = ('-created_at',)
+
+
 admin.site.register(Organization, OrganizationAdmin)
 admin.site.register(Event, EventAdmin)
 admin.site.register(Person, PersonAdmin)
 admin.site.register(Venue)
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
 
 
 # override GroupAdmin for users of group support in admin
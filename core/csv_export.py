@@ -1,14 +1,19 @@
 # encoding: utf-8
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from tempfile import TemporaryFile
 
 import unicodecsv as csv
 
-from django.http import HttpResponse
+from django.http import FileResponse, StreamingHttpResponse
 from django.db import models
+from django.db.models import prefetch_related_objects
 
 
 ENCODING = 'ISO-8859-15'
 
+# Number of rows to fetch, prefetch many-to-many fields for and send to the client at a time
+EXPORT_CHUNK_SIZE = 500
+
 
 ExportFormat = namedtuple('ExportFormat', [
     'name',
@@ -50,7 +55,11 @@ class CsvExportMixin(object):
 
     def get_csv_row(self, event, fields, m2m_mode='separate_columns'):
         result_row = []
-        related = self.get_csv_related()
+
+        # export_csv may have already computed this in prefetch_m2m_fields
+        related = getattr(self, '_csv_related', None)
+        if related is None:
+            related = self.get_csv_related()
 
         for model, field in fields:
             if isinstance(field, str):
@@ -71,8 +80,11 @@ class CsvExportMixin(object):
                 if m2m_mode == 'separate_columns':
                     choices = get_m2m_choices(event, field)
 
+                    # uses the prefetched values if available (see prefetch_m2m_fields)
+                    selected_pks = set(item.pk for item in field_value.all())
+
                     result_row.extend(
-                        field_value.filter(pk=choice.pk).exists()
+                        choice.pk in selected_pks
                         for choice in choices
                     )
                 elif m2m_mode == 'comma_separated':
@@ -118,22 +130,59 @@ def write_header_row(event, writer, fields, m2m_mode='separate_columns'):
 
 
 def get_m2m_choices(event, field):
+    """
+    Returns the possible values of a many-to-many field as a list, each of which gets its own column in
+    the separate_columns mode.
+
+    The choices are cached on the event instance (similar to Signup.get_csv_fields) instead of globally.
+    The Event is loaded anew for every request or export job, so the cache lives for the duration of one
+    export, never serves stale choices and is freed along with the Event.
+    """
     target_model = field.rel.to
-    cache_key = (event.id, target_model._meta.app_label, target_model._meta.model_name)
+    cache_key = (target_model._meta.app_label, target_model._meta.model_name)
 
-    if cache_key not in get_m2m_choices.cache:
+    m2m_choices = getattr(event, '_csv_m2m_choices', None)
+    if m2m_choices is None:
+        m2m_choices = event._csv_m2m_choices = dict()
 
+    if cache_key not in m2m_choices:
         if any(f.name == 'event' for f in target_model._meta.fields):
             choices = target_model.objects.filter(event=event)
         else:
             choices = target_model.objects.all()
 
-        get_m2m_choices.cache[cache_key] = choices.order_by('pk')
+        m2m_choices[cache_key] = list(choices.order_by('pk'))
+
+    return m2m_choices[cache_key]
+
 
-    return get_m2m_choices.cache[cache_key]
+def prefetch_m2m_fields(model_instances, fields):
+    """
+    Fetches the values of all many-to-many fields to be exported for all model instances using one
+    query per field, instead of get_csv_row querying them for every row.
+    """
+    m2m_fields = [
+        (model, field)
+        for (model, field) in fields
+        if not isinstance(field, str) and type(field) is models.ManyToManyField
+    ]
 
+    if not m2m_fields:
+        return
 
-get_m2m_choices.cache = {}
+    m2m_models = set(model for (model, field) in m2m_fields)
+    source_instances_by_model = defaultdict(list)
+
+    for model_instance in model_instances:
+        related = model_instance._csv_related = model_instance.get_csv_related()
+
+        for model in m2m_models:
+            source_instance = related.get(model, None) if model in related else model_instance
+            if source_instance is not None:
+                source_instances_by_model[model].append(source_instance)
+
+    for model, field in m2m_fields:
+        prefetch_related_objects(source_instances_by_model[model], field.name)
 
 
 def write_row(event, writer, fields, model_instance, m2m_mode):
@@ -149,44 +198,176 @@ def make_writer(output_stream, dialect):
         return csv.writer(output_stream, encoding=ENCODING, dialect=dialect, errors='ignore')
 
 
-def export_csv(event, model, model_instances, output_file, m2m_mode='separate_columns', dialect='excel-tab'):
+def get_export_fields(event, model, model_instances):
     # XXX Horrible hack.
     try:
         # EventSurveys force us to get this from an instance instead of the model class because they may differ
-        fields = model_instances[0].get_csv_fields(event)
+        return model_instances[0].get_csv_fields(event)
     except IndexError:
         # empty set, use the old way
-        fields = model.get_csv_fields(event)
-    writer = make_writer(output_file, dialect)
+        return model.get_csv_fields(event)
 
-    write_header_row(event, writer, fields, m2m_mode)
+
+def iter_model_instance_chunks(model, model_instances, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the model instances to be exported in lists of at most chunk_size. QuerySets are iterated
+    using .iterator() so that the whole result set is not cached in memory.
+    """
+    if isinstance(model_instances, models.QuerySet):
+        model_instances = model_instances.iterator()
+
+    chunk = []
 
     for model_instance in model_instances:
         if isinstance(model_instance, (str, int)):
-            model_instance = model.objects.get(pk=int(model_instances))
+            model_instance = model.objects.get(pk=int(model_instance))
+
+        chunk.append(model_instance)
+
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def write_rows_in_chunks(event, model, model_instances, writer, m2m_mode='separate_columns', fields=None):
+    """
+    Writes the header row and then the rows in chunks, yielding the number of rows written after the
+    header (zero) and after each chunk so that the caller may flush what has been written so far.
+    """
+    if fields is None:
+        fields = get_export_fields(event, model, model_instances)
+
+    write_header_row(event, writer, fields, m2m_mode)
+    yield 0
+
+    for chunk in iter_model_instance_chunks(model, model_instances):
+        prefetch_m2m_fields(chunk, fields)
+
+        for model_instance in chunk:
+            write_row(event, writer, fields, model_instance, m2m_mode)
+
+        yield len(chunk)
+
+
+def export_csv(
+    event,
+    model,
+    model_instances,
+    output_file,
+    m2m_mode='separate_columns',
+    dialect='excel-tab',
+    fields=None,
+    progress=None,
+):
+    """
+    Writes the export into output_file. If given, progress is called with the number of rows
+    written so far after each chunk.
+    """
+    writer = make_writer(output_file, dialect)
+    num_rows_written = 0
+
+    for num_rows in write_rows_in_chunks(event, model, model_instances, writer, m2m_mode, fields):
+        num_rows_written += num_rows
 
-        write_row(event, writer, fields, model_instance, m2m_mode)
+        if num_rows and progress is not None:
+            progress(num_rows_written)
 
     if getattr(writer, 'must_close', False):
         writer.close()
 
 
+class StreamBuffer(object):
+    """
+    A write-only file-like object that holds whatever is written into it until drained.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_csv(event, model, model_instances, m2m_mode='separate_columns', dialect='excel-tab'):
+    """
+    Like export_csv, but instead of writing into a file, yields the CSV/TSV data chunk by chunk. Not
+    applicable to XLSX.
+    """
+    assert dialect != 'xlsx'
+
+    buffer = StreamBuffer()
+    writer = make_writer(buffer, dialect)
+
+    for unused in write_rows_in_chunks(event, model, model_instances, writer, m2m_mode):
+        data = buffer.drain()
+        if data:
+            yield data
+
+
 CONTENT_TYPES = dict(
     xlsx='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
 )
 
 
 def csv_response(*args, **kwargs):
+    """
+    Returns the export as a downloadable file. CSV and TSV are streamed to the client as they are
+    generated. XLSX is streamed from a temporary file once complete.
+    """
     filename = kwargs.pop('filename')
     dialect = kwargs.get('dialect', 'excel')
+    content_type = CONTENT_TYPES.get(dialect, 'text/csv')
+
+    if dialect == 'xlsx':
+        # written into a temporary file in constant memory mode and then streamed from there
+        output_file = TemporaryFile()
+        kwargs['output_file'] = output_file
+        export_csv(*args, **kwargs)
+        output_file.seek(0)
+        response = FileResponse(output_file, content_type=content_type)
+    else:
+        response = StreamingHttpResponse(stream_csv(*args, **kwargs), content_type=content_type)
 
-    response = HttpResponse(content_type=CONTENT_TYPES.get(dialect, 'text/csv'))
     response['Content-Disposition'] = 'attachment; filename="{filename}"'.format(
         filename=filename
     )
 
-    kwargs['output_file'] = response
+    return response
 
-    export_csv(*args, **kwargs)
 
-    return response
+def export_job_response(request, event, model, model_instances, filename, dialect='excel', m2m_mode='separate_columns'):
+    """
+    Like csv_response, but for exports that may be too large to generate within the request. If
+    background_tasks is installed, the export is generated by an ExportJob in the background and the
+    user is redirected to a page that shows its progress and eventually the download link. Otherwise
+    falls back to csv_response.
+    """
+    from django.conf import settings
+    from django.shortcuts import redirect
+
+    if 'background_tasks' not in settings.INSTALLED_APPS:
+        return csv_response(event, model, model_instances,
+            filename=filename,
+            dialect=dialect,
+            m2m_mode=m2m_mode,
+        )
+
+    from .models import ExportJob
+
+    export_job = ExportJob.create(event, model, model_instances,
+        filename=filename,
+        dialect=dialect,
+        m2m_mode=m2m_mode,
+        user=request.user,
+    )
+    export_job.start()
+
+    return redirect('core_export_job_view', export_job.pk)
@@ -1,11 +1,27 @@
-import io
+from datetime import date, datetime
+from tempfile import TemporaryFile
+from shutil import copyfileobj
 
 import xlsxwriter
 
 
+DATETIME_FORMAT = 'yyyy-mm-dd hh:mm'
+DATE_FORMAT = 'yyyy-mm-dd'
+
+
+def is_seekable(stream):
+    seekable = getattr(stream, 'seekable', None)
+    return seekable is not None and seekable()
+
+
 class XlsxWriter(object):
     """
-    An almost csv.writer compatible wrapper for XlsxWriter. Horribly inefficient.
+    An almost csv.writer compatible wrapper for XlsxWriter.
+
+    The workbook is written in the constant_memory mode of XlsxWriter, which means rows must be written
+    in order and only the current row is kept in memory. If the output stream is not seekable (eg. a
+    HttpResponse), the workbook is written into a temporary file that is copied into the output stream
+    on .close(). The first row is taken to be the header row and written as strings.
 
     Must .close() to get the data actually written. Use getattr(writer, 'must_close', False)
     to distinguish from an actual csv.writer.
@@ -14,26 +30,67 @@ class XlsxWriter(object):
     def __init__(self, output_stream):
         self.row = 0
         self.output_stream = output_stream
-        self.buf = io.BytesIO()
-        self.workbook = xlsxwriter.Workbook(self.buf)
+
+        if is_seekable(output_stream):
+            self.temp_file = None
+            workbook_file = output_stream
+        else:
+            self.temp_file = workbook_file = TemporaryFile()
+
+        self.workbook = xlsxwriter.Workbook(workbook_file, dict(constant_memory=True))
         self.worksheet = self.workbook.add_worksheet()
+        self.datetime_format = self.workbook.add_format(dict(num_format=DATETIME_FORMAT))
+        self.date_format = self.workbook.add_format(dict(num_format=DATE_FORMAT))
+        self.column_writers = dict()
         self.must_close = True
 
+    def get_cell_writer(self, value):
+        if isinstance(value, str):
+            # Workaround to avoid corner case bug that triggers (when all of the following)
+            # - value starts with http:// (write interprets it as URL)
+            # - value is longer than 255 chars
+            # - value contains characters with ordinal not in range(0, 128)
+            return self.worksheet.write_string
+        elif isinstance(value, bool):
+            return self.worksheet.write_boolean
+        elif isinstance(value, (int, float)):
+            return self.worksheet.write_number
+        elif isinstance(value, datetime):
+            return lambda row, col, value: self.worksheet.write_datetime(row, col, value, self.datetime_format)
+        elif isinstance(value, date):
+            return lambda row, col, value: self.worksheet.write_datetime(row, col, value, self.date_format)
+        else:
+            return self.worksheet.write
+
     def writerow(self, row):
+        if self.row == 0:
+            # header row
+            for col, value in enumerate(row):
+                self.worksheet.write_string(self.row, col, str(value))
+
+            self.row += 1
+            return
+
         for col, value in enumerate(row):
-            if isinstance(value, str):
-                # Workaround to avoid corner case bug that triggers (when all of the following)
-                # - value starts with http:// (write interprets it as URL)
-                # - value is longer than 255 chars
-                # - value contains characters with ordinal not in range(0, 128)
-                self.worksheet.write_string(self.row, col, value)
-            else:
-                self.worksheet.write(self.row, col, value)
+            if value is None:
+                continue
+
+            # The type of a column is decided by its first non-empty value. Should a column have
+            # values of mixed types, the odd ones out are handled separately.
+            column_type, write = self.column_writers.get(col, (None, None))
+            if column_type is None:
+                column_type, write = self.column_writers[col] = (type(value), self.get_cell_writer(value))
+            elif type(value) is not column_type:
+                write = self.get_cell_writer(value)
+
+            write(self.row, col, value)
 
         self.row += 1
 
     def close(self):
         self.workbook.close()
-        self.buf.seek(0)
-        self.output_stream.write(self.buf.read())
-        self.buf.close()
+
+        if self.temp_file is not None:
+            self.temp_file.seek(0)
+            copyfileobj(self.temp_file, self.output_stream)
+            self.temp_file.close()
@@ -0,0 +1,16 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Delete export jobs and their files older than KOMPASSI_EXPORT_JOB_RETENTION_HOURS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-hours', type=int, default=None)
+
+    def handle(self, *args, **options):
+        from ...models import ExportJob
+
+        count = ExportJob.clean_up(retention_hours=options['retention_hours'])
+        self.stdout.write('Deleted {count} export jobs'.format(count=count))
@@ -0,0 +1,13 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Send due messages from the e-mail outbox (eg. from cron when Celery is not in use)'
+
+    def handle(self, *args, **options):
+        from ...models import OutboxEmail
+
+        num_sent = OutboxEmail.drain()
+        self.stdout.write('Sent {num_sent} messages'.format(num_sent=num_sent))
@@ -1,5 +1,7 @@
 # encoding: utf-8
 
+from django.utils.functional import SimpleLazyObject
+
 from .page_wizard import page_wizard_clear
 
 
@@ -36,3 +38,27 @@ class PageWizardMiddleware(object):
             page_wizard_clear(request)
 
         return None
+
+
+def enable_group_ids_cache(user):
+    user._group_ids_cacheable = True
+    return user
+
+
+class GroupIdsCacheMiddleware(object):
+    """
+    MIDDLEWARE_CLASSES = (
+        # ...
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        # ...
+        'core.middleware.GroupIdsCacheMiddleware',
+    )
+
+    Lets admin checks for request.user be answered from the group ids of the user, which are loaded
+    once per request. See core.models.group_management_mixin.get_user_group_ids. The user is still
+    loaded lazily.
+    """
+
+    def process_request(self, request):
+        user = request.user
+        request.user = SimpleLazyObject(lambda: enable_group_ids_cache(user))
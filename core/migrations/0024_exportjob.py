@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('core', '0023_auto_20160704_2155'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Finished at')),
+                ('object_ids', django.contrib.postgres.fields.jsonb.JSONField(default=list)),
+                ('m2m_mode', models.CharField(default='separate_columns', max_length=31)),
+                ('dialect', models.CharField(max_length=31)),
+                ('filename', models.CharField(max_length=255)),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='pending', max_length=8, verbose_name='State')),
+                ('num_rows_total', models.IntegerField(default=0)),
+                ('num_rows_done', models.IntegerField(default=0)),
+                ('error_message', models.TextField(blank=True, default='')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('event', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='core.Event', verbose_name='Event')),
+            ],
+            options={
+                'verbose_name': 'export job',
+                'verbose_name_plural': 'export jobs',
+            },
+        ),
+    ]
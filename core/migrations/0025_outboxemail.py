@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_exportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('from_email', models.CharField(blank=True, default='', max_length=255, verbose_name='Sender')),
+                ('to', django.contrib.postgres.fields.jsonb.JSONField(default=list, verbose_name='Recipients')),
+                ('bcc', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list)),
+                ('reply_to', django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=list)),
+                ('domain', models.CharField(db_index=True, max_length=255, verbose_name='Domain')),
+                ('state', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=7, verbose_name='State')),
+                ('num_attempts', models.IntegerField(default=0, verbose_name='Attempts')),
+                ('next_attempt_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent at')),
+            ],
+            options={
+                'verbose_name': 'outbox e-mail',
+                'verbose_name_plural': 'outbox e-mails',
+            },
+        ),
+        migrations.CreateModel(
+            name='OutboxEmailAttachment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255)),
+                ('content', models.BinaryField()),
+                ('mimetype', models.CharField(max_length=255)),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='core.OutboxEmail')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxemail',
+            index_together=set([('state', 'next_attempt_at')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_outboxemail_subject_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='content',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+    ]
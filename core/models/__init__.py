@@ -17,3 +17,5 @@ from .one_time_code import OneTimeCodeMixin, OneTimeCode, OneTimeCodeLite
 from .password_reset_token import PasswordResetToken, PasswordResetError
 from .email_verification_token import EmailVerificationToken, EmailVerificationError
 from .contact_email_mixin import contact_email_validator, ContactEmailMixin
+from .email_outbox import OutboxEmail, OutboxEmailAttachment
+from .export_job import ExportJob
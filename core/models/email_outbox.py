@@ -0,0 +1,285 @@
+# encoding: utf-8
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.db import models, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+logger = logging.getLogger('kompassi')
+
+
+OUTBOX_EMAIL_STATE_CHOICES = [
+    ('pending', _('Pending')),
+    ('sending', _('Sending')),
+    ('sent', _('Sent')),
+    ('failed', _('Failed')),
+]
+
+# A message claimed for sending is given back to the queue after this if the worker never finishes it.
+SENDING_TIMEOUT = timedelta(minutes=10)
+
+
+def get_domain(address):
+    name, email = parseaddr(address)
+    return email.rpartition('@')[2].lower()
+
+
+def get_rate_limit(domain):
+    """
+    Returns the maximum number of messages per minute to the domain, or 0 for no limit.
+    """
+    return settings.KOMPASSI_EMAIL_OUTBOX_RATE_LIMITS.get(domain, settings.KOMPASSI_EMAIL_OUTBOX_DEFAULT_RATE_LIMIT)
+
+
+class OutboxEmail(models.Model):
+    """
+    An e-mail message waiting to be sent or already sent. Instead of opening an SMTP connection per
+    message, messages are enqueued here and sent in batches over a single connection by .drain, which
+    also enforces per-domain rate limits (KOMPASSI_EMAIL_OUTBOX_RATE_LIMITS) and retries failed messages
+    with exponential backoff.
+    """
+
+    subject = models.TextField(verbose_name=_('Subject'))
+    body = models.TextField(verbose_name=_('Body'))
+    from_email = models.CharField(max_length=255, blank=True, default='', verbose_name=_('Sender'))
+    to = JSONField(default=list, verbose_name=_('Recipients'))
+    bcc = JSONField(default=list, blank=True)
+    reply_to = JSONField(default=list, blank=True)
+    domain = models.CharField(max_length=255, db_index=True, verbose_name=_('Domain'))
+
+    state = models.CharField(
+        max_length=max(len(key) for (key, label) in OUTBOX_EMAIL_STATE_CHOICES),
+        choices=OUTBOX_EMAIL_STATE_CHOICES,
+        default='pending',
+        verbose_name=_('State'),
+    )
+    num_attempts = models.IntegerField(default=0, verbose_name=_('Attempts'))
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True, default='', verbose_name=_('Last error'))
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created at'))
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Sent at'))
+
+    class Meta:
+        verbose_name = _('outbox e-mail')
+        verbose_name_plural = _('outbox e-mails')
+        index_together = [('state', 'next_attempt_at')]
+
+    def __str__(self):
+        return self.subject
+
+    @classmethod
+    def enqueue(cls, subject, body, to, from_email='', bcc=(), reply_to=(), attachments=(), drain=True):
+        """
+        Puts a message in the outbox. Attachments are (filename, content, mimetype) triples like for
+        EmailMessage.attach. If drain is True, sending the outbox is started, too. Pass drain=False when
+        enqueuing many messages at once and call drain_async afterwards.
+        """
+        if settings.DEBUG:
+            logger.debug(body)
+
+        to = list(to)
+
+        with transaction.atomic():
+            email = cls.objects.create(
+                subject=subject,
+                body=body,
+                from_email=from_email or '',
+                to=to,
+                bcc=list(bcc or []),
+                reply_to=list(reply_to or []),
+                domain=get_domain(to[0]) if to else '',
+            )
+
+            for filename, content, mimetype in attachments:
+                if isinstance(content, str):
+                    content = content.encode('UTF-8')
+
+                email.attachments.create(filename=filename, content=content, mimetype=mimetype)
+
+        if drain:
+            cls.drain_async()
+
+        return email
+
+    @classmethod
+    def drain_async(cls):
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from ..tasks import outbox_email_drain
+            transaction.on_commit(lambda: outbox_email_drain.delay())
+        else:
+            cls.drain()
+
+    @classmethod
+    def drain(cls, batch_size=None):
+        """
+        Sends due messages in batches of batch_size over a single SMTP connection per batch until there are
+        none left that the rate limits allow to be sent now. Returns the number of messages sent.
+        """
+        if batch_size is None:
+            batch_size = settings.KOMPASSI_EMAIL_OUTBOX_BATCH_SIZE
+
+        num_sent = 0
+
+        while True:
+            emails = cls._claim_batch(batch_size)
+            if emails is None:
+                break
+
+            if emails:
+                num_sent += cls._send_batch(emails)
+
+        return num_sent
+
+    @classmethod
+    def get_next_attempt_at(cls):
+        return cls.objects.filter(state__in=['pending', 'sending']).aggregate(
+            next_attempt_at=models.Min('next_attempt_at'),
+        )['next_attempt_at']
+
+    @classmethod
+    def _claim_batch(cls, batch_size):
+        """
+        Marks up to batch_size due messages as being sent and returns them. Messages over the rate limit of
+        their domain are postponed instead. Returns None if there were no due messages.
+        """
+        t = timezone.now()
+
+        with transaction.atomic():
+            candidates = list(
+                cls.objects
+                .select_for_update()
+                .filter(Q(state='pending') | Q(state='sending'), next_attempt_at__lte=t)
+                .order_by('next_attempt_at', 'id')
+                [:batch_size]
+            )
+
+            if not candidates:
+                return None
+
+            # Rate limits are per minute and recipient domain
+            num_sent_by_domain = defaultdict(int)
+            for domain, num_sent in (
+                cls.objects
+                .filter(state='sent', sent_at__gt=t - timedelta(minutes=1))
+                .filter(domain__in=set(email.domain for email in candidates))
+                .values_list('domain')
+                .annotate(num_sent=Count('id'))
+            ):
+                num_sent_by_domain[domain] = num_sent
+
+            emails = []
+            postponed_ids = []
+
+            for email in candidates:
+                rate_limit = get_rate_limit(email.domain)
+
+                if rate_limit and num_sent_by_domain[email.domain] >= rate_limit:
+                    postponed_ids.append(email.id)
+                else:
+                    num_sent_by_domain[email.domain] += 1
+                    emails.append(email)
+
+            if emails:
+                cls.objects.filter(id__in=[email.id for email in emails]).update(
+                    state='sending',
+                    num_attempts=models.F('num_attempts') + 1,
+                    next_attempt_at=t + SENDING_TIMEOUT,
+                )
+
+            if postponed_ids:
+                # Out of the way so that messages to other domains get their turn
+                cls.objects.filter(id__in=postponed_ids).update(next_attempt_at=t + timedelta(minutes=1))
+
+        for email in emails:
+            email.num_attempts += 1
+
+        return emails
+
+    @classmethod
+    def _send_batch(cls, emails):
+        from django.core.mail import get_connection
+
+        attachments_by_email_id = defaultdict(list)
+        for attachment in OutboxEmailAttachment.objects.filter(email__in=emails):
+            attachments_by_email_id[attachment.email_id].append(attachment)
+
+        connection = get_connection()
+        num_sent = 0
+
+        try:
+            connection.open()
+        except Exception as e:
+            logger.exception('Failed to open a connection for sending e-mail')
+            for email in emails:
+                email._mark_failed(e)
+            return 0
+
+        try:
+            for email in emails:
+                try:
+                    email.as_email_message(connection, attachments_by_email_id[email.id]).send(fail_silently=False)
+                except Exception as e:
+                    logger.exception('Failed to send outbox e-mail %s', email.id)
+                    email._mark_failed(e)
+                else:
+                    email._mark_sent()
+                    num_sent += 1
+        finally:
+            connection.close()
+
+        return num_sent
+
+    def as_email_message(self, connection=None, attachments=None):
+        from django.core.mail import EmailMessage
+
+        message = EmailMessage(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email or None,
+            to=self.to,
+            bcc=self.bcc,
+            reply_to=self.reply_to,
+            connection=connection,
+        )
+
+        if attachments is None:
+            attachments = self.attachments.all()
+
+        for attachment in attachments:
+            message.attach(attachment.filename, bytes(attachment.content), attachment.mimetype)
+
+        return message
+
+    def _mark_sent(self):
+        self.state = 'sent'
+        self.sent_at = timezone.now()
+        self.last_error = ''
+        self.save(update_fields=['state', 'sent_at', 'last_error'])
+
+    def _mark_failed(self, error):
+        self.last_error = str(error)
+
+        if self.num_attempts >= settings.KOMPASSI_EMAIL_OUTBOX_MAX_ATTEMPTS:
+            self.state = 'failed'
+        else:
+            self.state = 'pending'
+            backoff = settings.KOMPASSI_EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS * 2 ** (self.num_attempts - 1)
+            self.next_attempt_at = timezone.now() + timedelta(seconds=backoff)
+
+        self.save(update_fields=['state', 'next_attempt_at', 'last_error'])
+
+
+class OutboxEmailAttachment(models.Model):
+    email = models.ForeignKey(OutboxEmail, related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content = models.BinaryField()
+    mimetype = models.CharField(max_length=255)
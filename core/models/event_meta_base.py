@@ -13,8 +13,4 @@ class EventMetaBase(models.Model, GroupManagementMixin):
         abstract = True
 
     def get_group(self, suffix):
-        from django.contrib.auth.models import Group
-
-        group_name = self.make_group_name(self.event, suffix)
-
-        return Group.objects.get(name=group_name)
\ No newline at end of file
+        return self.get_cached_group(self.event, suffix)
\ No newline at end of file
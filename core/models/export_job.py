@@ -0,0 +1,179 @@
+# encoding: utf-8
+
+import logging
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+logger = logging.getLogger('kompassi')
+
+
+EXPORT_JOB_STATE_CHOICES = [
+    ('pending', _('Pending')),
+    ('running', _('Running')),
+    ('finished', _('Finished')),
+    ('failed', _('Failed')),
+]
+
+
+class ExportJob(models.Model):
+    """
+    A CSV/TSV/XLSX export that is generated in the background (if background_tasks is installed). The
+    finished file is stored in the database so that the web process serving the download need not share
+    a disk with the worker that generated it. The admin who started the job may poll its progress and
+    download the file once finished. Jobs are deleted along with their files after
+    KOMPASSI_EXPORT_JOB_RETENTION_HOURS.
+
+    The instances to be exported are stored as a list of primary keys in export order, because the
+    queryset built by the view cannot be passed to a Celery task.
+    """
+
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created at'))
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished at'))
+
+    event = models.ForeignKey('core.Event', null=True, blank=True, verbose_name=_('Event'))
+    content_type = models.ForeignKey('contenttypes.ContentType')
+    object_ids = JSONField(default=list)
+    m2m_mode = models.CharField(max_length=31, default='separate_columns')
+    dialect = models.CharField(max_length=31)
+    filename = models.CharField(max_length=255)
+
+    state = models.CharField(
+        max_length=max(len(key) for (key, label) in EXPORT_JOB_STATE_CHOICES),
+        choices=EXPORT_JOB_STATE_CHOICES,
+        default='pending',
+        verbose_name=_('State'),
+    )
+    num_rows_total = models.IntegerField(default=0)
+    num_rows_done = models.IntegerField(default=0)
+    error_message = models.TextField(blank=True, default='')
+
+    # Use .defer('content') when the file is not needed
+    content = models.BinaryField(null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = _('export job')
+        verbose_name_plural = _('export jobs')
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def is_finished(self):
+        return self.state == 'finished'
+
+    @property
+    def is_done(self):
+        return self.state in ('finished', 'failed')
+
+    @property
+    def progress_percent(self):
+        if not self.num_rows_total:
+            return 100 if self.is_done else 0
+
+        return int(100 * self.num_rows_done / self.num_rows_total)
+
+    @classmethod
+    def create(cls, event, model, model_instances, filename, dialect, m2m_mode='separate_columns', user=None):
+        from django.contrib.contenttypes.models import ContentType
+
+        if isinstance(model_instances, models.QuerySet):
+            object_ids = list(model_instances.values_list('pk', flat=True))
+        else:
+            object_ids = [model_instance.pk for model_instance in model_instances]
+
+        return cls.objects.create(
+            created_by=user if user is not None and user.is_authenticated else None,
+            event=event,
+            content_type=ContentType.objects.get_for_model(model, for_concrete_model=False),
+            object_ids=object_ids,
+            num_rows_total=len(object_ids),
+            m2m_mode=m2m_mode,
+            dialect=dialect,
+            filename=filename,
+        )
+
+    def can_be_downloaded_by(self, user):
+        return user.is_superuser or (self.created_by_id is not None and self.created_by_id == user.id)
+
+    def start(self):
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from ..tasks import export_job_run
+            export_job_run.delay(self.pk)
+        else:
+            self._run()
+
+    def iter_model_instances(self, model):
+        """
+        Yields the model instances to be exported in export order, fetching them in chunks.
+        """
+        from ..csv_export import EXPORT_CHUNK_SIZE
+
+        for i in range(0, len(self.object_ids), EXPORT_CHUNK_SIZE):
+            chunk_ids = self.object_ids[i:i + EXPORT_CHUNK_SIZE]
+            model_instances = model.objects.in_bulk(chunk_ids)
+
+            for object_id in chunk_ids:
+                model_instance = model_instances.get(object_id)
+                if model_instance is not None:
+                    yield model_instance
+
+    def _update_progress(self, num_rows_done):
+        self.num_rows_done = num_rows_done
+        ExportJob.objects.filter(pk=self.pk).update(num_rows_done=num_rows_done)
+
+    def _run(self):
+        from ..csv_export import export_csv
+
+        model = self.content_type.model_class()
+
+        self.state = 'running'
+        self.save(update_fields=['state'])
+
+        try:
+            if self.object_ids:
+                # EventSurveys force us to get the fields from an instance, see get_export_fields
+                fields = model.objects.get(pk=self.object_ids[0]).get_csv_fields(self.event)
+            else:
+                fields = model.get_csv_fields(self.event)
+
+            output_file = BytesIO()
+            export_csv(self.event, model, self.iter_model_instances(model), output_file,
+                m2m_mode=self.m2m_mode,
+                dialect=self.dialect,
+                fields=fields,
+                progress=self._update_progress,
+            )
+        except Exception as e:
+            logger.exception('Export job %s failed', self.pk)
+            self.state = 'failed'
+            self.error_message = str(e)
+        else:
+            self.state = 'finished'
+            self.content = output_file.getvalue()
+
+        self.finished_at = timezone.now()
+        self.save(update_fields=['state', 'error_message', 'finished_at', 'content'])
+
+        self.clean_up()
+
+    @classmethod
+    def clean_up(cls, retention_hours=None):
+        """
+        Deletes jobs older than the retention period along with their files. This also gets rid of
+        jobs left pending or running by a crashed worker. Returns the number of jobs deleted.
+        """
+        if retention_hours is None:
+            retention_hours = settings.KOMPASSI_EXPORT_JOB_RETENTION_HOURS
+
+        deadline = timezone.now() - timedelta(hours=retention_hours)
+        count, unused = cls.objects.filter(created_at__lt=deadline).delete()
+
+        return count
@@ -1,20 +1,57 @@
 # encoding: utf-8
 
 from django.conf import settings
+from django.contrib.auth.models import Group
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 
 from ..utils import ensure_groups_exist
 
 
+# Per-process caches for group lookups. Group names are made of the app label, the host slug and the
+# suffix, so (model, host slug, suffix) identifies a group name. Only existing groups get cached.
+# Renaming or deleting a group through the ORM evicts it, see the receivers below. Note that
+# QuerySet.update and raw SQL do not send signals.
+_group_names = dict()  # (model, host slug, suffix) -> group name
+_groups_by_name = dict()  # group name -> (group id, group name)
+
+
+def get_user_group_ids(user):
+    """
+    For users that have been marked request-scoped by core.middleware.GroupIdsCacheMiddleware (ie.
+    request.user), returns the set of the ids of the groups of the user, loading it on first use.
+    For other users, returns None: they may outlive the request and see membership changes through
+    Group.user_set that cannot be tracked here.
+    """
+    if not getattr(user, '_group_ids_cacheable', False):
+        return None
+
+    group_ids = getattr(user, '_group_ids_cache', None)
+    if group_ids is None:
+        group_ids = user._group_ids_cache = frozenset(user.groups.values_list('id', flat=True))
+
+    return group_ids
+
+
 class GroupManagementMixin(object):
     @staticmethod
     def is_user_in_group(user, group):
+        return GroupManagementMixin.is_user_in_group_id(user, group.pk)
+
+    @staticmethod
+    def is_user_in_group_id(user, group_id):
         if not user.is_authenticated():
             return False
 
-        return user.groups.filter(pk=group.pk).exists()
+        group_ids = get_user_group_ids(user)
+        if group_ids is not None:
+            return group_id in group_ids
+
+        return user.groups.filter(pk=group_id).exists()
 
     def is_user_in_admin_group(self, user):
-        return self.is_user_in_group(user, self.admin_group)
+        return self.is_user_in_group_id(user, self.admin_group_id)
 
     def is_user_admin(self, user):
         return user.is_superuser or self.is_user_in_admin_group(user)
@@ -25,19 +62,68 @@ class GroupManagementMixin(object):
         # and would otherwise get groups a, d, m, i, n, s...
         assert isinstance(suffix, str) and len(suffix) > 1
 
-        from django.contrib.contenttypes.models import ContentType
+        cache_key = (cls, host.slug, suffix)
+        group_name = _group_names.get(cache_key)
 
-        ctype = ContentType.objects.get_for_model(cls)
+        if group_name is None:
+            from django.contrib.contenttypes.models import ContentType
 
-        return '{installation_slug}-{host_slug}-{app_label}-{suffix}'.format(
-            installation_slug=settings.KOMPASSI_INSTALLATION_SLUG,
-            host_slug=host.slug,
-            app_label=ctype.app_label,
-            suffix=suffix,
-        )
+            ctype = ContentType.objects.get_for_model(cls)
+
+            group_name = _group_names[cache_key] = '{installation_slug}-{host_slug}-{app_label}-{suffix}'.format(
+                installation_slug=settings.KOMPASSI_INSTALLATION_SLUG,
+                host_slug=host.slug,
+                app_label=ctype.app_label,
+                suffix=suffix,
+            )
+
+        return group_name
+
+    @classmethod
+    def get_cached_group(cls, host, suffix):
+        """
+        Returns the group of the given host (event or organization) and suffix. Raises Group.DoesNotExist
+        if there is no such group.
+
+        Groups are looked up by name from the database only the first time within each process. The
+        instances returned are fresh but only have their id and name loaded.
+        """
+        group_name = cls.make_group_name(host, suffix)
+        cached = _groups_by_name.get(group_name)
+
+        if cached is None:
+            group = Group.objects.get(name=group_name)
+            _groups_by_name[group_name] = (group.id, group.name)
+            return group
+
+        group_id, group_name = cached
+        return Group.from_db(DEFAULT_DB_ALIAS, ['id', 'name'], [group_id, group_name])
 
     @classmethod
     def get_or_create_groups(cls, host, suffixes):
         group_names = [cls.make_group_name(host, suffix) for suffix in suffixes]
 
         return ensure_groups_exist(group_names)
+
+
+def clear_group_cache():
+    _group_names.clear()
+    _groups_by_name.clear()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def evict_group_from_cache(sender, instance, **kwargs):
+    # The old name of a renamed group is not known here, so look it up by id.
+    for group_name, (group_id, unused) in list(_groups_by_name.items()):
+        if group_id == instance.id:
+            _groups_by_name.pop(group_name, None)
+
+    _groups_by_name.pop(instance.name, None)
+
+
+@receiver(m2m_changed, sender=Group.user_set.through)
+def clear_user_group_ids_cache(sender, instance, reverse, **kwargs):
+    # Only the forward side (user.groups.add etc.) gives us the user instance.
+    if not reverse and hasattr(instance, '_group_ids_cache'):
+        del instance._group_ids_cache
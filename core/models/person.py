@@ -439,7 +439,7 @@ class Person(models.Model):
     def apply_state_async(self):
         if 'background_tasks' in settings.INSTALLED_APPS:
             from ..tasks import person_apply_state_async
-            person_apply_state_async(self.pk)
+            person_apply_state_async.delay(self.pk)
         else:
             self._apply_state_async()
 
@@ -451,8 +451,8 @@ class Person(models.Model):
         if 'crowd_integration' not in settings.INSTALLED_APPS:
             return
 
-        from crowd_integration.utils import update_user
-        update_user(self.user)
+        from crowd_integration.models import CrowdChange
+        CrowdChange.record_user_update(self.user)
 
     def apply_state_update_may_send_info_group_membership(self):
         from ..utils import ensure_user_is_member_of_group
@@ -506,9 +506,11 @@ class Person(models.Model):
         TODO Propagate django-admin group changes to Crowd
         https://docs.djangoproject.com/en/1.10/ref/signals/#m2m-changed
         """
-        from crowd_integration.utils import ensure_user_group_membership
-        for group in self.user.groups.all():
-            ensure_user_group_membership(self.user, group.name)
+        from crowd_integration.models import CrowdChange
+        CrowdChange.record_memberships(
+            (self.user, group_name, True)
+            for group_name in self.user.groups.values_list('name', flat=True)
+        )
 
     def get_email_for_event(self, event):
         from labour.models import Signup
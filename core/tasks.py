@@ -3,8 +3,10 @@
 import logging
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import EmailMessage
 from django.core.management import call_command
+from django.utils import timezone
 
 from celery import shared_task
 
@@ -37,3 +39,28 @@ def person_apply_state_new_user_async(person_id, password):
 @shared_task(ignore_result=True)
 def run_admin_command(*args, **kwargs):
     call_command(*args, **kwargs)
+
+
+@shared_task(ignore_result=True)
+def export_job_run(export_job_id):
+    from .models import ExportJob
+    export_job = ExportJob.objects.get(id=export_job_id)
+    export_job._run()
+
+
+OUTBOX_EMAIL_DRAIN_SCHEDULED_CACHE_KEY = 'core:outbox_email_drain:scheduled'
+
+
+@shared_task(ignore_result=True)
+def outbox_email_drain():
+    from .models import OutboxEmail
+
+    cache.delete(OUTBOX_EMAIL_DRAIN_SCHEDULED_CACHE_KEY)
+    OutboxEmail.drain()
+
+    # Come back for postponed and retried messages. At most one such follow-up is scheduled at a time.
+    next_attempt_at = OutboxEmail.get_next_attempt_at()
+    if next_attempt_at is not None:
+        countdown = max(0, (next_attempt_at - timezone.now()).total_seconds())
+        if cache.add(OUTBOX_EMAIL_DRAIN_SCHEDULED_CACHE_KEY, True, int(countdown) + 60):
+            outbox_email_drain.apply_async(eta=next_attempt_at)
@@ -146,3 +146,40 @@ class UtilsTestCase(TestCase):
             format_interval(d0, d2, locale=locale),
             'ke 27.4. klo 21.00 – to 28.4. klo 1.00'
         )
+
+
+class OutboxEmailTestCase(TestCase):
+    def test_drain(self):
+        from django.core import mail
+        from .models import OutboxEmail
+
+        email = OutboxEmail.enqueue(
+            subject='Test',
+            body='Hello',
+            to=('Test Person <test@example.com>',),
+            attachments=[('hello.txt', 'Hello', 'text/plain')],
+        )
+
+        email = OutboxEmail.objects.get(id=email.id)
+        assert email.domain == 'example.com'
+        assert email.state == 'sent'
+        assert email.num_attempts == 1
+        assert len(mail.outbox) == 1
+        assert [filename for (filename, content, mimetype) in mail.outbox[0].attachments] == ['hello.txt']
+
+    def test_rate_limit(self):
+        from django.core import mail
+        from django.test import override_settings
+        from .models import OutboxEmail
+
+        with override_settings(KOMPASSI_EMAIL_OUTBOX_RATE_LIMITS={'example.com': 2}):
+            for i in range(3):
+                OutboxEmail.enqueue(subject='Test', body='Hello', to=('test{i}@example.com'.format(i=i),), drain=False)
+            OutboxEmail.enqueue(subject='Test', body='Hello', to=('test@example.org',), drain=False)
+
+            assert OutboxEmail.drain() == 3
+
+        assert len(mail.outbox) == 3
+        postponed = OutboxEmail.objects.get(state='pending')
+        assert postponed.domain == 'example.com'
+        assert postponed.num_attempts == 0
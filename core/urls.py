@@ -8,6 +8,8 @@ from .views import (
     core_email_verification_request_view,
     core_email_verification_view,
     core_event_view,
+    core_export_job_download_view,
+    core_export_job_view,
     core_frontpage_view,
     core_login_view,
     core_logout_view,
@@ -41,5 +43,7 @@ urlpatterns = [
     url(r'^profile/password/reset/(?P<code>[a-f0-9]+)$', core_password_reset_view, name='core_password_reset_view'),
     url(r'^profile/email/verify$', core_email_verification_request_view, name='core_email_verification_request_view'),
     url(r'^profile/email/verify/(?P<code>[a-f0-9]+)$', core_email_verification_view, name='core_email_verification_view'),
+    url(r'^exports/(?P<export_job_id>\d+)/?$', core_export_job_view, name='core_export_job_view'),
+    url(r'^exports/(?P<export_job_id>\d+)/download$', core_export_job_download_view, name='core_export_job_download_view'),
     url(r'^impersonate/(?P<username>[a-zA-Z0-9_-]+)$', core_admin_impersonate_view, name='core_admin_impersonate_view'),
 ]
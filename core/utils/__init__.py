@@ -14,6 +14,7 @@ from .misc_utils import (
     check_password_strength,
     class_property,
     create_temporary_password,
+    ensure_group_membership,
     ensure_groups_exist,
     ensure_user_group_membership,
     ensure_user_is_member_of_group,
@@ -64,13 +64,12 @@ def ensure_user_group_membership(user, groups_to_add=[], groups_to_remove=[]):
         group.user_set.remove(user)
 
     if 'crowd_integration' in settings.INSTALLED_APPS:
-        from crowd_integration.utils import ensure_user_group_membership as cr_ensure_user_group_membership
+        from crowd_integration.models import CrowdChange
 
-        for group in groups_to_add:
-            cr_ensure_user_group_membership(user, group.name, True)
-
-        for group in groups_to_remove:
-            cr_ensure_user_group_membership(user, group.name, False)
+        CrowdChange.record_memberships(
+            [(user, group.name, True) for group in groups_to_add] +
+            [(user, group.name, False) for group in groups_to_remove]
+        )
 
 
 def ensure_user_is_member_of_group(user, group, should_belong_to_group=True):
@@ -87,18 +86,36 @@ def ensure_user_is_member_of_group(user, group, should_belong_to_group=True):
         group.user_set.remove(user)
 
     if 'crowd_integration' in settings.INSTALLED_APPS:
-        from crowd_integration.utils import ensure_user_group_membership as cr_ensure_user_group_membership
-        cr_ensure_user_group_membership(user, group.name, should_belong_to_group)
+        from crowd_integration.models import CrowdChange
+        CrowdChange.record_memberships([(user, group.name, should_belong_to_group)])
+
+
+def ensure_group_membership(group, users_to_add=(), users_to_remove=()):
+    """
+    The many-users-one-group counterpart of ensure_user_group_membership. Membership in Django is
+    changed with one query per direction.
+    """
+    if users_to_add:
+        group.user_set.add(*users_to_add)
+
+    if users_to_remove:
+        group.user_set.remove(*users_to_remove)
+
+    if 'crowd_integration' in settings.INSTALLED_APPS:
+        from crowd_integration.models import CrowdChange
+
+        CrowdChange.record_memberships(
+            [(user, group.name, True) for user in users_to_add] +
+            [(user, group.name, False) for user in users_to_remove]
+        )
 
 
 def ensure_groups_exist(group_names):
     groups = [Group.objects.get_or_create(name=group_name)[0] for group_name in group_names]
 
     if 'crowd_integration' in settings.INSTALLED_APPS:
-        from crowd_integration.utils import ensure_group_exists
-
-        for group_name in group_names:
-            ensure_group_exists(group_name)
+        from crowd_integration.models import CrowdChange
+        CrowdChange.record_groups(group_names)
 
     return groups
 
@@ -112,8 +129,12 @@ def change_user_password(user, new_password, old_password=AllowPasswordChangeWit
     user.save()
 
     if 'crowd_integration' in settings.INSTALLED_APPS:
-        from crowd_integration.utils import change_user_password as cr_change_user_password
-        cr_change_user_password(user, new_password)
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from crowd_integration.tasks import change_user_password as cr_change_user_password
+            cr_change_user_password.delay(user.pk, new_password)
+        else:
+            from crowd_integration.utils import change_user_password as cr_change_user_password
+            cr_change_user_password(user, new_password)
 
 
 def get_code(path):
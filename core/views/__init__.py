@@ -7,6 +7,11 @@ from .email_verification_views import (
     core_email_verification_view,
 )
 
+from .export_job_views import (
+    core_export_job_download_view,
+    core_export_job_view,
+)
+
 from .login_views import (
     core_login_view,
     core_logout_view,
@@ -0,0 +1,48 @@
+# encoding: utf-8
+
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.views.decorators.http import require_safe
+
+from ..csv_export import CONTENT_TYPES
+from ..models import ExportJob
+
+
+def get_export_job_or_404(request, export_job_id, with_content=False):
+    export_jobs = ExportJob.objects.all() if with_content else ExportJob.objects.defer('content')
+    export_job = get_object_or_404(export_jobs, pk=int(export_job_id))
+
+    if not export_job.can_be_downloaded_by(request.user):
+        raise Http404()
+
+    return export_job
+
+
+@login_required
+@require_safe
+def core_export_job_view(request, export_job_id):
+    export_job = get_export_job_or_404(request, export_job_id)
+
+    vars = dict(
+        event=export_job.event,
+        export_job=export_job,
+    )
+
+    return render(request, 'core_export_job_view.jade', vars)
+
+
+@login_required
+@require_safe
+def core_export_job_download_view(request, export_job_id):
+    export_job = get_export_job_or_404(request, export_job_id, with_content=True)
+
+    if not export_job.is_finished or export_job.content is None:
+        raise Http404()
+
+    response = HttpResponse(bytes(export_job.content), content_type=CONTENT_TYPES.get(export_job.dialect, 'text/csv'))
+    response['Content-Disposition'] = 'attachment; filename="{filename}"'.format(
+        filename=export_job.filename,
+    )
+
+    return response
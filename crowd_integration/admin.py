@@ -0,0 +1,18 @@
+# encoding: utf-8
+
+from django.contrib import admin
+
+from .models import CrowdChange
+
+
+class CrowdChangeAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'operation', 'user', 'group_name', 'num_attempts', 'next_attempt_at')
+    list_filter = ('operation',)
+    raw_id_fields = ('user',)
+    readonly_fields = ('created_at', 'operation', 'user', 'group_name', 'num_attempts', 'last_error')
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+
+admin.site.register(CrowdChange, CrowdChangeAdmin)
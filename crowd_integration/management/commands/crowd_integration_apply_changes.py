@@ -0,0 +1,13 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Apply due changes to Crowd (eg. from cron when Celery is not in use)'
+
+    def handle(self, *args, **options):
+        from ...models import CrowdChange
+
+        num_applied = CrowdChange.apply_pending()
+        self.stdout.write('Applied {num_applied} changes'.format(num_applied=num_applied))
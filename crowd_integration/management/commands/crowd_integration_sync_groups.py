@@ -1,6 +1,11 @@
 # encoding: utf-8
 
-import sys
+import json
+import logging
+import os
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
@@ -8,32 +13,202 @@ from django.core.management.base import BaseCommand
 
 from core.utils import create_temporary_password
 
-from ...utils import ensure_group_exists, create_user, ensure_user_is_member_of_group, CrowdError
+from ...utils import (
+    CROWD_PAGE_SIZE,
+    CrowdError,
+    create_user,
+    ensure_group_exists,
+    get_client,
+)
 
 
-def dot(ch='.'):
-    sys.stdout.write(ch)
-    sys.stdout.flush()
+logger = logging.getLogger('kompassi')
+
+
+class Checkpoint(object):
+    """
+    Remembers which steps of a reconciliation run are done so that an interrupted run can resume.
+    Saved as JSON after every step.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.users_done = False
+        self.groups_done = set()
+
+        if not restart and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                state = json.load(checkpoint_file)
+
+            self.users_done = state['users_done']
+            self.groups_done = set(state['groups_done'])
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(dict(users_done=self.users_done, groups_done=sorted(self.groups_done)), checkpoint_file)
+
+        os.replace(temp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
 
 
 class Command(BaseCommand):
-    args = ''
-    help = 'Make sure all users belong to their respective labour groups'
+    help = (
+        'Make sure all users and their group memberships exist in Crowd. Fetches the current state of '
+        'Crowd, compares it to that of Kompassi and only applies the differences.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+            help='Only report the number of differences',
+        )
+        parser.add_argument('--workers', type=int, default=8,
+            help='Number of concurrent requests to Crowd',
+        )
+        parser.add_argument('--page-size', type=int, default=CROWD_PAGE_SIZE,
+            help='Number of entities fetched from Crowd per request',
+        )
+        parser.add_argument('--checkpoint',
+            default=os.path.join(tempfile.gettempdir(), 'crowd_integration_sync_groups.json'),
+            help='Progress is saved in this file so that an interrupted run can be resumed',
+        )
+        parser.add_argument('--restart', action='store_true', default=False,
+            help='Ignore the progress saved by an earlier run',
+        )
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.page_size = options['page_size']
+
+        checkpoint = Checkpoint(options['checkpoint'], restart=options['restart'] or self.dry_run)
+
+        if not self.dry_run:
+            # Fail now rather than after all the work if the checkpoint cannot be written
+            checkpoint.save()
 
-    def handle(*args, **options):
         User = get_user_model()
+        UserGroup = User.groups.through
+
+        # Only users with a Person are managed by us in Crowd
+        users_by_username = dict(
+            (user.username, user)
+            for user in User.objects.filter(person__isnull=False).only(
+                'id', 'username', 'first_name', 'last_name', 'email',
+            )
+        )
+
+        usernames_by_group_name = defaultdict(set)
+        for group_name, username in UserGroup.objects.filter(user__person__isnull=False).values_list(
+            'group__name',
+            'user__username',
+        ):
+            usernames_by_group_name[group_name].add(username)
+
+        group_names = [
+            group_name
+            for group_name in Group.objects.order_by('name').values_list('name', flat=True)
+            if group_name not in checkpoint.groups_done
+        ]
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            if not checkpoint.users_done:
+                num_users_created = self.sync_users(executor, users_by_username)
+                self.stdout.write('Users missing from Crowd: {num_users_created}'.format(
+                    num_users_created=num_users_created,
+                ))
+
+                if not self.dry_run:
+                    checkpoint.users_done = True
+                    checkpoint.save()
+
+            num_added = 0
+            num_removed = 0
+            num_failed = 0
+
+            for group_name, result in zip(group_names, executor.map(
+                lambda group_name: self.sync_group(
+                    group_name,
+                    usernames_by_group_name.get(group_name, set()),
+                    users_by_username,
+                ),
+                group_names,
+            )):
+                if result is None:
+                    # Left out of the checkpoint so that the next run retries it
+                    num_failed += 1
+                    continue
+
+                group_num_added, group_num_removed = result
+                num_added += group_num_added
+                num_removed += group_num_removed
+
+                if not self.dry_run:
+                    checkpoint.groups_done.add(group_name)
+                    checkpoint.save()
+
+        self.stdout.write(
+            'Groups: {num_groups}, memberships to add: {num_added}, to remove: {num_removed}, '
+            'failed groups: {num_failed}'.format(
+                num_groups=len(group_names),
+                num_added=num_added,
+                num_removed=num_removed,
+                num_failed=num_failed,
+            )
+        )
+
+        if not self.dry_run and not num_failed:
+            checkpoint.clear()
+
+    def sync_users(self, executor, users_by_username):
+        """
+        Creates the users missing from Crowd. Returns the number of users missing.
+        """
+        crowd_usernames = set(get_client().get_user_names(page_size=self.page_size))
+        missing_users = [user for (username, user) in users_by_username.items() if username not in crowd_usernames]
+
+        if not self.dry_run:
+            def _create_user(user):
+                try:
+                    create_user(user, create_temporary_password())
+                except CrowdError:
+                    logger.exception('Failed to create user %s in Crowd', user.username)
+
+            list(executor.map(_create_user, missing_users))
+
+        return len(missing_users)
+
+    def sync_group(self, group_name, usernames, users_by_username):
+        """
+        Makes the direct members of the group in Crowd agree with Kompassi for the users managed by
+        Kompassi. Returns (num_added, num_removed), or None if Crowd failed us.
+        """
+        try:
+            if not self.dry_run:
+                ensure_group_exists(group_name)
+
+            crowd_usernames = set(get_client().get_group_member_names(group_name, page_size=self.page_size))
+
+            to_add = usernames - crowd_usernames
 
-        for group in Group.objects.all():
-            ensure_group_exists(group.name)
-            dot()
+            # Users not managed by Kompassi are left alone
+            to_remove = set(username for username in crowd_usernames - usernames if username in users_by_username)
 
-        for user in User.objects.filter(person__isnull=False):
-            try:
-                create_user(user, create_temporary_password())
-                dot()
-            except CrowdError:
-                dot('+')
+            if not self.dry_run and (to_add or to_remove):
+                get_client().ensure_user_group_memberships(
+                    [(username, group_name, True) for username in sorted(to_add)] +
+                    [(username, group_name, False) for username in sorted(to_remove)]
+                )
+        except CrowdError:
+            logger.exception('Failed to sync group %s with Crowd', group_name)
+            return None
 
-            for group in user.groups.all():
-                ensure_user_is_member_of_group(user, group.name)
-                dot()
+        return len(to_add), len(to_remove)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CrowdChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(choices=[('ensure_group', 'Ensure group exists'), ('update_user', 'Update user'), ('add_to_group', 'Add user to group'), ('remove_from_group', 'Remove user from group')], max_length=17)),
+                ('group_name', models.CharField(blank=True, default='', max_length=255)),
+                ('num_attempts', models.IntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Crowd change',
+                'verbose_name_plural': 'Crowd changes',
+            },
+        ),
+    ]
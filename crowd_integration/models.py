@@ -1,8 +1,16 @@
 # encoding: utf-8
 
+import logging
+from collections import namedtuple, OrderedDict
+from datetime import timedelta
 
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
 
-from collections import namedtuple
+
+logger = logging.getLogger('kompassi')
 
 
 BaseJustEnoughUser = namedtuple('JustEnoughUser', 'username first_name last_name email')
@@ -11,4 +19,262 @@ class JustEnoughUser(BaseJustEnoughUser):
         JustEnoughUser can be passed to most IPA functions instead of an actual User if one is not available at
         the time of the call of create_user.
     """
-    pass
\ No newline at end of file
+    pass
+
+
+CROWD_CHANGE_OPERATION_CHOICES = [
+    ('ensure_group', 'Ensure group exists'),
+    ('update_user', 'Update user'),
+    ('add_to_group', 'Add user to group'),
+    ('remove_from_group', 'Remove user from group'),
+]
+
+# A claimed change is given back to the queue after this if the worker never finishes it.
+APPLYING_TIMEOUT = timedelta(minutes=10)
+
+
+class CrowdChange(models.Model):
+    """
+    A change waiting to be made in Crowd. Instead of calling Crowd from whatever request changed a user
+    or a group, changes are recorded here and applied in the background by .apply_pending. Operations
+    on the same user and group are coalesced so that only the last one is sent, changes to the same
+    user are applied in the order they were recorded, and changes that fail because Crowd is down are
+    retried with backoff.
+
+    Creating users and changing passwords are not recorded here so as not to store passwords in the
+    database. They still go through Celery tasks (see crowd_integration.tasks).
+    """
+
+    operation = models.CharField(
+        max_length=max(len(key) for (key, label) in CROWD_CHANGE_OPERATION_CHOICES),
+        choices=CROWD_CHANGE_OPERATION_CHOICES,
+    )
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True)
+    group_name = models.CharField(max_length=255, blank=True, default='')
+
+    num_attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Crowd change'
+        verbose_name_plural = 'Crowd changes'
+
+    def __str__(self):
+        return '{operation} {user} {group_name}'.format(
+            operation=self.operation,
+            user=self.user_id or '',
+            group_name=self.group_name,
+        )
+
+    @property
+    def coalesce_key(self):
+        return (self.operation if self.operation in ('ensure_group', 'update_user') else 'membership', self.group_name)
+
+    @classmethod
+    def record_memberships(cls, memberships):
+        """
+        Takes an iterable of (user, group_name, should_belong_to_group).
+        """
+        cls._record([
+            cls(
+                operation='add_to_group' if should_belong_to_group else 'remove_from_group',
+                user=user,
+                group_name=group_name,
+            )
+            for (user, group_name, should_belong_to_group) in memberships
+        ])
+
+    @classmethod
+    def record_groups(cls, group_names):
+        cls._record([cls(operation='ensure_group', group_name=group_name) for group_name in group_names])
+
+    @classmethod
+    def record_user_update(cls, user):
+        cls._record([cls(operation='update_user', user=user)])
+
+    @classmethod
+    def _record(cls, changes):
+        if not changes:
+            return
+
+        cls.objects.bulk_create(changes)
+        cls.apply_pending_async()
+
+    @classmethod
+    def apply_pending_async(cls, countdown=0):
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from .tasks import crowd_apply_changes
+            transaction.on_commit(lambda: crowd_apply_changes.apply_async(countdown=countdown))
+        else:
+            cls.apply_pending()
+
+    @classmethod
+    def apply_pending(cls, batch_size=None):
+        """
+        Applies due changes in batches until there are none left or Crowd is found to be down.
+        Returns the number of changes applied.
+        """
+        from requests import RequestException
+
+        if batch_size is None:
+            batch_size = settings.KOMPASSI_CROWD_CHANGE_BATCH_SIZE
+
+        num_applied = 0
+
+        while True:
+            changes = cls._claim_batch(batch_size)
+            if not changes:
+                break
+
+            try:
+                num_applied += cls._apply_batch(changes)
+            except RequestException as e:
+                # Crowd is unreachable. No sense trying the rest now.
+                logger.warning('Crowd unreachable, postponing %d changes: %s', len(changes), e)
+                cls._postpone(changes, e)
+                break
+
+        return num_applied
+
+    @classmethod
+    def get_seconds_until_next_attempt(cls):
+        next_attempt_at = cls.objects.aggregate(next_attempt_at=Min('next_attempt_at'))['next_attempt_at']
+        if next_attempt_at is None:
+            return None
+
+        return max(0, (next_attempt_at - timezone.now()).total_seconds())
+
+    @classmethod
+    def _claim_batch(cls, batch_size):
+        t = timezone.now()
+
+        with transaction.atomic():
+            changes = list(
+                cls.objects
+                .select_for_update()
+                .filter(next_attempt_at__lte=t)
+                .order_by('id')
+                [:batch_size]
+            )
+
+            # Changes of a user must wait for the earlier changes of the same user that are postponed or
+            # being applied by another worker
+            blocking = dict(
+                (user_id, (first_id, next_attempt_at))
+                for (user_id, first_id, next_attempt_at) in (
+                    cls.objects
+                    .filter(
+                        user_id__in=set(change.user_id for change in changes if change.user_id is not None),
+                        next_attempt_at__gt=t,
+                    )
+                    .order_by()
+                    .values_list('user_id')
+                    .annotate(first_id=Min('id'), next_attempt_at=Max('next_attempt_at'))
+                )
+            )
+
+            blocked = [
+                change for change in changes
+                if change.user_id in blocking and blocking[change.user_id][0] < change.id
+            ]
+            for change in blocked:
+                cls.objects.filter(id=change.id).update(next_attempt_at=blocking[change.user_id][1])
+
+            changes = [change for change in changes if change not in blocked]
+
+            if changes:
+                cls.objects.filter(id__in=[change.id for change in changes]).update(
+                    num_attempts=models.F('num_attempts') + 1,
+                    next_attempt_at=t + APPLYING_TIMEOUT,
+                )
+
+        for change in changes:
+            change.num_attempts += 1
+
+        return changes
+
+    @classmethod
+    def _coalesce(cls, changes):
+        """
+        Returns (superseded, group_changes, changes_by_user_id). Of the changes that concern the same
+        user and group, or the same user's details, only the last one is kept; the rest are superseded.
+        """
+        last_changes = OrderedDict()
+        superseded = []
+
+        for change in changes:
+            key = (change.user_id,) + change.coalesce_key
+            if key in last_changes:
+                superseded.append(last_changes.pop(key))
+            last_changes[key] = change
+
+        group_changes = []
+        changes_by_user_id = OrderedDict()
+        for change in last_changes.values():
+            if change.user_id is None:
+                group_changes.append(change)
+            else:
+                changes_by_user_id.setdefault(change.user_id, []).append(change)
+
+        return superseded, group_changes, changes_by_user_id
+
+    @classmethod
+    def _apply_batch(cls, changes):
+        from django.contrib.auth import get_user_model
+        from .utils import CrowdError, ensure_group_exists, get_client, update_user
+
+        superseded, group_changes, changes_by_user_id = cls._coalesce(changes)
+        cls.objects.filter(id__in=[change.id for change in superseded]).delete()
+
+        users_by_id = get_user_model().objects.in_bulk(list(changes_by_user_id.keys()))
+        num_applied = len(superseded)
+
+        # Groups first so that memberships have them to refer to
+        for change in group_changes:
+            try:
+                ensure_group_exists(change.group_name)
+            except CrowdError as e:
+                cls._postpone([change], e)
+            else:
+                change.delete()
+                num_applied += 1
+
+        for user_id, user_changes in changes_by_user_id.items():
+            user = users_by_id.get(user_id)
+            num_done = 0
+
+            try:
+                for change in user_changes:
+                    if user is None:
+                        pass
+                    elif change.operation == 'update_user':
+                        update_user(user)
+                    else:
+                        get_client().ensure_user_group_memberships([
+                            (user.username, change.group_name, change.operation == 'add_to_group'),
+                        ])
+
+                    num_done += 1
+            except CrowdError as e:
+                # The rest of the changes of this user wait for the failed one
+                cls._postpone(user_changes[num_done:], e)
+
+            cls.objects.filter(id__in=[change.id for change in user_changes[:num_done]]).delete()
+            num_applied += num_done
+
+        return num_applied
+
+    @classmethod
+    def _postpone(cls, changes, error):
+        t = timezone.now()
+
+        for change in changes:
+            backoff = min(
+                settings.KOMPASSI_CROWD_CHANGE_RETRY_BACKOFF_SECONDS * 2 ** (change.num_attempts - 1),
+                settings.KOMPASSI_CROWD_CHANGE_MAX_BACKOFF_SECONDS,
+            )
+            next_attempt_at = t + timedelta(seconds=backoff)
+
+            cls.objects.filter(id=change.id).update(next_attempt_at=next_attempt_at, last_error=str(error))
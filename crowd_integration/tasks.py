@@ -5,6 +5,7 @@ import logging
 from celery import shared_task
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 
 from .utils import (
     change_user_password as _change_user_password,
@@ -15,6 +16,9 @@ from .utils import (
 
 logger = logging.getLogger('kompassi')
 
+APPLY_CHANGES_LOCK_CACHE_KEY = 'crowd_integration:apply_changes:lock'
+APPLY_CHANGES_LOCK_TIMEOUT = 10 * 60
+
 
 @shared_task(ignore_result=True)
 def create_user(user_pk, password):
@@ -35,3 +39,22 @@ def change_user_password(user_pk, new_password):
     User = get_user_model()
     user = User.objects.get(pk=user_pk)
     _change_user_password(user, new_password)
+
+
+@shared_task(ignore_result=True)
+def crowd_apply_changes():
+    from .models import CrowdChange
+
+    # Only one consumer at a time so that the changes of a user are applied in order. The one running
+    # will take care of any new changes.
+    if not cache.add(APPLY_CHANGES_LOCK_CACHE_KEY, True, APPLY_CHANGES_LOCK_TIMEOUT):
+        return
+
+    try:
+        CrowdChange.apply_pending()
+    finally:
+        cache.delete(APPLY_CHANGES_LOCK_CACHE_KEY)
+
+    seconds = CrowdChange.get_seconds_until_next_attempt()
+    if seconds is not None:
+        crowd_apply_changes.apply_async(countdown=seconds)
@@ -0,0 +1,113 @@
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import Mock, patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from requests import ConnectionError
+
+
+@skipUnless('crowd_integration' in settings.INSTALLED_APPS, 'requires crowd_integration')
+class CrowdChangeTestCase(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user1 = User.objects.create(username='crowd-test-1')
+        self.user2 = User.objects.create(username='crowd-test-2')
+        self.crowd_client = Mock()
+
+    def change(self, operation, user=None, group_name='', **kwargs):
+        from .models import CrowdChange
+        return CrowdChange.objects.create(operation=operation, user=user, group_name=group_name, **kwargs)
+
+    def apply_pending(self):
+        from .models import CrowdChange
+
+        with patch('crowd_integration.utils.get_client', return_value=self.crowd_client):
+            return CrowdChange.apply_pending(batch_size=10)
+
+    def get_memberships(self):
+        return [
+            membership
+            for call in self.crowd_client.ensure_user_group_memberships.call_args_list
+            for membership in call[0][0]
+        ]
+
+    def test_coalesce(self):
+        from .models import CrowdChange
+
+        changes = [
+            self.change('ensure_group', group_name='g1'),
+            self.change('add_to_group', self.user1, 'g1'),
+            self.change('add_to_group', self.user1, 'g2'),
+            self.change('ensure_group', group_name='g1'),
+            self.change('remove_from_group', self.user1, 'g1'),
+            self.change('update_user', self.user2),
+            self.change('update_user', self.user2),
+        ]
+
+        superseded, group_changes, changes_by_user_id = CrowdChange._coalesce(changes)
+
+        assert superseded == [changes[0], changes[1], changes[5]]
+        assert group_changes == [changes[3]]
+        assert changes_by_user_id[self.user1.id] == [changes[2], changes[4]]
+        assert changes_by_user_id[self.user2.id] == [changes[6]]
+
+        assert self.apply_pending() == len(changes)
+        assert self.get_memberships() == [('crowd-test-1', 'g2', True), ('crowd-test-1', 'g1', False)]
+        assert not CrowdChange.objects.exists()
+
+    def test_user_waits_for_postponed_change(self):
+        from .models import CrowdChange
+
+        later = timezone.now() + timedelta(hours=1)
+        postponed = self.change('add_to_group', self.user1, 'g1', next_attempt_at=later, num_attempts=1)
+        blocked = self.change('remove_from_group', self.user1, 'g2')
+        other = self.change('add_to_group', self.user2, 'g1')
+
+        assert self.apply_pending() == 1
+        assert self.get_memberships() == [('crowd-test-2', 'g1', True)]
+
+        blocked = CrowdChange.objects.get(id=blocked.id)
+        assert blocked.next_attempt_at == later
+        assert blocked.num_attempts == 0
+        assert CrowdChange.objects.filter(id=postponed.id).exists()
+        assert not CrowdChange.objects.filter(id=other.id).exists()
+
+    def test_partial_failure(self):
+        from .models import CrowdChange
+        from .utils import CrowdError
+
+        first = self.change('add_to_group', self.user1, 'g1')
+        second = self.change('add_to_group', self.user1, 'g2')
+        other = self.change('add_to_group', self.user2, 'g1')
+
+        self.crowd_client.ensure_user_group_memberships.side_effect = [CrowdError('nope'), 1]
+
+        assert self.apply_pending() == 1
+
+        # The failed change and the one after it wait, the other user goes ahead
+        postponed = list(CrowdChange.objects.order_by('id'))
+        assert [change.id for change in postponed] == [first.id, second.id]
+        assert all(change.next_attempt_at > timezone.now() for change in postponed)
+        assert all(change.last_error for change in postponed)
+        assert not CrowdChange.objects.filter(id=other.id).exists()
+
+    def test_crowd_unreachable(self):
+        from .models import CrowdChange
+
+        self.change('ensure_group', group_name='g1')
+        self.change('add_to_group', self.user1, 'g1')
+
+        self.crowd_client.request.side_effect = ConnectionError('down')
+
+        assert self.apply_pending() == 0
+
+        changes = list(CrowdChange.objects.all())
+        assert len(changes) == 2
+        assert all(change.num_attempts == 1 for change in changes)
+        assert all(change.next_attempt_at > timezone.now() for change in changes)
+        assert all('down' in change.last_error for change in changes)
+        assert not self.crowd_client.ensure_user_group_memberships.called
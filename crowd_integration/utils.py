@@ -1,10 +1,13 @@
 import json
 import logging
+import threading
+from collections import OrderedDict
 
 from django.conf import settings
 
 import requests
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 
@@ -22,30 +25,145 @@ HEADERS = {
 }
 
 
+# Connections kept open to Crowd per thread
+CROWD_POOL_SIZE = 10
+
+# Entities fetched per request from paged listings
+CROWD_PAGE_SIZE = 1000
+
+
 class CrowdError(RuntimeError):
     pass
 
 
-def crowd_request(method, url, params={}, body=None, ignore_status_codes=[]):
-    url = '{base_url}{url}'.format(base_url=settings.KOMPASSI_CROWD_BASE_URL, url=url)
-
-    response = requests.request(
-        method=method,
-        url=url,
-        auth=AUTH,
-        data=json.dumps(body) if body else None,
-        headers=HEADERS,
-        params=params,
-    )
+class CrowdClient(object):
+    """
+    Talks to the Crowd usermanagement REST API over a requests.Session so that TLS connections are
+    kept alive and reused between calls instead of being opened for every request. Use get_client()
+    to get the client of the current thread.
+    """
+
+    def __init__(self, base_url=None, auth=AUTH, pool_size=CROWD_POOL_SIZE):
+        self.base_url = base_url if base_url is not None else settings.KOMPASSI_CROWD_BASE_URL
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update(HEADERS)
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, url, params={}, body=None, ignore_status_codes=[]):
+        response = self.session.request(
+            method=method,
+            url='{base_url}{url}'.format(base_url=self.base_url, url=url),
+            data=json.dumps(body) if body else None,
+            params=params,
+        )
+
+        if response.status_code in ignore_status_codes:
+            return
+
+        try:
+            response.raise_for_status()
+        except HTTPError as e:
+            logger.exception(response.text)
+            raise CrowdError(e)
+
+        return response
+
+    def get_names(self, url, params={}, key='users', page_size=CROWD_PAGE_SIZE, ignore_status_codes=[]):
+        """
+        Yields the names of the entities in a paged listing such as /search or /group/user/direct,
+        fetching page_size entities per request.
+        """
+        start_index = 0
+
+        while True:
+            page_params = dict(params)
+            page_params.update({'start-index': start_index, 'max-results': page_size})
+
+            response = self.request('GET', url, page_params, ignore_status_codes=ignore_status_codes)
+            if response is None:
+                return
+
+            entities = response.json().get(key, [])
+            for entity in entities:
+                yield entity['name']
+
+            if len(entities) < page_size:
+                return
+
+            start_index += page_size
+
+    def get_user_names(self, page_size=CROWD_PAGE_SIZE):
+        return self.get_names('/search', {'entity-type': 'user'}, 'users', page_size)
+
+    def get_group_member_names(self, group_name, page_size=CROWD_PAGE_SIZE):
+        """
+        Yields the usernames of the direct members of the group. A group missing from Crowd has no members.
+        """
+        return self.get_names(
+            '/group/user/direct',
+            {'groupname': group_name},
+            'users',
+            page_size,
+            ignore_status_codes=[404],
+        )
+
+    def ensure_user_group_memberships(self, memberships):
+        """
+        Given an iterable of (username, group_name, should_belong_to_group), makes Crowd agree. The
+        usermanagement API takes one membership per call, so the calls are made one after another over
+        the pooled connections, grouped by user. Returns the number of calls made.
+        """
+        memberships_by_username = OrderedDict()
+        for username, group_name, should_belong_to_group in memberships:
+            # The last word on a membership wins
+            memberships_by_username.setdefault(username, OrderedDict())[group_name] = should_belong_to_group
+
+        num_calls = 0
+        for username, user_memberships in memberships_by_username.items():
+            for group_name, should_belong_to_group in user_memberships.items():
+                if should_belong_to_group:
+                    self.request(
+                        'POST',
+                        '/user/group/direct',
+                        {'username': username},
+                        {'name': group_name},
+                        ignore_status_codes=[409],
+                    )
+                else:
+                    self.request(
+                        'DELETE',
+                        '/user/group/direct',
+                        {'username': username, 'groupname': group_name},
+                        ignore_status_codes=[404],
+                    )
+
+                num_calls += 1
+
+        return num_calls
+
+
+_local = threading.local()
+
+
+def get_client():
+    """
+    Returns the CrowdClient of the current thread. Sessions are not shared between threads.
+    """
+    client = getattr(_local, 'client', None)
+
+    if client is None:
+        client = _local.client = CrowdClient()
+
+    return client
 
-    if response.status_code in ignore_status_codes:
-        return
 
-    try:
-        response.raise_for_status()
-    except HTTPError as e:
-        logger.exception(response.text)
-        raise CrowdError(e)
+def crowd_request(method, url, params={}, body=None, ignore_status_codes=[]):
+    return get_client().request(method, url, params, body, ignore_status_codes=ignore_status_codes)
 
 
 def user_to_crowd(user, password=None):
@@ -95,23 +213,23 @@ def ensure_user_group_membership(user, group_name, should_belong_to_group=True):
         ensure_user_is_not_member_of_group(user, group_name)
 
 
-def ensure_user_is_member_of_group(user, group_name):
-    return crowd_request(
-        'POST',
-        '/user/group/direct',
-        {'username': user.username},
-        {'name': group_name},
-        ignore_status_codes=[409],
+def ensure_user_group_memberships(memberships):
+    """
+    Batch counterpart of ensure_user_group_membership. Takes an iterable of
+    (user, group_name, should_belong_to_group).
+    """
+    return get_client().ensure_user_group_memberships(
+        (user.username, group_name, should_belong_to_group)
+        for (user, group_name, should_belong_to_group) in memberships
     )
 
 
+def ensure_user_is_member_of_group(user, group_name):
+    return ensure_user_group_memberships([(user, group_name, True)])
+
+
 def ensure_user_is_not_member_of_group(user, group_name):
-    return crowd_request(
-        'DELETE',
-        '/user/group/direct',
-        {'username': user.username, 'groupname': group_name},
-        ignore_status_codes=[404],
-    )
+    return ensure_user_group_memberships([(user, group_name, False)])
 
 
 def create_user(user, password):
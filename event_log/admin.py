@@ -19,7 +19,7 @@ class EntryAdmin(admin.ModelAdmin):
 
 
 class SubscriptionAdmin(admin.ModelAdmin):
-    list_display = ('entry_type', 'user', 'active')
+    list_display = ('entry_type', 'user', 'channel', 'active')
     raw_id_fields = ('user',)
 
 
@@ -1,8 +1,10 @@
 from . import email
+from . import email_digest
 from . import callback
 
 
 channels = dict(
     email=email,
+    email_digest=email_digest,
     callback=callback,
 )
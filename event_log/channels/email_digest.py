@@ -0,0 +1,71 @@
+import logging
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.translation import ugettext as _
+
+
+logger = logging.getLogger('kompassi')
+
+def send_update_for_entry(subscription, entry):
+    from ..models import DigestItem
+
+    assert subscription.channel == 'email_digest'
+
+    DigestItem.objects.create(subscription=subscription, entry=entry)
+
+
+def send_digests():
+    """
+    Sends one e-mail per subscription listing the entries accumulated since its previous digest.
+    Called periodically (see CELERYBEAT_SCHEDULE and the event_log_send_digests management command).
+    Returns the number of digests sent.
+    """
+    from core.models import OutboxEmail
+    from ..models import DigestItem
+
+    num_sent = 0
+
+    with transaction.atomic():
+        item_ids = list(DigestItem.objects.select_for_update().values_list('id', flat=True))
+        if not item_ids:
+            return 0
+
+        items = (
+            DigestItem.objects
+            .filter(id__in=item_ids)
+            .select_related('subscription__user', 'entry')
+            .order_by('subscription_id', 'entry__created_at', 'entry_id')
+        )
+
+        for subscription, subscription_items in groupby(items, lambda item: item.subscription):
+            entries = [item.entry for item in subscription_items]
+
+            if not subscription.active:
+                continue
+
+            logger.debug('Sending a digest of %d entries to subscription %s', len(entries), subscription.id)
+
+            OutboxEmail.enqueue(
+                subject='[{app_name}] {message}'.format(
+                    app_name=settings.KOMPASSI_INSTALLATION_NAME,
+                    message=_('{num_entries} new events').format(num_entries=len(entries)),
+                ),
+                body=render_to_string('event_log_digest.eml', dict(
+                    subscription=subscription,
+                    entries=entries,
+                    settings=settings,
+                )),
+                to=(subscription.recipient_name_and_email,),
+                drain=False,
+            )
+            num_sent += 1
+
+        DigestItem.objects.filter(id__in=item_ids).delete()
+
+    if num_sent:
+        OutboxEmail.drain_async()
+
+    return num_sent
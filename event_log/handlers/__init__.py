@@ -1 +1,2 @@
 from . import entry  # noqa
+from . import subscription  # noqa
@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.dispatch import receiver
+from django.db.models.signals import post_delete, post_save
+
+from ..models import Subscription
+from ..models.subscription import invalidate_subscription_index
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def on_subscription_changed(sender, **kwargs):
+    # Now so that the rest of this transaction sees the change, and again after commit so that an index
+    # that another process built from the rows committed before ours is not kept.
+    invalidate_subscription_index()
+    transaction.on_commit(invalidate_subscription_index)
@@ -0,0 +1,13 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Send digest e-mails of event log entries (eg. from cron when Celery is not in use)'
+
+    def handle(self, *args, **options):
+        from ...channels.email_digest import send_digests
+
+        num_sent = send_digests()
+        self.stdout.write('Sent {num_sent} digests'.format(num_sent=num_sent))
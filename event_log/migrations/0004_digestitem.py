@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('event_log', '0003_subscription_event_survey_filter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='subscription',
+            name='channel',
+            field=models.CharField(choices=[('email', 'E-mail'), ('email_digest', 'E-mail digest'), ('callback', 'Callback')], default='email', max_length=12),
+        ),
+        migrations.CreateModel(
+            name='DigestItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='event_log.Entry')),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digest_items', to='event_log.Subscription')),
+            ],
+            options={
+                'verbose_name': 'digest item',
+                'verbose_name_plural': 'digest items',
+            },
+        ),
+    ]
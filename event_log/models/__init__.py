@@ -1,5 +1,6 @@
 from .entry import Entry  # noqa
 from .subscription import Subscription  # noqa
+from .digest_item import DigestItem  # noqa
 
 # not Django DB models
 from .entry_type_metadata import EntryTypeMetadata  # noqa
@@ -0,0 +1,17 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class DigestItem(models.Model):
+    """
+    An entry waiting to be included in the next digest e-mail of a subscription with channel=email_digest.
+    See event_log.channels.email_digest.
+    """
+
+    subscription = models.ForeignKey('event_log.Subscription', related_name='digest_items')
+    entry = models.ForeignKey('event_log.Entry')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('digest item')
+        verbose_name_plural = _('digest items')
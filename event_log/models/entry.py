@@ -1,10 +1,13 @@
+import logging
+
 from django.conf import settings
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
 
 
+logger = logging.getLogger('kompassi')
+
 TARGET_FKEY_ATTRS = dict(
     null=True,
     blank=True,
@@ -36,27 +39,33 @@ class Entry(models.Model):
         return self.event_survey_result if self.event_survey_result else self.global_survey_result
 
     def send_updates(self):
-        from .subscription import Subscription
+        """
+        Sends this entry to the matching subscriptions in a background task. If nobody is subscribed to
+        entries of this type, this costs no database queries.
+        """
+        from .subscription import get_subscription_index
 
-        q = Q(entry_type=self.entry_type, active=True)
+        if not get_subscription_index().get(self.entry_type):
+            return
 
-        # TODO need a more flexible filter solution that does not hard-code these
-        # One option would be to specify filter = JSONField in Subscription.
-        # Implementing this filter would require a client-side check or one SQL query
-        # per Subscription, however, as we query Subscriptions by Entry and not vice versa.
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from ..tasks import entry_send_updates
+            transaction.on_commit(lambda: entry_send_updates.delay(self.id))
+        else:
+            self._send_updates()
 
-        if self.event:
-            # Implement the event filter. Subscriptions without event_filter receive updates from
-            # all events. Subscriptions with event_filter receive only updates from that event.
-            q &= Q(event_filter=self.event) | Q(event_filter__isnull=True)
+    def _send_updates(self):
+        from .subscription import Subscription
 
-        if self.event_survey_result:
-            # Implement event survey filter.
-            survey = self.event_survey_result.survey
-            q &= Q(event_survey_filter=survey) | Q(event_survey_filter__isnull=True)
+        subscription_ids = Subscription.get_ids_for_entry(self)
+        if not subscription_ids:
+            return
 
-        for subscription in Subscription.objects.filter(q):
-            subscription.send_update_for_entry(self)
+        for subscription in Subscription.objects.filter(id__in=subscription_ids).select_related('user'):
+            try:
+                subscription._send_update_for_entry(self)
+            except Exception:
+                logger.exception('Failed to send entry %s to subscription %s', self.id, subscription.id)
 
     @property
     def entry_type_metadata(self):
@@ -1,4 +1,8 @@
+from collections import defaultdict
+from uuid import uuid4
+
 from django.conf import settings
+from django.core.cache import cache
 from django.forms import ValidationError
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
@@ -10,17 +14,62 @@ from ..channels import channels
 
 CHANNEL_CHOICES = [
     ('email', _('E-mail')),
+    ('email_digest', _('E-mail digest')),
     ('callback', _('Callback')),
     # ('sms', _('SMS')),
     # ('push', _('Push notifications')),
 ]
 
+SUBSCRIPTION_INDEX_VERSION_CACHE_KEY = 'event_log:subscription_index_version'
+
+# (version, index) where index is entry_type -> list of (subscription_id, event_filter_id, event_survey_filter_id)
+_subscription_index = (None, {})
+
+
+def get_subscription_index():
+    """
+    Returns a dict of entry_type -> list of (subscription_id, event_filter_id, event_survey_filter_id) of
+    active subscriptions. The index is cached in process memory. Saving or deleting a Subscription in any
+    process changes the version stored in the cache, which makes every process rebuild its index.
+    """
+    global _subscription_index
+
+    version = cache.get(SUBSCRIPTION_INDEX_VERSION_CACHE_KEY)
+    if version is None:
+        cache.add(SUBSCRIPTION_INDEX_VERSION_CACHE_KEY, uuid4().hex, None)
+        version = cache.get(SUBSCRIPTION_INDEX_VERSION_CACHE_KEY)
+
+    cached_version, index = _subscription_index
+    if version is not None and version == cached_version:
+        return index
+
+    index = defaultdict(list)
+    for entry_type, subscription_id, event_filter_id, event_survey_filter_id in (
+        Subscription.objects.filter(active=True).order_by('id').values_list(
+            'entry_type',
+            'id',
+            'event_filter_id',
+            'event_survey_filter_id',
+        )
+    ):
+        index[entry_type].append((subscription_id, event_filter_id, event_survey_filter_id))
+
+    index = dict(index)
+    _subscription_index = (version, index)
+
+    return index
+
+
+def invalidate_subscription_index():
+    cache.set(SUBSCRIPTION_INDEX_VERSION_CACHE_KEY, uuid4().hex, None)
+
 
 class Subscription(models.Model):
     """
     Channels:
 
     * `email` - e-mail will be sent to `user`
+    * `email_digest` - a summary of entries will be sent to `user` every KOMPASSI_EVENT_LOG_DIGEST_INTERVAL_MINUTES
     * `callback` - the callback specified in `callback_code` will be called (for testing mostly).
     """
 
@@ -57,14 +106,28 @@ class Subscription(models.Model):
 
     callback = code_property('callback_code')
 
-    def send_update_for_entry(self, entry):
-        assert self.active
-
-        if 'background_tasks' in settings.INSTALLED_APPS:
-            from ..tasks import subscription_send_update_for_entry
-            subscription_send_update_for_entry.delay(self.id, entry.id)
-        else:
-            self._send_update_for_entry(entry)
+    @classmethod
+    def get_ids_for_entry(cls, entry):
+        """
+        Returns the ids of the active subscriptions matching the entry, as determined by the subscription
+        index and the event and event survey filters.
+
+        Subscriptions without event_filter receive updates from all events. Subscriptions with
+        event_filter receive only updates from that event. The same goes for event_survey_filter.
+        """
+        subscriptions = get_subscription_index().get(entry.entry_type)
+        if not subscriptions:
+            return []
+
+        event_id = entry.event_id
+        survey_id = entry.event_survey_result.survey_id if entry.event_survey_result_id else None
+
+        return [
+            subscription_id
+            for (subscription_id, event_filter_id, event_survey_filter_id) in subscriptions
+            if (event_id is None or event_filter_id is None or event_filter_id == event_id)
+            and (survey_id is None or event_survey_filter_id is None or event_survey_filter_id == survey_id)
+        ]
 
     def _send_update_for_entry(self, entry):
         channels[self.channel].send_update_for_entry(self, entry)
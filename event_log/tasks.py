@@ -1,15 +1,24 @@
-
-
 from celery import shared_task
 
-from core.models import Person
-
 from .models import Subscription, Entry
 
 
+@shared_task(ignore_result=True)
+def entry_send_updates(entry_id):
+    entry = Entry.objects.get(id=entry_id)
+    entry._send_updates()
+
+
 @shared_task(ignore_result=True)
 def subscription_send_update_for_entry(subscription_id, entry_id):
+    # Superseded by entry_send_updates. Kept for tasks queued before the upgrade.
     subscription = Subscription.objects.get(id=subscription_id)
     entry = Entry.objects.get(id=entry_id)
 
     subscription._send_update_for_entry(entry)
+
+
+@shared_task(ignore_result=True)
+def subscriptions_send_digests():
+    from .channels.email_digest import send_digests
+    send_digests()
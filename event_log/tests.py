@@ -5,6 +5,7 @@ from surveys.models import EventSurvey, EventSurveyResult
 
 from .models import Subscription
 from .utils import emit
+from .models.subscription import get_subscription_index
 
 
 notifications = []
@@ -61,3 +62,53 @@ class EventSurveyFilterTestCase(TestCase):
         EventSurveyResult(survey=survey2, model=dict()).save()
 
         assert len(notifications) == 3
+
+
+class SubscriptionIndexTestCase(TestCase):
+    def setUp(self):
+        global notifications
+        notifications = []
+
+    def test_subscription_index(self):
+        get_subscription_index()
+
+        # only the INSERT of the entry
+        with self.assertNumQueries(1):
+            emit('event_log.nobody_cares')
+
+        subscription, unused = Subscription.get_or_create_dummy(
+            entry_type='event_log.somebody_cares',
+            channel='callback',
+            callback_code=f'{__name__}:notification_callback',
+        )
+
+        emit('event_log.somebody_cares')
+        assert len(notifications) == 1
+
+        subscription.active = False
+        subscription.save()
+
+        emit('event_log.somebody_cares')
+        assert len(notifications) == 1
+
+
+class EmailDigestTestCase(TestCase):
+    def test_send_digests(self):
+        from core.models import OutboxEmail
+        from .channels.email_digest import send_digests
+        from .models import DigestItem
+
+        subscription, unused = Subscription.get_or_create_dummy(channel='email_digest')
+
+        emit(subscription.entry_type)
+        emit(subscription.entry_type)
+        assert DigestItem.objects.filter(subscription=subscription).count() == 2
+
+        assert send_digests() == 1
+        assert not DigestItem.objects.exists()
+
+        email = OutboxEmail.objects.get()
+        assert email.to == [subscription.recipient_name_and_email]
+        assert '2' in email.subject
+
+        assert send_digests() == 0
@@ -1 +1,2 @@
 from . import access
+from . import change_data_capture
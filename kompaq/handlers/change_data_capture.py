@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+from django.conf import settings
+
+from core.models import Person
+
+from ..registry import register
+
+
+register(Person)
+
+if 'labour' in settings.INSTALLED_APPS:
+    from labour.models import Signup
+
+    # Signup.as_dict is for the shift planning tool
+    register(Signup, use_fields=True)
+
+if 'programme' in settings.INSTALLED_APPS:
+    from programme.models import Programme
+    register(Programme)
+
+if 'badges' in settings.INSTALLED_APPS:
+    from badges.models import Badge
+    register(Badge)
+
+if 'tickets' in settings.INSTALLED_APPS:
+    from tickets.models import Order
+    register(Order, exclude=('ip_address',))
+
+if 'access' in settings.INSTALLED_APPS:
+    from access.models import EmailAlias
+    register(EmailAlias)
@@ -0,0 +1,13 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Publish due messages from the kompaq outbox (eg. from cron when Celery is not in use)'
+
+    def handle(self, *args, **options):
+        from ...models import OutboxMessage
+
+        num_published = OutboxMessage.flush()
+        self.stdout.write('Published {num_published} messages'.format(num_published=num_published))
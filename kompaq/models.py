@@ -0,0 +1,152 @@
+# encoding: utf-8
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+
+logger = logging.getLogger('kompassi')
+
+# A claimed message is given back to the queue after this if the worker never finishes it.
+PUBLISHING_TIMEOUT = timedelta(minutes=10)
+
+
+class OutboxMessage(models.Model):
+    """
+    An AMQP message waiting to be published. Messages are written here in the same transaction as the
+    change they describe and published after commit by .flush, so that the broker being slow or down
+    never holds up the request that saved the model. Messages are published in the order they were
+    written, with publisher confirms, and deleted once the broker has confirmed them.
+    """
+
+    exchange = models.CharField(max_length=255)
+    body = models.TextField()
+
+    num_attempts = models.IntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'outbox message'
+        verbose_name_plural = 'outbox messages'
+
+    def __str__(self):
+        return self.exchange
+
+    @classmethod
+    def enqueue(cls, messages):
+        """
+        Takes a list of (exchange, body). The messages are published after the current transaction
+        commits.
+        """
+        if not messages:
+            return
+
+        cls.objects.bulk_create([cls(exchange=exchange, body=body) for (exchange, body) in messages])
+        transaction.on_commit(cls.flush_async)
+
+    @classmethod
+    def flush_async(cls):
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from .tasks import kompaq_flush
+            kompaq_flush.delay()
+        else:
+            try:
+                cls.flush()
+            except Exception:
+                # Left in the outbox for the next flush
+                logger.exception('Failed to flush the kompaq outbox')
+
+    @classmethod
+    def flush(cls, batch_size=None):
+        """
+        Publishes due messages in batches until there are none left or publishing fails. Returns the
+        number of messages published.
+        """
+        from pika.exceptions import AMQPError
+        from .utils import get_publisher
+
+        if batch_size is None:
+            batch_size = settings.KOMPAQ_FLUSH_BATCH_SIZE
+
+        publisher = get_publisher()
+        num_published = 0
+
+        while True:
+            messages = cls._claim_batch(batch_size)
+            if not messages:
+                break
+
+            published_ids = []
+            error = None
+
+            for message in messages:
+                try:
+                    confirmed = publisher.publish(message.exchange, message.body)
+                except AMQPError as e:
+                    error = e
+                else:
+                    if not confirmed:
+                        error = 'Not confirmed by the broker'
+
+                if error is not None:
+                    break
+
+                published_ids.append(message.id)
+
+            cls.objects.filter(id__in=published_ids).delete()
+            num_published += len(published_ids)
+
+            if error is not None:
+                # Keep the order: the rest wait for the failed one
+                logger.warning('Failed to publish kompaq message %s: %s', messages[len(published_ids)].id, error)
+                cls._postpone(messages[len(published_ids):], error)
+                break
+
+        return num_published
+
+    @classmethod
+    def get_seconds_until_next_attempt(cls):
+        next_attempt_at = cls.objects.aggregate(next_attempt_at=models.Min('next_attempt_at'))['next_attempt_at']
+        if next_attempt_at is None:
+            return None
+
+        return max(0, (next_attempt_at - timezone.now()).total_seconds())
+
+    @classmethod
+    def _claim_batch(cls, batch_size):
+        t = timezone.now()
+
+        with transaction.atomic():
+            if cls.objects.filter(next_attempt_at__gt=t).exists():
+                # Something is postponed or being published by another worker. Wait for it to keep the order.
+                return []
+
+            messages = list(cls.objects.select_for_update().order_by('id')[:batch_size])
+
+            if messages:
+                cls.objects.filter(id__in=[message.id for message in messages]).update(
+                    num_attempts=models.F('num_attempts') + 1,
+                    next_attempt_at=t + PUBLISHING_TIMEOUT,
+                )
+
+        for message in messages:
+            message.num_attempts += 1
+
+        return messages
+
+    @classmethod
+    def _postpone(cls, messages, error):
+        backoff = min(
+            settings.KOMPAQ_RETRY_BACKOFF_SECONDS * 2 ** (messages[0].num_attempts - 1),
+            settings.KOMPAQ_MAX_BACKOFF_SECONDS,
+        )
+
+        cls.objects.filter(id__in=[message.id for message in messages]).update(
+            next_attempt_at=timezone.now() + timedelta(seconds=backoff),
+            last_error=str(error),
+        )
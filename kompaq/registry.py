@@ -0,0 +1,299 @@
+# encoding: utf-8
+
+'''
+Change data capture: models registered here have a notification published to their exchange whenever
+instances are created, updated or deleted. Changes are collected per transaction and published after
+commit as one message per model, listing the changes. Updates carry the fields that changed.
+
+    from kompaq.registry import register
+    register(Person)
+
+Changes made with QuerySet.update bypass the signals and must be reported with record_updates.
+
+Registering is a no-op if 'kompaq' is not in INSTALLED_APPS.
+'''
+
+import json
+import threading
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete, pre_save
+
+from .utils import KOMPAQ_VERSION, _get_exchange_for_model
+
+
+registered_models = dict()
+_local = threading.local()
+
+
+class ModelRegistration(object):
+    __slots__ = [
+        'model',
+        'as_dict',
+        'exclude',
+    ]
+
+    def __init__(self, model, as_dict, exclude):
+        self.model = model
+        self.as_dict = as_dict
+        self.exclude = exclude
+
+    def get_fields(self, instance=None):
+        """
+        Returns the concrete fields that are not excluded. If instance is given, fields deferred by
+        .only() or .defer() and not loaded since are left out.
+        """
+        return [
+            field for field in self.model._meta.concrete_fields
+            if field.attname not in self.exclude and (instance is None or field.attname in instance.__dict__)
+        ]
+
+    def get_field_values(self, instance):
+        return dict((field.attname, getattr(instance, field.attname)) for field in self.get_fields())
+
+
+def register(model, as_dict=None, exclude=(), use_fields=False):
+    """
+    Opts model in to change notifications. The message for an instance is built by as_dict(instance),
+    by default the as_dict method of the model. Models without as_dict, or with use_fields=True, get
+    the values of their fields instead. Fields in exclude appear neither there nor in the changed fields.
+    """
+    if 'kompaq' not in settings.INSTALLED_APPS:
+        return
+
+    registration = ModelRegistration(model, as_dict, frozenset(exclude))
+
+    if use_fields:
+        registration.as_dict = registration.get_field_values
+    elif as_dict is None:
+        registration.as_dict = getattr(model, 'as_dict', registration.get_field_values)
+
+    registered_models[model] = registration
+
+    pre_save.connect(fetch_old_values, sender=model, dispatch_uid='kompaq_fetch_old_values')
+    post_save.connect(record_save, sender=model, dispatch_uid='kompaq_record_save')
+    pre_delete.connect(record_delete, sender=model, dispatch_uid='kompaq_record_delete')
+
+
+def fetch_old_values(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    Reads the stored values of the fields about to be saved so that record_save can tell which of them
+    changed. Only done on save so that loading instances costs nothing extra.
+    """
+    instance._kompaq_old_values = None
+
+    if raw or instance.pk is None:
+        return
+
+    fields = registered_models[sender].get_fields(instance)
+    if update_fields is not None:
+        fields = [field for field in fields if field.name in update_fields or field.attname in update_fields]
+
+    instance._kompaq_old_values = (
+        sender._base_manager
+        .filter(pk=instance.pk)
+        .values(*[field.attname for field in fields])
+        .first()
+    )
+
+
+def record_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    old_values = instance.__dict__.pop('_kompaq_old_values', None)
+
+    if created or old_values is None:
+        _record(sender, instance.pk, 'created', instance=instance)
+    else:
+        changed = dict(
+            (name, (old_value, getattr(instance, name)))
+            for (name, old_value) in old_values.items()
+            if getattr(instance, name) != old_value
+        )
+
+        if changed:
+            _record(sender, instance.pk, 'updated', changed, instance=instance)
+
+
+def record_delete(sender, instance, **kwargs):
+    # Built now because related objects may be gone after the delete
+    _record(sender, instance.pk, 'deleted', instance=instance, message=registered_models[sender].as_dict(instance))
+
+
+def record_updates(model, pks, updates):
+    """
+    Records the changes that QuerySet.update(**updates) is about to make to the instances with the given
+    primary keys. Call in the same transaction right before the update, with the rows locked. The
+    messages are built from the instances as they are after commit.
+    """
+    registration = registered_models.get(model)
+    if registration is None:
+        return
+
+    # updates may name foreign keys either way
+    new_values = dict()
+    for field in registration.get_fields():
+        for name in (field.name, field.attname):
+            if name in updates:
+                new_values[field.attname] = updates[name]
+
+    if not new_values:
+        return
+
+    for old_values in model._base_manager.filter(pk__in=pks).values('pk', *new_values.keys()).iterator():
+        pk = old_values.pop('pk')
+        changed = dict(
+            (name, (old_value, new_values[name]))
+            for (name, old_value) in old_values.items()
+            if new_values[name] != old_value
+        )
+
+        if changed:
+            _record(model, pk, 'updated', changed)
+
+
+class PendingChanges(object):
+    """
+    The changes recorded in one transaction or savepoint, keyed by (model, pk). Registered with
+    on_commit to publish them, so that when the transaction or savepoint is rolled back, Django drops
+    the last reference to it and the changes are forgotten along with it.
+    """
+
+    def __init__(self):
+        self.changes = OrderedDict()
+        self.flushed = False
+
+    def __call__(self):
+        self.flushed = True
+        flush_changes(self.changes)
+
+
+def _get_pending_changes():
+    """
+    Returns (pending_changes, is_new) for the innermost savepoint of the current transaction. Outside
+    atomic blocks every save is a transaction of its own.
+    """
+    connection = transaction.get_connection()
+
+    if not connection.in_atomic_block:
+        return PendingChanges(), True
+
+    if not hasattr(_local, 'pending_changes'):
+        _local.pending_changes = OrderedDict()
+
+    key = (connection.alias, tuple(connection.savepoint_ids))
+    ref = _local.pending_changes.get(key)
+    pending_changes = ref() if ref is not None else None
+
+    if pending_changes is not None and not pending_changes.flushed:
+        return pending_changes, False
+
+    # Forget those rolled back or published
+    for other_key, other_ref in list(_local.pending_changes.items()):
+        other = other_ref()
+        if other is None or other.flushed:
+            del _local.pending_changes[other_key]
+
+    pending_changes = PendingChanges()
+    _local.pending_changes[key] = weakref.ref(pending_changes)
+
+    return pending_changes, True
+
+
+def _record(model, pk, action, changed=None, instance=None, message=None):
+    """
+    Adds the change to those of the current transaction, merging it with an earlier change of the same
+    instance in the same savepoint. The changes are published after commit.
+    """
+    pending_changes, is_new = _get_pending_changes()
+    changes = pending_changes.changes
+
+    key = (model, pk)
+    earlier = changes.pop(key, None)
+
+    if earlier is None:
+        change = dict(instance=instance, action=action, changed=changed, message=message)
+    elif earlier['action'] == 'created' and action == 'deleted':
+        # Nobody needs to know
+        change = None
+    elif earlier['action'] == 'created':
+        change = dict(earlier, instance=instance or earlier['instance'])
+    elif action == 'updated':
+        # Keep the original old value and the latest new value of each field
+        merged = dict(earlier['changed'] or {})
+        for name, (old, new) in changed.items():
+            merged[name] = (merged[name][0] if name in merged else old, new)
+
+        merged = dict((name, (old, new)) for (name, (old, new)) in merged.items() if old != new)
+        change = dict(earlier, instance=instance or earlier['instance'], changed=merged) if merged else None
+    else:
+        change = dict(instance=instance, action=action, changed=changed, message=message)
+
+    if change is not None:
+        changes[key] = change
+
+    if is_new:
+        # Outside atomic blocks this runs right away
+        transaction.on_commit(pending_changes)
+
+
+def flush_changes(changes):
+    """
+    Writes the changes of a committed transaction to the outbox, one message per model. Changes
+    recorded by record_updates have no instance, so they are fetched now, in one query per model.
+    """
+    from .models import OutboxMessage
+
+    if not changes:
+        return
+
+    missing_pks_by_model = OrderedDict()
+    for (model, pk), change in changes.items():
+        if change['message'] is None and change['instance'] is None:
+            missing_pks_by_model.setdefault(model, []).append(pk)
+
+    instances_by_model = dict(
+        (model, model._base_manager.in_bulk(pks))
+        for (model, pks) in missing_pks_by_model.items()
+    )
+
+    changes_by_model = OrderedDict()
+    for (model, pk), change in changes.items():
+        registration = registered_models[model]
+
+        message = change['message']
+        if message is None:
+            instance = change['instance']
+            if instance is None:
+                instance = instances_by_model[model].get(pk)
+                if instance is None:
+                    # Deleted by a later transaction that will tell about it
+                    continue
+
+            message = registration.as_dict(instance)
+
+        message = dict(message, _action=change['action'])
+        if change['action'] == 'updated':
+            message['_changed'] = dict(
+                (name, dict(old=old, new=new))
+                for (name, (old, new)) in change['changed'].items()
+            )
+
+        changes_by_model.setdefault(model, []).append(message)
+
+    OutboxMessage.enqueue([
+        (
+            _get_exchange_for_model(model),
+            json.dumps(dict(
+                _type=model._meta.label,
+                _version=KOMPAQ_VERSION,
+                changes=changes,
+            ), cls=DjangoJSONEncoder),
+        )
+        for (model, changes) in changes_by_model.items()
+    ])
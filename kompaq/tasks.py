@@ -0,0 +1,26 @@
+from django.core.cache import cache
+
+from celery import shared_task
+
+
+FLUSH_LOCK_CACHE_KEY = 'kompaq:flush:lock'
+FLUSH_LOCK_TIMEOUT = 10 * 60
+
+
+@shared_task(ignore_result=True)
+def kompaq_flush():
+    from .models import OutboxMessage
+
+    # Only one flusher at a time so that messages are published in order. The one running will take
+    # care of any new messages.
+    if not cache.add(FLUSH_LOCK_CACHE_KEY, True, FLUSH_LOCK_TIMEOUT):
+        return
+
+    try:
+        OutboxMessage.flush()
+    finally:
+        cache.delete(FLUSH_LOCK_CACHE_KEY)
+
+    seconds = OutboxMessage.get_seconds_until_next_attempt()
+    if seconds is not None:
+        kompaq_flush.apply_async(countdown=seconds)
@@ -0,0 +1,279 @@
+import json
+from unittest import skipUnless
+from unittest.mock import Mock, patch
+
+from django.conf import settings
+from django.db import transaction
+from django.test import TestCase
+from django.utils import timezone
+
+from core.models import Person
+
+
+class RollbackTest(Exception):
+    pass
+
+
+@skipUnless('kompaq' in settings.INSTALLED_APPS, 'requires kompaq')
+class ChangeDataCaptureTestCase(TestCase):
+    def commit(self, model_label='core.Person'):
+        """
+        The test case runs in a transaction that is never committed, so publish what has been recorded
+        so far as if it had been, and return the changes of the model.
+        """
+        from .models import OutboxMessage
+        from .registry import _local
+
+        for ref in list(getattr(_local, 'pending_changes', {}).values()):
+            pending_changes = ref()
+            if pending_changes is not None and not pending_changes.flushed:
+                pending_changes()
+
+        messages = [json.loads(message.body) for message in OutboxMessage.objects.order_by('id')]
+        OutboxMessage.objects.all().delete()
+
+        return [change for message in messages if message['_type'] == model_label for change in message['changes']]
+
+    def test_create_and_delete(self):
+        person, unused = Person.get_or_create_dummy()
+        person.delete()
+
+        assert self.commit() == []
+
+    def test_create_and_update(self):
+        person, unused = Person.get_or_create_dummy()
+        person.nick = 'Mahtava'
+        person.save()
+
+        changes = self.commit()
+        assert len(changes) == 1
+        assert changes[0]['_action'] == 'created'
+        assert changes[0]['nick'] == 'Mahtava'
+        assert '_changed' not in changes[0]
+
+    def test_update_and_update(self):
+        person, unused = Person.get_or_create_dummy()
+        self.commit()
+
+        person = Person.objects.get(id=person.id)
+        person.nick = 'Mahtava'
+        person.save()
+        person.nick = 'Mahtavin'
+        person.email = 'mahtavin@example.com'
+        person.save()
+        person.email = 'mahti@example.com'
+        person.save()
+
+        changes = self.commit()
+        assert len(changes) == 1
+        assert changes[0]['_action'] == 'updated'
+        assert changes[0]['_changed'] == dict(nick=dict(old='Mahti', new='Mahtavin'))
+
+    def test_message(self):
+        from .models import OutboxMessage
+        from .registry import _get_pending_changes
+        from .utils import KOMPAQ_VERSION, _get_exchange_for_model
+
+        person, unused = Person.get_or_create_dummy()
+        person_id = person.id
+        self.commit()
+
+        person.delete()
+
+        pending_changes, unused = _get_pending_changes()
+        pending_changes()
+
+        message = OutboxMessage.objects.get(exchange=_get_exchange_for_model(Person))
+        body = json.loads(message.body)
+
+        assert body['_type'] == 'core.Person'
+        assert body['_version'] == KOMPAQ_VERSION
+        assert len(body['changes']) == 1
+        assert body['changes'][0]['_action'] == 'deleted'
+        assert body['changes'][0]['id'] == person_id
+
+    def test_rollback(self):
+        person, unused = Person.get_or_create_dummy()
+        self.commit()
+
+        try:
+            with transaction.atomic():
+                person = Person.objects.get(id=person.id)
+                person.nick = 'Rollback'
+                person.save()
+                raise RollbackTest()
+        except RollbackTest:
+            pass
+
+        person = Person.objects.get(id=person.id)
+        person.email = 'mahtava@example.com'
+        person.save()
+
+        changes = self.commit()
+        assert len(changes) == 1
+        assert changes[0]['_changed'] == dict(email=dict(old='mahti@example.com', new='mahtava@example.com'))
+
+    def test_savepoint_rollback(self):
+        person, unused = Person.get_or_create_dummy()
+        self.commit()
+
+        person = Person.objects.get(id=person.id)
+        person.nick = 'Mahtava'
+        person.save()
+
+        try:
+            with transaction.atomic():
+                person.email = 'rollback@example.com'
+                person.save()
+                raise RollbackTest()
+        except RollbackTest:
+            pass
+
+        changes = self.commit()
+        assert len(changes) == 1
+        assert changes[0]['_changed'] == dict(nick=dict(old='Mahti', new='Mahtava'))
+
+    def test_deferred_fields(self):
+        person, unused = Person.get_or_create_dummy()
+        self.commit()
+
+        with self.assertNumQueries(1):
+            person = Person.objects.only('id', 'nick').get(id=person.id)
+
+        person.nick = 'Mahtava'
+        person.save()
+
+        changes = self.commit()
+        assert len(changes) == 1
+        assert changes[0]['_changed'] == dict(nick=dict(old='Mahti', new='Mahtava'))
+
+    def test_record_updates(self):
+        from labour.models import Signup
+
+        signup, unused = Signup.get_or_create_dummy()
+        self.commit()
+
+        assert Signup.mass_reject(Signup.objects.filter(event=signup.event)) == [signup.id]
+
+        changes = [
+            change for change in self.commit('labour.Signup')
+            if change['id'] == signup.id and 'is_active' in change.get('_changed', {})
+        ]
+        assert len(changes) == 1
+        assert changes[0]['_action'] == 'updated'
+        assert changes[0]['_changed']['is_active'] == dict(old=True, new=False)
+        assert changes[0]['time_rejected'] is not None
+
+
+class StubPublisher(object):
+    def __init__(self, results):
+        self.results = list(results)
+        self.published = []
+
+    def publish(self, exchange_name, body):
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+
+        self.published.append(body)
+        return result
+
+
+@skipUnless('kompaq' in settings.INSTALLED_APPS, 'requires kompaq')
+class OutboxTestCase(TestCase):
+    def flush(self, publisher):
+        from .models import OutboxMessage
+
+        with patch('kompaq.utils.get_publisher', return_value=publisher):
+            return OutboxMessage.flush(batch_size=2)
+
+    def enqueue(self, *bodies):
+        from .models import OutboxMessage
+        OutboxMessage.enqueue([('kompassi.test', body) for body in bodies])
+
+    def test_flush(self):
+        from .models import OutboxMessage
+
+        self.enqueue('1', '2', '3')
+        publisher = StubPublisher([])
+
+        assert self.flush(publisher) == 3
+        assert publisher.published == ['1', '2', '3']
+        assert not OutboxMessage.objects.exists()
+
+    def test_not_confirmed(self):
+        from .models import OutboxMessage
+
+        self.enqueue('1', '2', '3')
+        publisher = StubPublisher([True, False])
+
+        assert self.flush(publisher) == 1
+        assert publisher.published == ['1', '2']
+
+        # Only the confirmed message is gone
+        remaining = list(OutboxMessage.objects.order_by('id'))
+        assert [message.body for message in remaining] == ['2', '3']
+        assert remaining[0].next_attempt_at > timezone.now()
+        assert remaining[0].last_error
+
+        # Nothing jumps the queue while the unconfirmed one waits
+        self.enqueue('4')
+        assert self.flush(StubPublisher([])) == 0
+
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        publisher = StubPublisher([])
+        assert self.flush(publisher) == 3
+        assert publisher.published == ['2', '3', '4']
+
+    def test_publish_error(self):
+        from pika.exceptions import AMQPConnectionError
+        from .models import OutboxMessage
+
+        self.enqueue('1', '2')
+
+        assert self.flush(StubPublisher([AMQPConnectionError()])) == 0
+        assert OutboxMessage.objects.filter(num_attempts=1).count() == 2
+
+
+class PublisherTestCase(TestCase):
+    def get_publisher(self, channel):
+        from .utils import Publisher
+
+        publisher = Publisher('amqp://localhost')
+        publisher.open = Mock()
+        publisher.close = Mock()
+        publisher.channel = channel
+
+        return publisher
+
+    def test_reconnect_once(self):
+        from pika.exceptions import AMQPConnectionError
+
+        channel = Mock()
+        channel.basic_publish.side_effect = [AMQPConnectionError(), True]
+        publisher = self.get_publisher(channel)
+
+        assert publisher.publish('kompassi.test', '{}')
+        assert publisher.open.call_count == 2
+        assert publisher.close.call_count == 1
+
+    def test_give_up(self):
+        from pika.exceptions import AMQPConnectionError
+
+        channel = Mock()
+        channel.basic_publish.side_effect = AMQPConnectionError()
+        publisher = self.get_publisher(channel)
+
+        with self.assertRaises(AMQPConnectionError):
+            publisher.publish('kompassi.test', '{}')
+
+        assert channel.basic_publish.call_count == 2
+
+    def test_declare_once(self):
+        channel = Mock()
+        publisher = self.get_publisher(channel)
+
+        publisher.publish('kompassi.test', '1')
+        publisher.publish('kompassi.test', '2')
+
+        assert channel.exchange_declare.call_count == 1
@@ -6,50 +6,119 @@ Public API for the outbound AMQP notifications. It is safe to import this module
 '''
 
 import json
+import logging
 
 from django.conf import settings
 
+from pika import BasicProperties, BlockingConnection
 from pika.connection import URLParameters
-from pika import BlockingConnection
+from pika.exceptions import AMQPError
 
 
-_channel = None
-_exchanges_we_declared = set()
+logger = logging.getLogger('kompassi')
 
 KOMPAQ_VERSION = '0.1'
 
 
-def _get_channel():
-    global _channel
-    assert 'kompaq' in settings.INSTALLED_APPS
+class Publisher(object):
+    """
+    Keeps a connection to the broker open between flushes of the outbox (see kompaq.models.OutboxMessage)
+    and opens a new one when it has been lost. Messages are published with publisher confirms. Exchanges
+    are declared once per connection instead of before every message.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.connection = None
+        self.channel = None
+        self.declared_exchanges = set()
+
+    @property
+    def is_open(self):
+        return (
+            self.connection is not None and self.connection.is_open and
+            self.channel is not None and self.channel.is_open
+        )
 
-    if not _channel:
-        connection = BlockingConnection(URLParameters(settings.KOMPAQ_URL))
-        _channel = connection.channel()
+    def open(self):
+        if self.is_open:
+            return
 
-    return _channel
+        self.close()
 
+        self.connection = BlockingConnection(URLParameters(self.url))
+        self.channel = self.connection.channel()
+        self.channel.confirm_delivery()
 
-def _get_exchange_for_model_instance(instance, exchange_type='fanout'):
-    assert 'kompaq' in settings.INSTALLED_APPS
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except AMQPError:
+                pass
 
-    model = instance.__class__
-    meta = model._meta
-    exchange_name = '{prefix}.{app_label}.{model_name}'.format(
-        prefix='kompassi', # TODO NEW_INSTALLATION_SLUG
-        app_label=meta.app_label,
-        model_name=meta.model_name,
-    )
+        self.connection = None
+        self.channel = None
+        self.declared_exchanges = set()
 
-    if exchange_name not in _exchanges_we_declared:
-        channel = _get_channel()
-        channel.exchange_declare(
+    def declare_exchange(self, exchange_name, exchange_type='fanout'):
+        if exchange_name in self.declared_exchanges:
+            return
+
+        self.channel.exchange_declare(
             exchange=exchange_name,
             type=exchange_type,
             durable=True,
         )
+        self.declared_exchanges.add(exchange_name)
+
+    def publish(self, exchange_name, body):
+        """
+        Returns True if the broker confirmed the message. If the connection turns out to have been
+        lost, reconnects and tries once more.
+        """
+        for attempt in range(2):
+            try:
+                self.open()
+                self.declare_exchange(exchange_name)
+
+                # routing_key='' – fanout exchange
+                return self.channel.basic_publish(
+                    exchange=exchange_name,
+                    routing_key='',
+                    body=body,
+                    properties=BasicProperties(content_type='application/json', delivery_mode=2),
+                )
+            except AMQPError:
+                self.close()
+
+                if attempt > 0:
+                    raise
+
+                logger.info('Lost connection to the kompaq broker, reconnecting')
 
-    return exchange_name
+
+_publisher = None
+
+
+def get_publisher():
+    global _publisher
+    assert 'kompaq' in settings.INSTALLED_APPS
+
+    if _publisher is None:
+        _publisher = Publisher(settings.KOMPAQ_URL)
+
+    return _publisher
+
+
+def _get_exchange_for_model(model):
+    meta = model._meta
+
+    return '{prefix}.{app_label}.{model_name}'.format(
+        prefix='kompassi', # TODO NEW_INSTALLATION_SLUG
+        app_label=meta.app_label,
+        model_name=meta.model_name,
+    )
 
 
 def _format_message(instance, action):
@@ -64,12 +133,14 @@ def _format_message(instance, action):
 
 
 def send_update(instance, action='created'):
+    """
+    Queues a notification about the instance to be published once the current transaction commits.
+    """
     if 'kompaq' not in settings.INSTALLED_APPS:
         return
 
-    channel = _get_channel()
-    exchange = _get_exchange_for_model_instance(instance)
-    body = json.dumps(_format_message(instance, action))
+    from .models import OutboxMessage
 
-    # routing_key='' – fanout exchange
-    channel.basic_publish(exchange=exchange, routing_key='', body=body)
+    OutboxMessage.enqueue([
+        (_get_exchange_for_model(instance.__class__), json.dumps(_format_message(instance, action))),
+    ])
@@ -1,5 +1,6 @@
 import os
 import warnings
+from datetime import timedelta
 from email.utils import parseaddr
 
 from django.utils.translation import ugettext_lazy as _
@@ -89,6 +90,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.auth.middleware.SessionAuthenticationMiddleware',
     'oauth2_provider.middleware.OAuth2TokenMiddleware',
+    'core.middleware.GroupIdsCacheMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'core.middleware.PageWizardMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -299,6 +301,10 @@ KOMPASSI_PHONENUMBERS_DEFAULT_REGION = 'FI'
 # getattr'd from phonenumbers.PhoneNumberFormat with itself as default
 KOMPASSI_PHONENUMBERS_DEFAULT_FORMAT = 'INTERNATIONAL'
 
+# Large exports are generated in the background (see core.models.ExportJob).
+# Finished exports are deleted after this many hours
+KOMPASSI_EXPORT_JOB_RETENTION_HOURS = env.int('KOMPASSI_EXPORT_JOB_RETENTION_HOURS', default=24)
+
 
 # Sending email
 if env('EMAIL_HOST', default=''):
@@ -308,6 +314,20 @@ else:
 
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL', default='spam@example.com')
 
+# E-mail is sent through an outbox (see core.models.OutboxEmail) in batches of this many messages
+KOMPASSI_EMAIL_OUTBOX_BATCH_SIZE = env.int('KOMPASSI_EMAIL_OUTBOX_BATCH_SIZE', default=100)
+
+# Messages per minute per recipient domain, eg. {'gmail.com': 300}. 0 means no limit.
+KOMPASSI_EMAIL_OUTBOX_RATE_LIMITS = {}
+KOMPASSI_EMAIL_OUTBOX_DEFAULT_RATE_LIMIT = env.int('KOMPASSI_EMAIL_OUTBOX_DEFAULT_RATE_LIMIT', default=0)
+
+# Failed messages are retried after 1, 2, 4... times this many seconds until they have been tried this many times
+KOMPASSI_EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS = 60
+KOMPASSI_EMAIL_OUTBOX_MAX_ATTEMPTS = env.int('KOMPASSI_EMAIL_OUTBOX_MAX_ATTEMPTS', default=6)
+
+# Event log subscriptions with channel=email_digest get a summary of new entries this often
+KOMPASSI_EVENT_LOG_DIGEST_INTERVAL_MINUTES = env.int('KOMPASSI_EVENT_LOG_DIGEST_INTERVAL_MINUTES', default=60)
+
 
 if 'payments' in INSTALLED_APPS:
     from payments.defaults import CHECKOUT_PARAMS  # noqafoo
@@ -341,11 +361,25 @@ if env('BROKER_URL', default=''):
     CELERY_TASK_SERIALIZER = 'json'
     CELERY_RESULT_SERIALIZER = 'json'
 
+    CELERYBEAT_SCHEDULE = {
+        'event_log-send-digests': dict(
+            task='event_log.tasks.subscriptions_send_digests',
+            schedule=timedelta(minutes=KOMPASSI_EVENT_LOG_DIGEST_INTERVAL_MINUTES),
+        ),
+    }
+
 
 if env('KOMPAQ_URL', default=''):
     INSTALLED_APPS = INSTALLED_APPS + ('kompaq',)
     KOMPAQ_URL = env('KOMPAQ_URL')
 
+    # Notifications are published from an outbox (see kompaq.models.OutboxMessage) this many at a time
+    KOMPAQ_FLUSH_BATCH_SIZE = 100
+
+    # Failed messages are retried after 1, 2, 4... times this many seconds, but at most this many seconds apart
+    KOMPAQ_RETRY_BACKOFF_SECONDS = 10
+    KOMPAQ_MAX_BACKOFF_SECONDS = 10 * 60
+
 
 if 'api' in INSTALLED_APPS:
     KOMPASSI_APPLICATION_USER_GROUP = '{KOMPASSI_INSTALLATION_SLUG}-apps'.format(**locals())
@@ -371,6 +405,13 @@ if 'nexmo' in INSTALLED_APPS:
     NEXMO_INBOUND_KEY = env('NEXMO_INBOUND_KEY', default='deadbeef')
 
 
+if 'sms' in INSTALLED_APPS:
+    # Outgoing SMS are sent at most this many message fragments per second on average (see sms.models.SMSMessageOut.dispatch)
+    KOMPASSI_SMS_FRAGMENTS_PER_SECOND = env.float('KOMPASSI_SMS_FRAGMENTS_PER_SECOND', default=3.0)
+    KOMPASSI_SMS_BURST_FRAGMENTS = env.int('KOMPASSI_SMS_BURST_FRAGMENTS', default=30)
+    KOMPASSI_SMS_DISPATCH_BATCH_SIZE = 100
+
+
 if 'branding' in INSTALLED_APPS:
     KOMPASSI_ACCOUNT_BRANDING = 'Kompassi-tunnus'
     KOMPASSI_ACCOUNT_BRANDING_PARTITIVE = 'Kompassi-tunnusta'
@@ -386,6 +427,13 @@ if env('KOMPASSI_CROWD_APPLICATION_PASSWORD', default=''):
     KOMPASSI_CROWD_HOST = env('KOMPASSI_CROWD_HOST', default='https://crowd.tracon.fi')
     KOMPASSI_CROWD_BASE_URL = '{host}/crowd/rest/usermanagement/1'.format(host=KOMPASSI_CROWD_HOST)
 
+    # Changes to Crowd are applied in the background this many at a time (see crowd_integration.models.CrowdChange)
+    KOMPASSI_CROWD_CHANGE_BATCH_SIZE = 100
+
+    # Failed changes are retried after 1, 2, 4... times this many seconds, but at most this many seconds apart
+    KOMPASSI_CROWD_CHANGE_RETRY_BACKOFF_SECONDS = 30
+    KOMPASSI_CROWD_CHANGE_MAX_BACKOFF_SECONDS = 60 * 60
+
 
 if 'desuprofile_integration' in INSTALLED_APPS:
     KOMPASSI_DESUPROFILE_HOST = env('KOMPASSI_DESUPROFILE_HOST', default='https://desucon.fi')
@@ -1,18 +1,27 @@
 # encoding: utf-8
 
-import sys
-
 from django.core.management.base import BaseCommand
 
+
 class Command(BaseCommand):
-    args = ''
     help = 'Make sure all users belong to their respective labour groups'
 
-    def handle(*args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument('event_slugs', nargs='*', metavar='EVENT_SLUG')
+
+    def handle(self, *args, **options):
+        from core.models import Event
         from labour.models import Signup
-        for signup in Signup.objects.all():
-            signup.apply_state()
-            sys.stdout.write('.')
-            sys.stdout.flush()
 
-        print()
\ No newline at end of file
+        if options['event_slugs']:
+            events = Event.objects.filter(slug__in=options['event_slugs'])
+        else:
+            events = Event.objects.filter(laboureventmeta__isnull=False)
+
+        for event in events:
+            num_added, num_removed = Signup.reconcile_group_membership(event)
+            self.stdout.write('{event.slug}: {num_added} memberships added, {num_removed} removed'.format(
+                event=event,
+                num_added=num_added,
+                num_removed=num_removed,
+            ))
@@ -99,8 +99,7 @@ class JobCategory(models.Model):
 
     @property
     def group(self):
-        from django.contrib.auth.models import Group
-        return Group.objects.get(name=self.event.labour_event_meta.make_group_name(self.event, self.slug))
+        return self.event.labour_event_meta.get_group(self.slug)
 
     def is_person_qualified(self, person):
         if not self.required_qualifications.exists():
@@ -1,9 +1,11 @@
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 
 from django.conf import settings
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 from django.db.models import Sum
 from django.db.models.functions import Coalesce
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 from six import text_type
@@ -11,7 +13,7 @@ from six import text_type
 from core.csv_export import CsvExportMixin
 from core.utils import (
     alias_property,
-    ensure_user_group_membership,
+    ensure_group_membership,
     get_previous_and_next,
     time_bool_property,
 )
@@ -30,6 +32,15 @@ from .constants import (
 )
 
 
+MASS_STATE_CHANGE_CHUNK_SIZE = 100
+MASS_STATE_CHANGE_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+
+def get_mass_state_change_progress_cache_keys(event_id):
+    prefix = 'labour:mass_state_change:{event_id}'.format(event_id=event_id)
+    return prefix + ':total', prefix + ':done'
+
+
 class StateTransition(object):
     """
     This class represents a potential state transition of a Signup from its current state to
@@ -418,17 +429,224 @@ class Signup(models.Model, CsvExportMixin):
 
     @classmethod
     def _mass_state_change(cls, old_state, new_state, signups, filter_func=None):
+        """
+        Moves the signups from old_state to new_state with a single UPDATE. Group membership is updated
+        set-wise right away and the rest of apply_state is carried out in chunks by mass_apply_state.
+
+        Returns the IDs of the signups that were changed.
+        """
         if filter_func is None:
-            signups = signups.filter(**Signup.get_state_query_params(old_state))
+            signups = signups.filter(**cls.get_state_query_params(old_state))
         else:
             signups = filter_func(signups)
 
-        for signup in signups:
-            signup.state = new_state
-            signup.save()
-            signup.apply_state()
+        candidate_ids = list(signups.order_by().values_list('id', flat=True).distinct())
+        if not candidate_ids:
+            return candidate_ids
+
+        signup_ids_by_event_id = defaultdict(list)
+
+        with transaction.atomic():
+            # Someone else may have changed the state of some of these signups in the meantime.
+            locked_signups = cls.objects.filter(
+                id__in=candidate_ids,
+                **cls.get_state_query_params(old_state)
+            ).select_for_update()
+
+            for signup_id, event_id in locked_signups.values_list('id', 'event_id'):
+                signup_ids_by_event_id[event_id].append(signup_id)
+
+            signup_ids = [signup_id for ids in signup_ids_by_event_id.values() for signup_id in ids]
+            updates = dict(cls.get_state_transition_updates(old_state, new_state), updated_at=now())
+
+            if 'kompaq' in settings.INSTALLED_APPS:
+                # QuerySet.update sends no post_save
+                from kompaq.registry import record_updates
+                record_updates(cls, signup_ids, updates)
+
+            cls.objects.filter(id__in=signup_ids).update(**updates)
+
+        for event_id, event_signup_ids in signup_ids_by_event_id.items():
+            cls.mass_apply_state_group_membership(event_id, event_signup_ids, old_state, new_state)
+            cls.mass_apply_state(event_id, event_signup_ids, old_state, new_state)
+
+        return signup_ids
+
+    @classmethod
+    def get_state_transition_updates(cls, old_state, new_state, t=None):
+        """
+        Returns the field values that, given to QuerySet.update, move signups from old_state to new_state
+        just like setting .state on each of them would.
+        """
+        if t is None:
+            t = now()
+
+        # STATE_TIME_FIELDS has created_at in place of is_active
+        field_names = ['is_active'] + STATE_TIME_FIELDS[1:]
+        updates = dict()
+
+        for field_name, old_flag, new_flag in zip(
+            field_names,
+            STATE_FLAGS_BY_NAME[old_state],
+            STATE_FLAGS_BY_NAME[new_state],
+        ):
+            if old_flag == new_flag:
+                continue
+            elif field_name == 'is_active':
+                updates[field_name] = new_flag
+            else:
+                updates[field_name] = t if new_flag else None
+
+        return updates
+
+    @classmethod
+    def get_state_group_suffixes(cls, state):
+        """
+        Returns the suffixes of those SIGNUP_STATE_GROUPS that a signup in the given state belongs to.
+        """
+        signup = cls()
+        signup.state = state
+
+        return set(
+            group_suffix
+            for group_suffix in SIGNUP_STATE_GROUPS
+            if getattr(signup, 'is_{group_suffix}'.format(group_suffix=group_suffix))
+        )
+
+    @classmethod
+    def mass_apply_state_group_membership(cls, event_id, signup_ids, old_state, new_state):
+        """
+        Of the groups managed by apply_state_group_membership, only the SIGNUP_STATE_GROUPS depend on the
+        state. Every signup moving from old_state to new_state thus gets added to and removed from the same
+        groups, and each of those is updated once for all of them.
+        """
+        from django.contrib.auth.models import User
+        from core.models import Event
+
+        old_suffixes = cls.get_state_group_suffixes(old_state)
+        new_suffixes = cls.get_state_group_suffixes(new_state)
+
+        if old_suffixes == new_suffixes:
+            return
+
+        meta = Event.objects.get(id=event_id).labour_event_meta
+        users = list(User.objects.filter(person__signup__id__in=signup_ids).distinct())
+
+        for group_suffix in new_suffixes - old_suffixes:
+            ensure_group_membership(meta.get_group(group_suffix), users_to_add=users)
+
+        for group_suffix in old_suffixes - new_suffixes:
+            ensure_group_membership(meta.get_group(group_suffix), users_to_remove=users)
+
+    @classmethod
+    def mass_apply_state(cls, event_id, signup_ids, old_state, new_state, chunk_size=MASS_STATE_CHANGE_CHUNK_SIZE):
+        """
+        Carries out the rest of apply_state for signups that _mass_state_change moved from old_state to
+        new_state. The work is split in chunks of chunk_size signups that are processed as separate Celery
+        tasks if background_tasks is installed. See get_mass_state_change_progress.
+        """
+        total_key, done_key = get_mass_state_change_progress_cache_keys(event_id)
+        cache.add(total_key, 0, MASS_STATE_CHANGE_PROGRESS_TIMEOUT)
+        cache.add(done_key, 0, MASS_STATE_CHANGE_PROGRESS_TIMEOUT)
+        cache.incr(total_key, len(signup_ids))
+
+        for i in range(0, len(signup_ids), chunk_size):
+            chunk_ids = signup_ids[i:i + chunk_size]
+
+            if 'background_tasks' in settings.INSTALLED_APPS:
+                from ..tasks import signup_mass_apply_state
+                signup_mass_apply_state.delay(event_id, chunk_ids, old_state, new_state)
+            else:
+                cls._mass_apply_state(event_id, chunk_ids, old_state, new_state)
+
+    @classmethod
+    def _mass_apply_state(cls, event_id, signup_ids, old_state, new_state):
+        total_key, done_key = get_mass_state_change_progress_cache_keys(event_id)
+
+        try:
+            cls._mass_apply_state_chunk(event_id, signup_ids, old_state, new_state)
+        except Exception:
+            # The failed chunk would never be done, so stop reporting the mass state change as in progress
+            cache.delete_many([total_key, done_key])
+            raise
+
+        try:
+            cache.incr(done_key, len(signup_ids))
+        except ValueError:
+            # progress expired
+            pass
+
+    @classmethod
+    def _mass_apply_state_chunk(cls, event_id, signup_ids, old_state, new_state):
+        from core.models import Event
+
+        old_flags = dict(zip(('is_active', 'is_accepted'), STATE_FLAGS_BY_NAME[old_state]))
+        new_flags = dict(zip(('is_active', 'is_accepted'), STATE_FLAGS_BY_NAME[new_state]))
+        signups = list(cls.objects.filter(id__in=signup_ids).select_related('event', 'person__user'))
+
+        if new_flags['is_accepted'] and not old_flags['is_accepted']:
+            # Accepting may set job categories and personnel classes, and these affect groups,
+            # badges and messages in ways that are not the same for every signup.
+            for signup in signups:
+                signup.apply_state_sync()
+                signup._apply_state()
+        else:
+            if new_flags['is_active'] != old_flags['is_active']:
+                # Badges and SignupExtra.is_active only depend on whether the signup is active.
+                for signup in signups:
+                    signup.signup_extra.apply_state()
+                    signup.apply_state_create_badges()
+
+            added_suffixes = cls.get_state_group_suffixes(new_state) - cls.get_state_group_suffixes(old_state)
+            if added_suffixes:
+                event = Event.objects.get(id=event_id)
+                meta = event.labour_event_meta
+                added_groups = [meta.get_group(group_suffix) for group_suffix in added_suffixes]
+                persons = [signup.person for signup in signups if signup.person.user is not None]
+
+                cls.mass_apply_state_email_aliases(persons, added_groups)
+                cls.mass_apply_state_send_messages(event, persons, added_groups)
+
+    @classmethod
+    def mass_apply_state_email_aliases(cls, persons, added_groups):
+        if 'access' not in settings.INSTALLED_APPS:
+            return
 
-        return signups
+        from access.models import GroupEmailAliasGrant
+
+        # Any aliases granted by other groups have been ensured already.
+        if not GroupEmailAliasGrant.objects.filter(group__in=added_groups).exists():
+            return
+
+        for person in persons:
+            GroupEmailAliasGrant.ensure_aliases(person)
+
+    @classmethod
+    def mass_apply_state_send_messages(cls, event, persons, added_groups):
+        if 'mailings' not in settings.INSTALLED_APPS:
+            return
+
+        from mailings.models import Message
+
+        # Messages to other groups have been sent already.
+        for message in Message.objects.filter(
+            recipient__app_label='labour',
+            recipient__event=event,
+            recipient__group__in=added_groups,
+            sent_at__isnull=False,
+            expired_at__isnull=True,
+        ):
+            message.send(recipients=persons, resend=False)
+
+    @classmethod
+    def get_mass_state_change_progress(cls, event):
+        """
+        Returns (num_done, num_total) for the mass state changes of the event during the last day.
+        """
+        total_key, done_key = get_mass_state_change_progress_cache_keys(event.id)
+        progress = cache.get_many([total_key, done_key])
+
+        return progress.get(done_key, 0), progress.get(total_key, 0)
 
     def apply_state(self):
         self.apply_state_sync()
@@ -453,40 +671,109 @@ class Signup(models.Model, CsvExportMixin):
         self.apply_state_send_messages()
 
     def apply_state_group_membership(self):
+        self.reconcile_group_membership(self.event, Signup.objects.filter(pk=self.pk))
+
+    @classmethod
+    def reconcile_group_membership(cls, event, signups=None):
+        """
+        Makes the users of the given signups (default: all signups of the event) members of exactly those
+        labour groups of the event that they should belong to by their state, accepted job categories and
+        personnel classes.
+
+        The desired and the current membership are loaded in a handful of queries and only the difference
+        is applied using bulk inserts and deletes on the User.groups through table. Note that this means
+        no m2m_changed signals are sent for these changes.
+
+        Returns a pair (num_added, num_removed) of memberships.
+        """
+        from django.contrib.auth.models import Group, User
         from .job_category import JobCategory
         from .personnel_class import PersonnelClass
 
-        groups_to_add = set()
-        groups_to_remove = set()
+        if signups is None:
+            signups = cls.objects.filter(event=event)
 
-        for group_suffix in SIGNUP_STATE_GROUPS:
-            should_belong_to_group = getattr(self, 'is_{group_suffix}'.format(group_suffix=group_suffix))
-            group = self.event.labour_event_meta.get_group(group_suffix)
+        signups = list(signups.filter(person__user__isnull=False).select_related('person'))
+        if not signups:
+            return 0, 0
 
-            if should_belong_to_group:
-                groups_to_add.add(group)
-            else:
-                groups_to_remove.add(group)
+        meta = event.labour_event_meta
+        signup_ids = [signup.id for signup in signups]
 
-        for job_category in JobCategory.objects.filter(event=self.event):
-            should_belong_to_group = self.job_categories_accepted.filter(pk=job_category.pk).exists()
-            group = self.event.labour_event_meta.get_group(job_category.slug)
+        job_category_slugs = dict(JobCategory.objects.filter(event=event).values_list('id', 'slug'))
+        personnel_class_slugs = dict(
+            PersonnelClass.objects.filter(event=event, app_label='labour').values_list('id', 'slug')
+        )
 
-            if should_belong_to_group:
-                groups_to_add.add(group)
-            else:
-                groups_to_remove.add(group)
+        suffixes = set(SIGNUP_STATE_GROUPS)
+        suffixes.update(job_category_slugs.values())
+        suffixes.update(personnel_class_slugs.values())
+        group_names = dict((suffix, meta.make_group_name(event, suffix)) for suffix in suffixes)
+        groups_by_name = dict((group.name, group) for group in Group.objects.filter(name__in=group_names.values()))
+        group_ids = dict(
+            (suffix, groups_by_name[group_name].id)
+            for (suffix, group_name) in group_names.items()
+            if group_name in groups_by_name
+        )
 
-        for personnel_class in PersonnelClass.objects.filter(event=self.event, app_label='labour'):
-            should_belong_to_group = self.personnel_classes.filter(pk=personnel_class.pk).exists()
-            group = self.event.labour_event_meta.get_group(personnel_class.slug)
+        user_ids_by_signup_id = dict((signup.id, signup.person.user_id) for signup in signups)
+        desired = set()
 
-            if should_belong_to_group:
-                groups_to_add.add(group)
-            else:
-                groups_to_remove.add(group)
+        for signup in signups:
+            for group_suffix in SIGNUP_STATE_GROUPS:
+                if getattr(signup, 'is_{group_suffix}'.format(group_suffix=group_suffix)) and group_suffix in group_ids:
+                    desired.add((signup.person.user_id, group_ids[group_suffix]))
+
+        for signup_id, job_category_id in cls.job_categories_accepted.through.objects.filter(
+            signup_id__in=signup_ids,
+            jobcategory_id__in=job_category_slugs.keys(),
+        ).values_list('signup_id', 'jobcategory_id'):
+            group_id = group_ids.get(job_category_slugs[job_category_id])
+            if group_id is not None:
+                desired.add((user_ids_by_signup_id[signup_id], group_id))
+
+        for signup_id, personnel_class_id in cls.personnel_classes.through.objects.filter(
+            signup_id__in=signup_ids,
+            personnelclass_id__in=personnel_class_slugs.keys(),
+        ).values_list('signup_id', 'personnelclass_id'):
+            group_id = group_ids.get(personnel_class_slugs[personnel_class_id])
+            if group_id is not None:
+                desired.add((user_ids_by_signup_id[signup_id], group_id))
+
+        UserGroup = User.groups.through
+        current = set(UserGroup.objects.filter(
+            user_id__in=user_ids_by_signup_id.values(),
+            group_id__in=group_ids.values(),
+        ).values_list('user_id', 'group_id'))
+
+        to_add = desired - current
+        to_remove = current - desired
+
+        if to_add:
+            UserGroup.objects.bulk_create([
+                UserGroup(user_id=user_id, group_id=group_id)
+                for (user_id, group_id) in to_add
+            ])
+
+        user_ids_to_remove_by_group_id = defaultdict(list)
+        for user_id, group_id in to_remove:
+            user_ids_to_remove_by_group_id[group_id].append(user_id)
+
+        for group_id, user_ids in user_ids_to_remove_by_group_id.items():
+            UserGroup.objects.filter(group_id=group_id, user_id__in=user_ids).delete()
+
+        if 'crowd_integration' in settings.INSTALLED_APPS and (to_add or to_remove):
+            from crowd_integration.models import CrowdChange
+
+            users_by_id = User.objects.in_bulk(set(user_id for (user_id, group_id) in to_add | to_remove))
+            groups_by_id = dict((group.id, group) for group in groups_by_name.values())
+
+            CrowdChange.record_memberships(
+                [(users_by_id[user_id], groups_by_id[group_id].name, True) for (user_id, group_id) in to_add] +
+                [(users_by_id[user_id], groups_by_id[group_id].name, False) for (user_id, group_id) in to_remove]
+            )
 
-        ensure_user_group_membership(self.person.user, groups_to_add, groups_to_remove)
+        return len(to_add), len(to_remove)
 
     def apply_state_email_aliases(self):
         if 'access' not in settings.INSTALLED_APPS:
@@ -10,6 +10,12 @@ def signup_apply_state(signup_pk):
     signup._apply_state()
 
 
+@shared_task(ignore_result=True)
+def signup_mass_apply_state(event_id, signup_ids, old_state, new_state):
+    from .models import Signup
+    Signup._mass_apply_state(event_id, signup_ids, old_state, new_state)
+
+
 @shared_task(ignore_result=True)
 def labour_event_meta_create_groups(meta_pk):
     from .models import LabourEventMeta
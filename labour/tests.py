@@ -1,3 +1,4 @@
+from django.contrib.auth.models import Group
 from django.test import TestCase
 
 from core.models import Person
@@ -16,6 +17,26 @@ class LabourEventAdminTest(TestCase):
 
         assert labour_event_meta.is_user_admin(person.user)
 
+    def test_event_adminship_request_user(self):
+        from django.test import RequestFactory
+        from core.middleware import GroupIdsCacheMiddleware
+
+        person, unused = Person.get_or_create_dummy(superuser=False)
+        labour_event_meta, unused = LabourEventMeta.get_or_create_dummy()
+        labour_event_meta.admin_group.user_set.add(person.user)
+
+        request = RequestFactory().get('/')
+        request.user = person.user
+        GroupIdsCacheMiddleware().process_request(request)
+
+        assert labour_event_meta.is_user_admin(request.user)
+
+        with self.assertNumQueries(0):
+            assert labour_event_meta.is_user_admin(request.user)
+
+        request.user.groups.remove(labour_event_meta.admin_group)
+        assert not labour_event_meta.is_user_admin(request.user)
+
     def test_event_adminship_superuser(self):
         person, unused = Person.get_or_create_dummy(superuser=True)
         labour_event_meta, unused = LabourEventMeta.get_or_create_dummy()
@@ -23,6 +44,24 @@ class LabourEventAdminTest(TestCase):
         assert labour_event_meta.is_user_admin(person.user)
 
 
+class GroupCacheTestCase(TestCase):
+    def test_get_group(self):
+        meta, unused = LabourEventMeta.get_or_create_dummy()
+        group = meta.get_group('accepted')
+
+        with self.assertNumQueries(0):
+            cached_group = meta.get_group('accepted')
+
+        assert cached_group == group
+        assert cached_group.name == group.name
+
+        group.name = 'renamed-accepted'
+        group.save()
+
+        with self.assertRaises(Group.DoesNotExist):
+            meta.get_group('accepted')
+
+
 class QualificationTest(TestCase):
     def test_qualifications(self):
         person, unused = Person.get_or_create_dummy()
@@ -53,6 +92,71 @@ class SignupTest(TestCase):
         self.assertFalse(params['time_accepted__isnull'])
         self.assertTrue(params['time_finished__isnull'])
 
+    def test_get_state_transition_updates(self):
+        updates = Signup.get_state_transition_updates('new', 'rejected')
+        assert set(updates.keys()) == {'is_active', 'time_rejected'}
+        assert updates['is_active'] is False
+        assert updates['time_rejected'] is not None
+
+        updates = Signup.get_state_transition_updates('accepted', 'confirmation')
+        assert list(updates.keys()) == ['time_confirmation_requested']
+
+    def test_reconcile_group_membership(self):
+        signup, unused = Signup.get_or_create_dummy(accepted=True)
+        event = signup.event
+        meta = event.labour_event_meta
+        user = signup.person.user
+        job_category = signup.job_categories_accepted.get()
+
+        expected_groups = {
+            meta.get_group('applicants'),
+            meta.get_group('processed'),
+            meta.get_group('accepted'),
+            meta.get_group(job_category.slug),
+        }
+        assert expected_groups <= set(user.groups.all())
+        assert Signup.reconcile_group_membership(event) == (0, 0)
+
+        user.groups.remove(meta.get_group('accepted'))
+        user.groups.add(meta.get_group('rejected'))
+        assert Signup.reconcile_group_membership(event) == (1, 1)
+        assert meta.get_group('accepted') in user.groups.all()
+        assert meta.get_group('rejected') not in user.groups.all()
+
+    def test_mass_reject(self):
+        signup, unused = Signup.get_or_create_dummy()
+        meta = signup.event.labour_event_meta
+
+        signup.apply_state_group_membership()
+        user = signup.person.user
+        assert user.groups.filter(pk=meta.get_group('new').pk).exists()
+
+        signup_ids = Signup.mass_reject(Signup.objects.filter(event=signup.event))
+        assert signup_ids == [signup.pk]
+
+        signup = Signup.objects.get(pk=signup.pk)
+        assert signup.state == 'rejected'
+        assert not user.groups.filter(pk=meta.get_group('new').pk).exists()
+        assert user.groups.filter(pk=meta.get_group('rejected').pk).exists()
+        assert not signup.signup_extra.is_active
+
+        num_done, num_total = Signup.get_mass_state_change_progress(signup.event)
+        assert num_done == num_total
+
+        # nothing left to reject
+        assert Signup.mass_reject(Signup.objects.filter(event=signup.event)) == []
+
+    def test_mass_apply_state_failure(self):
+        from unittest.mock import patch
+
+        signup, unused = Signup.get_or_create_dummy()
+
+        with patch.object(Signup, '_mass_apply_state_chunk', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                Signup.mass_apply_state(signup.event.id, [signup.pk], 'new', 'rejected')
+
+        assert Signup.get_mass_state_change_progress(signup.event) == (0, 0)
+
 
 class JobCategoryTestCase(TestCase):
     def test_group(self):
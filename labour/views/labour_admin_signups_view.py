@@ -4,13 +4,14 @@
 
 from collections import OrderedDict, namedtuple
 
+from django.contrib import messages
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 
 from core.sort_and_filter import Sorter, Filter
-from core.csv_export import CSV_EXPORT_FORMATS, EXPORT_FORMATS, csv_response
+from core.csv_export import CSV_EXPORT_FORMATS, EXPORT_FORMATS, export_job_response
 
 from ..helpers import labour_admin_required
 from ..filters import SignupStateFilter
@@ -76,17 +77,28 @@ def labour_admin_signups_view(request, vars, event, format='screen'):
     if request.method == 'POST':
         action = request.POST.get('action', None)
         if action == 'reject':
-            SignupClass.mass_reject(signups)
+            signup_ids = SignupClass.mass_reject(signups)
         elif action == 'request_confirmation':
-            SignupClass.mass_request_confirmation(signups)
+            signup_ids = SignupClass.mass_request_confirmation(signups)
         elif action == 'send_shifts':
-            SignupClass.mass_send_shifts(signups)
+            signup_ids = SignupClass.mass_send_shifts(signups)
         else:
+            signup_ids = None
             messages.error(request, 'Ei semmosta toimintoa oo.')
 
+        if signup_ids is not None:
+            messages.success(request, 'Massatoiminto kohdistui {num} hakemukseen.'.format(num=len(signup_ids)))
+
         return redirect('labour_admin_signups_view', event.slug)
 
     elif format in HTML_TEMPLATES:
+        num_mass_state_change_done, num_mass_state_change_total = SignupClass.get_mass_state_change_progress(event)
+        if num_mass_state_change_done < num_mass_state_change_total:
+            messages.info(request, 'Massatoiminnon jälkikäsittely on kesken ({done}/{total} hakemusta).'.format(
+                done=num_mass_state_change_done,
+                total=num_mass_state_change_total,
+            ))
+
         num_would_mass_reject = signups.filter(**SignupClass.get_state_query_params('new')).count()
         num_would_mass_request_confirmation = signups.filter(**SignupClass.get_state_query_params('accepted')).count()
         num_would_send_shifts = SignupClass.filter_signups_for_mass_send_shifts(signups).count()
@@ -144,7 +156,7 @@ def labour_admin_signups_view(request, vars, event, format='screen'):
             format=format,
         )
 
-        return csv_response(event, SignupClass, signups,
+        return export_job_response(request, event, SignupClass, signups,
             dialect=CSV_EXPORT_FORMATS[format],
             filename=filename,
             m2m_mode='separate_columns',
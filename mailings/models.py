@@ -2,16 +2,15 @@
 
 
 
+from collections import OrderedDict
 from hashlib import sha1
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from django.utils import timezone
 from django.dispatch import receiver
 from django.db.models.signals import pre_save, post_save
 
-from math import ceil
-
 from django.conf import settings
 from django.db import models
 from django.template import Template, Context
@@ -26,8 +25,6 @@ APP_LABEL_CHOICES = [
     ('labour', 'Työvoima')
 ]
 
-DELAY_PER_MESSAGE_FRAGMENT_MILLIS = 350
-
 
 class RecipientGroup(models.Model):
     event = models.ForeignKey('core.Event', verbose_name='Tapahtuma')
@@ -136,33 +133,59 @@ class Message(models.Model):
             self._send(recipients, resend)
 
     def _send(self, recipients, resend):
-        from django.contrib.auth.models import User
+        from core.models import Person
 
         if recipients is None:
-            recipients = [user.person for user in self.recipient.group.user_set.all()]
-
-        # TODO this delay stuff should not be here (only applies to SMS messages)
-        delay = 0
-        for person in recipients:
-            try:
-                person_message, created = PersonMessage.objects.get_or_create(
-                    person=person,
-                    message=self,
-                )
-            except PersonMessage.MultipleObjectsReturned:
+            recipients = Person.objects.filter(user__groups=self.recipient.group)
+
+        persons_by_id = OrderedDict((person.id, person) for person in recipients)
+
+        existing_person_messages = dict()
+        for person_message in PersonMessage.objects.filter(
+            message=self,
+            person_id__in=persons_by_id.keys(),
+        ).select_related('subject', 'body').order_by('id'):
+            if person_message.person_id in existing_person_messages:
                 # This actually happens sometimes.
                 logger.warning('A Person doth multiple PersonMessages for a single Message have!')
-                person_message = PersonMessage.objects.filter(
-                    person=person,
-                    message=self
-                ).first()
-                created = False
-
-            if created or resend:
-                person_message.actually_send(delay)
-                bodylen = len(person_message.body.text)
-                delayfactor = ceil(bodylen / 153)
-                delay += DELAY_PER_MESSAGE_FRAGMENT_MILLIS * delayfactor
+                continue
+
+            person_message.message = self
+            person_message.person = persons_by_id[person_message.person_id]
+            existing_person_messages[person_message.person_id] = person_message
+
+        person_messages = PersonMessage.bulk_create_for_message(self, [
+            person
+            for (person_id, person) in persons_by_id.items()
+            if person_id not in existing_person_messages
+        ])
+
+        if resend:
+            person_messages.extend(existing_person_messages.values())
+
+        for person_message in person_messages:
+            person_message.actually_send(flush=False)
+
+        if person_messages:
+            if self.channel == 'email':
+                from core.models import OutboxEmail
+                OutboxEmail.drain_async()
+            elif self.channel == 'sms':
+                from sms.models import SMSMessageOut
+                SMSMessageOut.dispatch_async()
+
+    def get_compiled_templates(self):
+        """
+        Returns the subject and body templates as a pair of compiled Templates. They are compiled only once
+        per instance unless the template source changes.
+        """
+        sources = (self.subject_template, self.body_template)
+        cached = getattr(self, '_compiled_templates', None)
+
+        if cached is None or cached[0] != sources:
+            cached = self._compiled_templates = (sources, tuple(Template(source) for source in sources))
+
+        return cached[1]
 
     def expire(self):
         assert self.expired_at is None, 're-expiring an expired message does not make sense'
@@ -227,6 +250,28 @@ class DedupMixin(object):
             logger.warn('Multiple %s returned for hash %s', cls.__name__, the_hash)
             return cls.objects.filter(digest=the_hash, text=text).first(), False
 
+    @classmethod
+    def get_or_create_many(cls, texts):
+        """
+        Bulk version of get_or_create. Returns a dict mapping each of the texts to its instance.
+        """
+        digests = dict((text, sha1(text.encode('UTF-8')).hexdigest()) for text in set(texts))
+
+        def get_existing():
+            instances = dict()
+            for instance in cls.objects.filter(digest__in=set(digests.values())).order_by('id'):
+                instances.setdefault(instance.text, instance)
+            return instances
+
+        instances = get_existing()
+        missing_texts = [text for text in digests.keys() if text not in instances]
+
+        if missing_texts:
+            cls.objects.bulk_create([cls(digest=digests[text], text=text) for text in missing_texts])
+            instances = get_existing()
+
+        return instances
+
 
 class PersonMessageSubject(models.Model, DedupMixin):
     digest = models.CharField(max_length=63, db_index=True)
@@ -249,11 +294,69 @@ class PersonMessage(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     def save(self, *args, **kwargs):
-        self.subject, unused = PersonMessageSubject.get_or_create(self.render_message(self.message.subject_template))
-        self.body, unused = PersonMessageBody.get_or_create(self.render_message(self.message.body_template))
+        subject_template, body_template = self.message.get_compiled_templates()
+
+        self.subject, unused = PersonMessageSubject.get_or_create(self.render_message(subject_template))
+        self.body, unused = PersonMessageBody.get_or_create(self.render_message(body_template))
 
         return super(PersonMessage, self).save(*args, **kwargs)
 
+    @classmethod
+    def bulk_create_for_message(cls, message, persons, batch_size=500):
+        """
+        Renders and creates the PersonMessages of the message for the given persons. The templates are
+        compiled once, the signups of all persons are fetched at once, and the subjects, bodies and
+        PersonMessages are inserted in bulk. PersonMessage.save is not called.
+
+        Returns the new PersonMessages in the order of persons.
+        """
+        subject_template, body_template = message.get_compiled_templates()
+        event = message.event
+        persons = list(persons)
+
+        if not persons:
+            return []
+
+        signups_by_person_id = None
+        if 'labour' in settings.INSTALLED_APPS:
+            from labour.models import Signup
+
+            signups_by_person_id = dict()
+            for signup in Signup.objects.filter(
+                event=event,
+                person_id__in=[person.id for person in persons],
+            ).prefetch_related('job_categories_accepted', 'shifts'):
+                signups_by_person_id[signup.person_id] = signup
+
+        person_messages = []
+        for person in persons:
+            person_message = cls(message=message, person=person)
+            person_message._message_vars = dict(event=event, person=person)
+
+            if signups_by_person_id is not None:
+                signup = signups_by_person_id.get(person.id)
+                if signup is not None:
+                    signup.person = person
+                person_message._message_vars.update(signup=signup)
+
+            person_messages.append((
+                person_message,
+                person_message.render_message(subject_template),
+                person_message.render_message(body_template),
+            ))
+
+        subjects = PersonMessageSubject.get_or_create_many(subject for (pm, subject, body) in person_messages)
+        bodies = PersonMessageBody.get_or_create_many(body for (pm, subject, body) in person_messages)
+
+        for person_message, subject, body in person_messages:
+            person_message.subject = subjects[subject]
+            person_message.body = bodies[body]
+
+        person_messages = [person_message for (person_message, subject, body) in person_messages]
+        cls.objects.bulk_create(person_messages, batch_size=batch_size)
+
+        return person_messages
+
     @property
     def message_vars(self):
         if not hasattr(self, '_message_vars'):
@@ -276,18 +379,25 @@ class PersonMessage(models.Model):
         return self._message_vars
 
     def render_message(self, template):
-        return Template(template).render(Context(self.message_vars))
+        if not isinstance(template, Template):
+            template = Template(template)
+
+        return template.render(Context(self.message_vars))
 
-    def actually_send(self, delay=0):
+    def actually_send(self, flush=True):
+        """
+        Puts the message in the e-mail outbox or the SMS queue. If flush is False, it is up to the caller
+        to start sending the outbox or queue afterwards.
+        """
         if self.message.channel == 'email':
-            self._actually_send_email()
+            self._actually_send_email(drain=flush)
         elif self.message.channel == 'sms':
-            self._actually_send_sms(delay)
+            self._actually_send_sms(dispatch=flush)
         else:
             raise NotImplementedError(self.message.channel)
 
-    def _actually_send_email(self):
-        from django.core.mail import EmailMessage
+    def _actually_send_email(self, drain=True):
+        from core.models import OutboxEmail
 
         msgbcc = []
         meta = self.message.app_event_meta
@@ -298,26 +408,20 @@ class PersonMessage(models.Model):
         if settings.DEBUG:
             print(self.body.text)
 
-        EmailMessage(
+        OutboxEmail.enqueue(
             subject=self.subject.text,
             body=self.body.text,
             from_email=meta.cloaked_contact_email,
             to=(self.person.name_and_email,),
-            bcc=msgbcc
-        ).send(fail_silently=True)
+            bcc=msgbcc,
+            drain=drain,
+        )
 
-    def _actually_send_sms(self, delay=0):
+    def _actually_send_sms(self, dispatch=True):
         from sms.models import SMSMessageOut, SMSEventMeta
         try:
             event = SMSEventMeta.objects.get(event=self.message.event, sms_enabled=True)
         except SMSEventMeta.DoesNotExist:
             pass
         else:
-            if 'background_tasks' in settings.INSTALLED_APPS:
-                from sms.tasks import message_send
-                sendtime = timezone.now() + timedelta(milliseconds=delay)
-                sending = SMSMessageOut(message=self.body.text, to=self.person.phone, event=event)
-                sending.save()
-                message_send.apply_async(args=[sending.pk], eta=sendtime)
-            else:
-                SMSMessageOut.send(message=self.body.text, to=self.person.phone, event=event)
+            SMSMessageOut.send(message=self.body.text, to=self.person.phone, event=event, dispatch=dispatch)
@@ -0,0 +1,78 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from core.models import OutboxEmail, Person
+from labour.models import LabourEventMeta
+
+from .models import Message, PersonMessage, PersonMessageBody, PersonMessageSubject, RecipientGroup
+
+
+class DedupTestCase(TestCase):
+    def test_get_or_create_many(self):
+        existing, unused = PersonMessageSubject.get_or_create('Hello')
+
+        subjects = PersonMessageSubject.get_or_create_many(['Hello', 'World', 'World'])
+
+        assert set(subjects.keys()) == {'Hello', 'World'}
+        assert subjects['Hello'] == existing
+        assert subjects['World'].text == 'World'
+        assert PersonMessageSubject.objects.count() == 2
+
+        assert PersonMessageSubject.get_or_create_many(['World']) == dict(World=subjects['World'])
+        assert PersonMessageSubject.objects.count() == 2
+
+
+class MessageSendTestCase(TestCase):
+    def setUp(self):
+        meta, unused = LabourEventMeta.get_or_create_dummy()
+        self.group = meta.admin_group
+
+        self.person1, unused = Person.get_or_create_dummy(superuser=False)
+        self.person2 = Person.objects.create(
+            user=get_user_model().objects.create(username='mailings-test'),
+            first_name='Mikko',
+            surname='Mallikas',
+            email='mikko@example.com',
+        )
+
+        self.message = Message.objects.create(
+            recipient=RecipientGroup.objects.create(event=meta.event, app_label='labour', group=self.group),
+            subject_template='Hello',
+            body_template='Hello {{ person.first_name }}',
+        )
+
+    def get_num_sent(self, person):
+        return OutboxEmail.objects.filter(to=[person.name_and_email]).count()
+
+    def test_send(self):
+        self.group.user_set.add(self.person1.user)
+        self.message.send()
+
+        assert self.get_num_sent(self.person1) == 1
+        assert PersonMessage.objects.filter(message=self.message).count() == 1
+
+        # Only those not yet sent to get the message
+        self.group.user_set.add(self.person2.user)
+        self.message.send()
+
+        assert self.get_num_sent(self.person1) == 1
+        assert self.get_num_sent(self.person2) == 1
+        assert PersonMessage.objects.filter(message=self.message).count() == 2
+
+        # The subject is shared, the bodies differ
+        assert PersonMessageSubject.objects.filter(text='Hello').count() == 1
+        assert PersonMessageBody.objects.filter(text__startswith='Hello ').count() == 2
+
+        person_message = PersonMessage.objects.get(message=self.message, person=self.person2)
+        assert person_message.body.text == 'Hello Mikko'
+
+    def test_resend(self):
+        self.group.user_set.add(self.person1.user)
+        self.message.send()
+
+        self.group.user_set.add(self.person2.user)
+        self.message.send(resend=True)
+
+        assert self.get_num_sent(self.person1) == 2
+        assert self.get_num_sent(self.person2) == 1
+        assert PersonMessage.objects.filter(message=self.message).count() == 2
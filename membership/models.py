@@ -35,9 +35,7 @@ class MembershipOrganizationMeta(models.Model, GroupManagementMixin):
         verbose_name = 'Jäsenrekisterien asetukset'
 
     def get_group(self, suffix):
-        group_name = self.make_group_name(self.organization, suffix)
-
-        return Group.objects.get(name=group_name)
+        return self.get_cached_group(self.organization, suffix)
 
     def get_current_term(self, d=None):
         if d is None:
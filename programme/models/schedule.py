@@ -3,20 +3,56 @@
 
 
 import logging
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 from datetime import timedelta
+from uuid import uuid4
 
 from django.contrib import messages
+from django.core.cache import cache
 from django.db import models
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
 from dateutil.tz import tzlocal
 
 from core.utils import format_datetime
 
+from .category import Category
+from .programme import Programme
+from .room import Room
+from .tag import Tag
+
 
 logger = logging.getLogger('kompassi')
 
 ONE_HOUR = timedelta(hours=1)
+TIMETABLE_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_timetable_generation_cache_key(event_id):
+    return 'programme:timetable:generation:{event_id}'.format(event_id=event_id)
+
+
+def get_timetable_generation(event_id):
+    """
+    Cached timetables are keyed by a per-event generation. Replacing the generation makes all
+    timetables of the event stale at once without having to know which cache keys exist. Generations
+    are random so that one lost to cache eviction is never reused.
+    """
+    key = get_timetable_generation_cache_key(event_id)
+    generation = cache.get(key)
+
+    if generation is None:
+        cache.add(key, uuid4().hex, None)
+        generation = cache.get(key)
+
+    return generation
+
+
+def invalidate_timetable_cache(event_id):
+    cache.set(get_timetable_generation_cache_key(event_id), uuid4().hex, None)
 
 
 class ViewMethodsMixin(object):
@@ -25,57 +61,124 @@ class ViewMethodsMixin(object):
         return self.get_programmes_by_start_time()
 
     def get_programmes_by_start_time(self, include_unpublished=False, request=None):
+        results, overlaps = self.get_cached_timetable(include_unpublished=include_unpublished)
+
+        for room, start_time in overlaps:
+            logger.warn('Room %s has multiple programs starting at %s', room, start_time)
+
+        if (
+            overlaps and
+            request is not None and
+            self.event.programme_event_meta.is_user_admin(request.user)
+        ):
+            for room, start_time in overlaps:
+                messages.warning(request,
+                    'Tilassa {room} on päällekkäisiä ohjelmanumeroita kello {start_time}'.format(
+                        room=room,
+                        start_time=format_datetime(start_time.astimezone(tzlocal())),
+                    )
+                )
+
+        return results
+
+    def get_timetable_cache_key(self, include_unpublished=False):
+        return 'programme:timetable:{event_id}:{generation}:{view_id}:{published}'.format(
+            event_id=self.event.pk,
+            generation=get_timetable_generation(self.event.pk),
+            view_id=self.timetable_cache_id,
+            published='all' if include_unpublished else 'published',
+        )
+
+    def get_cached_timetable(self, include_unpublished=False):
+        """
+        Returns the output of build_timetable from the cache, computing it on a miss. The cache is
+        invalidated when anything that affects the timetable of the event is saved or deleted.
+        """
+        cache_key = self.get_timetable_cache_key(include_unpublished=include_unpublished)
+        timetable = cache.get(cache_key)
+
+        if timetable is None:
+            timetable = self.build_timetable(include_unpublished=include_unpublished)
+            cache.set(cache_key, timetable, TIMETABLE_CACHE_TIMEOUT)
+
+        return timetable
+
+    def build_timetable(self, include_unpublished=False):
+        """
+        Computes the timetable grid of this view in memory.
+
+        Rooms, programmes, time blocks and special start times are loaded in a constant number of
+        queries regardless of the number of rooms and start times. Returns a tuple of (rows, overlaps)
+        in which rows is a list of (start_time, incontinuity_css, cells) and each cell is either
+        (programme, rowspan) or (None, None) for a blank. Rooms in which a programme continues from an
+        earlier start time get no cell (it is covered by the rowspan). Overlaps is a list of
+        (room, start_time) pairs that have more than one programme starting at the same time.
+        """
+        start_times = self.start_times()
+        rooms = list(self.rooms.all())
+
+        criteria = dict(
+            category__event=self.event,
+            room__in=rooms,
+            start_time__isnull=False,
+            length__isnull=False,
+        )
+
+        if not include_unpublished:
+            criteria.update(state='published')
+
+        programmes = (
+            Programme.objects.filter(**criteria)
+                .select_related('category', 'room')
+                .prefetch_related('tags')
+                .order_by('start_time', 'room', 'id')
+        )
+
+        programmes_by_room = defaultdict(list)
+        for programme in programmes:
+            programmes_by_room[programme.room_id].append(programme)
+
+        room_start_times = dict(
+            (room_id, [programme.start_time for programme in room_programmes])
+            for (room_id, room_programmes) in programmes_by_room.items()
+        )
+
         results = []
+        overlaps = []
         prev_start_time = None
-        cont_criteria = dict() if include_unpublished else dict(state='published')
 
-        for start_time in self.start_times():
+        for start_time in start_times:
             cur_row = []
-            criteria = dict(
-                category__event=self.event,
-                start_time=start_time,
-                length__isnull=False,
-            )
-
-            if not include_unpublished:
-                criteria.update(state='published')
 
             incontinuity = prev_start_time and (start_time - prev_start_time > ONE_HOUR)
             incontinuity = 'incontinuity' if incontinuity else ''
             prev_start_time = start_time
 
             results.append((start_time, incontinuity, cur_row))
-            for room in self.rooms.all():
-                programmes = room.programme_set.filter(**criteria)
-                num_programmes = programmes.count()
-                if num_programmes == 0:
-                    if room.programme_continues_at(start_time, **cont_criteria):
+            for room in rooms:
+                room_programmes = programmes_by_room.get(room.pk, [])
+                starts = room_start_times.get(room.pk, [])
+
+                first = bisect_left(starts, start_time)
+                last = bisect_right(starts, start_time)
+
+                if first == last:
+                    # the latest programme started before start_time in this room, if any
+                    if first > 0 and start_time < room_programmes[first - 1].end_time:
                         # programme still continues, handled by rowspan
                         pass
                     else:
                         # there is no (visible) programme in the room at start_time, insert a blank
                         cur_row.append((None, None))
                 else:
-                    if programmes.count() > 1:
-                        logger.warn('Room %s has multiple programs starting at %s', room, start_time)
-
-                        if (
-                            request is not None and
-                            self.event.programme_event_meta.is_user_admin(request.user)
-                        ):
-                            messages.warning(request,
-                                'Tilassa {room} on päällekkäisiä ohjelmanumeroita kello {start_time}'.format(
-                                    room=room,
-                                    start_time=format_datetime(start_time.astimezone(tzlocal())),
-                                )
-                            )
-
-                    programme = programmes.first()
-
-                    rowspan = self.rowspan(programme)
+                    if last - first > 1:
+                        overlaps.append((room, start_time))
+
+                    programme = room_programmes[first]
+                    rowspan = bisect_left(start_times, programme.end_time) - bisect_left(start_times, start_time)
                     cur_row.append((programme, rowspan))
 
-        return results
+        return results, overlaps
 
     def start_times(self, programme=None):
         result = [t.start_time for t in SpecialStartTime.objects.filter(event=self.event)]
@@ -108,6 +211,10 @@ class View(models.Model, ViewMethodsMixin):
     def __str__(self):
         return self.name
 
+    @property
+    def timetable_cache_id(self):
+        return self.pk
+
     class Meta:
         verbose_name = _('schedule view')
         verbose_name_plural = _('schedule views')
@@ -116,14 +223,14 @@ class View(models.Model, ViewMethodsMixin):
 
 class AllRoomsPseudoView(ViewMethodsMixin):
     def __init__(self, event):
-        from .room import Room
-
         self.name = _('All rooms')
         self.public = True
         self.order = 0
         self.rooms = Room.objects.filter(venue=event.venue, view__event=event)
         self.event = event
 
+    timetable_cache_id = 'all'
+
 
 class TimeBlock(models.Model):
     event = models.ForeignKey('core.event')
@@ -146,3 +253,50 @@ class SpecialStartTime(models.Model):
         unique_together = [
             ('event', 'start_time'),
         ]
+
+
+@receiver(post_save, sender=View)
+@receiver(post_delete, sender=View)
+@receiver(post_save, sender=TimeBlock)
+@receiver(post_delete, sender=TimeBlock)
+@receiver(post_save, sender=SpecialStartTime)
+@receiver(post_delete, sender=SpecialStartTime)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_timetable_cache_on_event_model_change(sender, instance, **kwargs):
+    invalidate_timetable_cache(instance.event_id)
+
+
+@receiver(post_save, sender=Programme)
+@receiver(post_delete, sender=Programme)
+def invalidate_timetable_cache_on_programme_change(sender, instance, **kwargs):
+    if instance.category_id:
+        invalidate_timetable_cache(instance.category.event_id)
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidate_timetable_cache_on_room_change(sender, instance, **kwargs):
+    from core.models import Event
+
+    for event_id in Event.objects.filter(venue_id=instance.venue_id).values_list('id', flat=True):
+        invalidate_timetable_cache(event_id)
+
+
+@receiver(m2m_changed, sender=View.rooms.through)
+def invalidate_timetable_cache_on_view_rooms_change(sender, instance, **kwargs):
+    if isinstance(instance, View):
+        invalidate_timetable_cache(instance.event_id)
+    else:
+        for event_id in View.objects.filter(rooms=instance).values_list('event_id', flat=True).distinct():
+            invalidate_timetable_cache(event_id)
+
+
+@receiver(m2m_changed, sender=Programme.tags.through)
+def invalidate_timetable_cache_on_programme_tags_change(sender, instance, **kwargs):
+    if isinstance(instance, Programme):
+        invalidate_timetable_cache(instance.category.event_id)
+    else:
+        invalidate_timetable_cache(instance.event_id)
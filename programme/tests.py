@@ -9,7 +9,17 @@ from access.models import SlackAccess, GroupPrivilege, Privilege
 from labour.models import Signup
 
 from .utils import next_full_hour
-from .models import ProgrammeEventMeta, ProgrammeRole
+from .models import (
+    AllRoomsPseudoView,
+    Category,
+    Programme,
+    ProgrammeEventMeta,
+    ProgrammeRole,
+    Room,
+    Tag,
+    TimeBlock,
+    View,
+)
 
 
 class UtilsTestCase(TestCase):
@@ -120,3 +130,146 @@ class ProgrammeSlackAccessTestCase(TestCase):
         group = meta.get_group('hosts')
         assert person.user not in group.user_set.all()
         assert privilege not in Privilege.get_potential_privileges(person)
+
+
+class ScheduleTestCase(TestCase):
+    def test_build_timetable(self):
+        category, unused = Category.get_or_create_dummy()
+        event = category.event
+        room, unused = Room.get_or_create_dummy()
+        view = View.objects.create(event=event, name='Dummy view')
+        view.rooms.add(room)
+
+        t = datetime(2013, 8, 15, 10, 0, 0, tzinfo=tzlocal())
+        ONE_HOUR = timedelta(hours=1)
+        TimeBlock.objects.create(event=event, start_time=t, end_time=t + 3 * ONE_HOUR)
+
+        programme = Programme(
+            category=category,
+            room=room,
+            title='Two-hour programme',
+            state='published',
+            start_time=t + ONE_HOUR,
+            length=120,
+        )
+        programme.save()
+
+        rows, overlaps = view.build_timetable()
+        assert not overlaps
+        assert [start_time for (start_time, unused, cells) in rows] == [t + i * ONE_HOUR for i in range(4)]
+        assert rows[0][2] == [(None, None)]
+        assert rows[1][2] == [(programme, 2)]
+        assert rows[2][2] == []
+        assert rows[3][2] == [(None, None)]
+
+        assert AllRoomsPseudoView(event).get_programmes_by_start_time() == rows
+
+        programme.state = 'accepted'
+        programme.save()
+        unpublished_rows, unused = view.build_timetable(include_unpublished=True)
+        assert unpublished_rows[1][2] == [(programme, 2)]
+        published_rows, unused = view.build_timetable()
+        assert published_rows[1][2] == [(None, None)]
+        assert published_rows[2][2] == [(None, None)]
+
+    def test_timetable_cache_invalidation(self):
+        category, unused = Category.get_or_create_dummy()
+        event = category.event
+        room, unused = Room.get_or_create_dummy()
+        view = View.objects.create(event=event, name='Dummy view')
+        view.rooms.add(room)
+
+        t = datetime(2013, 8, 15, 10, 0, 0, tzinfo=tzlocal())
+        TimeBlock.objects.create(event=event, start_time=t, end_time=t + timedelta(hours=1))
+
+        rows, unused = view.get_cached_timetable()
+        assert rows[0][2] == [(None, None)]
+
+        programme = Programme(
+            category=category,
+            room=room,
+            title='Cached programme',
+            state='published',
+            start_time=t,
+            length=60,
+        )
+        programme.save()
+
+        rows, unused = view.get_cached_timetable()
+        assert rows[0][2] == [(programme, 1)]
+
+        programme.delete()
+
+        rows, unused = view.get_cached_timetable()
+        assert rows[0][2] == [(None, None)]
+
+
+class ProgrammeCsvExportTestCase(TestCase):
+    def test_separate_m2m_columns(self):
+        from io import BytesIO
+        from core.csv_export import export_csv
+
+        programme, unused = Programme.get_or_create_dummy()
+        other_programme, unused = Programme.get_or_create_dummy(title='Other dummy program')
+        event = programme.category.event
+
+        tag = Tag.objects.create(event=event, title='Dummy tag')
+        programme.tags.add(tag)
+
+        output = BytesIO()
+        programmes = Programme.objects.filter(category__event=event).order_by('id')
+        export_csv(event, Programme, programmes, output, dialect='excel-tab')
+
+        header, first, second = [
+            line.split('\t')
+            for line in output.getvalue().decode('ISO-8859-15').strip().split('\r\n')
+        ]
+        tag_column = header.index('tags: Dummy tag')
+
+        assert first[tag_column] == 'True'
+        assert second[tag_column] == 'False'
+
+    def test_stream_csv(self):
+        from io import BytesIO
+        from core.csv_export import export_csv, stream_csv
+
+        programme, unused = Programme.get_or_create_dummy()
+        event = programme.category.event
+        programmes = Programme.objects.filter(category__event=event).order_by('id')
+
+        output = BytesIO()
+        export_csv(event, Programme, programmes, output, dialect='excel')
+
+        assert b''.join(stream_csv(event, Programme, programmes, dialect='excel')) == output.getvalue()
+
+    def test_m2m_choices_are_not_stale(self):
+        from core.csv_export import get_m2m_choices
+        from core.models import Event
+
+        programme, unused = Programme.get_or_create_dummy()
+        event = programme.category.event
+        field = Programme._meta.get_field('tags')
+
+        assert get_m2m_choices(event, field) == []
+
+        tag = Tag.objects.create(event=event, title='Dummy tag')
+
+        assert get_m2m_choices(Event.objects.get(pk=event.pk), field) == [tag]
+
+    def test_export_job(self):
+        from core.models import ExportJob
+
+        programme, unused = Programme.get_or_create_dummy()
+        event = programme.category.event
+        programmes = Programme.objects.filter(category__event=event).order_by('id')
+
+        export_job = ExportJob.create(event, Programme, programmes, filename='programmes.xlsx', dialect='xlsx')
+        export_job._run()
+
+        export_job = ExportJob.objects.get(pk=export_job.pk)
+        assert export_job.is_finished, export_job.error_message
+        assert export_job.num_rows_done == export_job.num_rows_total == programmes.count()
+        assert bytes(export_job.content)[:2] == b'PK'
+
+        assert ExportJob.clean_up(retention_hours=-1) == 1
+        assert not ExportJob.objects.filter(pk=export_job.pk).exists()
@@ -9,7 +9,7 @@ from django.shortcuts import render
 from django.utils import timezone
 from django.views.decorators.http import require_safe
 
-from core.csv_export import csv_response, CSV_EXPORT_FORMATS, EXPORT_FORMATS, ExportFormat
+from core.csv_export import export_job_response, CSV_EXPORT_FORMATS, EXPORT_FORMATS, ExportFormat
 from core.models import Person
 from core.sort_and_filter import Filter, Sorter
 
@@ -99,7 +99,7 @@ def programme_admin_view(request, vars, event, format='screen'):
             timestamp=timezone.now().strftime('%Y%m%d%H%M%S'),
         )
 
-        return csv_response(event, Programme, programmes,
+        return export_job_response(request, event, Programme, programmes,
             m2m_mode='comma_separated',
             dialect='xlsx',
             filename=filename,
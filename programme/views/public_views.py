@@ -5,7 +5,7 @@ from django.http import HttpResponse
 from django.shortcuts import render
 from django.template.loader import render_to_string
 from django.utils.translation import ugettext_lazy as _
-from django.views.decorators.cache import cache_page, cache_control
+from django.views.decorators.cache import cache_control
 from django.views.decorators.http import require_safe
 
 from api.utils import api_view
@@ -49,7 +49,6 @@ SCHEDULE_TEMPLATES = dict(
 
 @public_programme_required
 @cache_control(public=True, max_age=5 * 60)
-@cache_page(5 * 60)  # XXX remove once nginx cache is in place
 @require_safe
 def programme_timetable_view(
     request,
@@ -194,7 +193,6 @@ def programme_internal_dumpdata_view(request):
 
 
 @cache_control(public=True, max_age=1 * 60)
-@cache_page(1 * 60)  # XXX remove once nginx cache is in place
 @public_programme_required
 @require_safe
 def programme_mobile_timetable_view(request, event):
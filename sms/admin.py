@@ -1,6 +1,7 @@
 # encoding: utf-8
 
 from django.contrib import admin
+from django.db.models import Sum
 
 from .models import SMSMessageOut, SMSMessageIn, SMSEventMeta, Hotword, VoteCategory, Vote, Nominee
 
@@ -22,7 +23,7 @@ def get_send_time(obj):
 get_send_time.short_description = "Vastaanotettu"
 
 def format_price(obj):
-    return "%d,%02d €" % divmod(obj.used_credit, 100)
+    return "%d,%02d €" % divmod(obj.total_used_credit, 100)
 format_price.short_description = "Käytetty krediitti"
 
 class SMSRecipientGroupAdmin(admin.ModelAdmin):
@@ -46,8 +47,8 @@ class VoteCategoryAdmin(admin.ModelAdmin):
 
 class VoteAdmin(admin.ModelAdmin):
     model = Vote
-    list_display = ('category', 'vote', 'message', get_send_time)
-    readonly_fields = ('category', 'vote', 'message', get_send_time)
+    list_display = ('category', 'vote', 'sender', get_send_time)
+    readonly_fields = ('category', 'vote', 'sender', 'message', get_send_time)
 
     def has_add_permission(self, request):
         return False
@@ -58,6 +59,11 @@ class SMSEventMetaAdmin(admin.ModelAdmin):
     list_display = ('event', 'sms_enabled', 'current', format_price)
     readonly_fields = ('used_credit', )
 
+    def get_queryset(self, request):
+        return super(SMSEventMetaAdmin, self).get_queryset(request).annotate(
+            unrolled_credit=Sum('credit_entries__amount'),
+        )
+
 
 class SMSMessageInAdmin(admin.ModelAdmin):
     model = SMSMessageIn
@@ -71,7 +77,8 @@ class NomineeAdmin(admin.ModelAdmin):
 
 class SMSMessageOutAdmin(admin.ModelAdmin):
     model = SMSMessageOut
-    list_display = ('to', 'message', 'event')
+    list_display = ('to', 'message', 'event', 'state', 'num_attempts', 'created_at', 'sent_at')
+    list_filter = ('state', 'event')
 
 
 admin.site.register(SMSMessageOut, SMSMessageOutAdmin)
@@ -0,0 +1,16 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Send queued SMS messages as fast as the rate limit allows (eg. from cron when Celery is not in use)'
+
+    def handle(self, *args, **options):
+        from sms.models import SMSEventMeta, SMSMessageOut
+
+        seconds = SMSMessageOut.dispatch()
+        SMSEventMeta.roll_up_credit()
+
+        if seconds is not None:
+            self.stdout.write('Messages left in queue, run again in {seconds:.1f} seconds'.format(seconds=seconds))
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def populate_state(apps, schema_editor):
+    SMSMessageOut = apps.get_model('sms', 'SMSMessageOut')
+
+    # Messages from before the dispatcher are not to be sent again.
+    SMSMessageOut.objects.filter(ref__isnull=False).update(state='sent')
+    SMSMessageOut.objects.filter(ref__isnull=True).update(state='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0005_review'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='Luotu'),
+        ),
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='next_attempt_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='num_attempts',
+            field=models.IntegerField(default=0, verbose_name='Yrityksiä'),
+        ),
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='sent_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Lähetetty'),
+        ),
+        migrations.AddField(
+            model_name='smsmessageout',
+            name='state',
+            field=models.CharField(choices=[('queued', 'Jonossa'), ('sending', 'Lähetetään'), ('sent', 'Lähetetty'), ('failed', 'Epäonnistui')], default='queued', max_length=7, verbose_name='Tila'),
+        ),
+        migrations.AlterIndexTogether(
+            name='smsmessageout',
+            index_together=set([('state', 'next_attempt_at')]),
+        ),
+        migrations.RunPython(populate_state, elidable=True),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+import django.db.models.deletion
+
+
+def populate_vote_sender_and_tally(apps, schema_editor):
+    Vote = apps.get_model('sms', 'Vote')
+    VoteTally = apps.get_model('sms', 'VoteTally')
+
+    for vote in Vote.objects.select_related('message'):
+        vote.sender = vote.message.sender
+        vote.save(update_fields=['sender'])
+
+    # Only the latest vote of a sender in a category counts
+    for sender, category_id, latest_id in (
+        Vote.objects.order_by().values_list('sender', 'category_id').annotate(latest_id=Max('id'))
+    ):
+        Vote.objects.filter(sender=sender, category_id=category_id, id__lt=latest_id).delete()
+
+    VoteTally.objects.bulk_create([
+        VoteTally(category_id=category_id, nominee_id=nominee_id, votes=num_votes)
+        for category_id, nominee_id, num_votes in (
+            Vote.objects.order_by().values_list('category_id', 'vote_id').annotate(num_votes=Count('id'))
+        )
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sms', '0007_smscreditentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vote',
+            name='sender',
+            field=models.CharField(default='', max_length=255, verbose_name='Lähettäjä'),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='VoteTally',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('votes', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sms.VoteCategory')),
+                ('nominee', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='sms.Nominee')),
+            ],
+            options={
+                'verbose_name': 'Äänimäärä',
+                'verbose_name_plural': 'Äänimäärät',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='votetally',
+            unique_together=set([('category', 'nominee')]),
+        ),
+        migrations.RunPython(populate_vote_sender_and_tally, elidable=True),
+        migrations.AlterUniqueTogether(
+            name='vote',
+            unique_together=set([('sender', 'category')]),
+        ),
+    ]
@@ -1,19 +1,42 @@
 # encoding: utf-8
 
-from datetime import datetime
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from math import ceil
 
 from django.conf import settings
-from django.db import models
-from django.db.models import F
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
 
 from nexmo.models import InboundMessage, OutboundMessage, RetryError
 import regex
 
 from core.models import EventMetaBase
 
+from .utils import TokenBucket
+
+
+logger = logging.getLogger('kompassi')
 
 MAX_TRIES = 20
-RETRY_DELAY_SECONDS = 0.4
+RETRY_DELAY_SECONDS = 5
+
+# A message claimed for sending is given back to the queue after this if the worker never finishes it.
+SENDING_TIMEOUT = timedelta(minutes=10)
+
+SMS_MESSAGE_OUT_STATE_CHOICES = [
+    ('queued', 'Jonossa'),
+    ('sending', 'Lähetetään'),
+    ('sent', 'Lähetetty'),
+    ('failed', 'Epäonnistui'),
+]
+
+
+def estimate_num_fragments(text):
+    return 1 if len(text) <= 160 else ceil(len(text) / 153)
 
 
 class Hotword(models.Model):
@@ -79,10 +102,94 @@ class Vote(models.Model):
     category = models.ForeignKey(VoteCategory)
     vote = models.ForeignKey(Nominee)
     message = models.ForeignKey('nexmo.InboundMessage')
+    sender = models.CharField(max_length=255, verbose_name='Lähettäjä')
+
+    @classmethod
+    def cast(cls, message, category_id, nominee_id):
+        """
+        Records the vote of the sender of the message in the category, replacing their earlier vote in
+        the same category if any, and keeps VoteTally up to date. Returns the Vote.
+        """
+        with transaction.atomic():
+            vote = cls.objects.select_for_update().filter(sender=message.sender, category_id=category_id).first()
+
+            if vote is None:
+                vote = cls(sender=message.sender, category_id=category_id, vote_id=nominee_id, message=message)
+
+                try:
+                    with transaction.atomic():
+                        vote.save()
+                except IntegrityError:
+                    # Another message from the same sender got there first
+                    return cls.cast(message, category_id, nominee_id)
+
+                VoteTally.add(category_id, nominee_id, 1)
+            else:
+                old_nominee_id = vote.vote_id
+                vote.vote_id = nominee_id
+                vote.message = message
+                vote.save(update_fields=['vote', 'message'])
+
+                if old_nominee_id != nominee_id:
+                    VoteTally.add(category_id, old_nominee_id, -1)
+                    VoteTally.add(category_id, nominee_id, 1)
+
+        return vote
 
     class Meta:
         verbose_name = 'Ääni'
         verbose_name_plural = 'Äänet'
+        unique_together = [('sender', 'category')]
+
+
+class VoteTally(models.Model):
+    """
+    Number of votes of a nominee in a category. Maintained by Vote.cast so that the results need not be
+    counted from the votes every time they are viewed.
+    """
+
+    category = models.ForeignKey(VoteCategory)
+    nominee = models.ForeignKey(Nominee)
+    votes = models.IntegerField(default=0)
+
+    @classmethod
+    def add(cls, category_id, nominee_id, num_votes):
+        tallies = cls.objects.filter(category_id=category_id, nominee_id=nominee_id)
+
+        if tallies.update(votes=F('votes') + num_votes):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(category_id=category_id, nominee_id=nominee_id, votes=num_votes)
+        except IntegrityError:
+            tallies.update(votes=F('votes') + num_votes)
+
+    @classmethod
+    def recount(cls, event=None):
+        """
+        Rebuilds the tallies from the votes, eg. after votes have been edited by hand.
+        """
+        votes = Vote.objects.all()
+        tallies = cls.objects.all()
+
+        if event is not None:
+            votes = votes.filter(category__hotword__assigned_event=event)
+            tallies = tallies.filter(category__hotword__assigned_event=event)
+
+        with transaction.atomic():
+            tallies.delete()
+            cls.objects.bulk_create([
+                cls(category_id=category_id, nominee_id=nominee_id, votes=num_votes)
+                for category_id, nominee_id, num_votes in (
+                    votes.order_by().values_list('category_id', 'vote_id').annotate(num_votes=Count('id'))
+                )
+            ])
+
+    class Meta:
+        verbose_name = 'Äänimäärä'
+        verbose_name_plural = 'Äänimäärät'
+        unique_together = [('category', 'nominee')]
 
 
 class SMSEventMeta(EventMetaBase):
@@ -112,6 +219,39 @@ class SMSEventMeta(EventMetaBase):
     def __str__(self):
         return self.event.name
 
+    @property
+    def total_used_credit(self):
+        """
+        Credit used by the event in cents, including credit entries not yet rolled up into used_credit.
+        """
+        # SMSEventMetaAdmin annotates this
+        if hasattr(self, 'unrolled_credit'):
+            unrolled_credit = self.unrolled_credit
+        else:
+            unrolled_credit = self.credit_entries.aggregate(amount=Sum('amount'))['amount']
+
+        return self.used_credit + (unrolled_credit or 0)
+
+    @classmethod
+    def roll_up_credit(cls):
+        """
+        Adds the credit entries to used_credit of their events and deletes them. Returns the number of
+        entries rolled up.
+        """
+        with transaction.atomic():
+            entries = list(SMSCreditEntry.objects.select_for_update().values_list('id', 'event_id', 'amount'))
+
+            amounts_by_event_id = defaultdict(int)
+            for entry_id, event_id, amount in entries:
+                amounts_by_event_id[event_id] += amount
+
+            for event_id, amount in amounts_by_event_id.items():
+                cls.objects.filter(pk=event_id).update(used_credit=F('used_credit') + amount)
+
+            SMSCreditEntry.objects.filter(id__in=[entry_id for (entry_id, event_id, amount) in entries]).delete()
+
+        return len(entries)
+
     @classmethod
     def get_or_create_dummy(cls):
         from core.models import Event
@@ -124,6 +264,19 @@ class SMSEventMeta(EventMetaBase):
         verbose_name_plural = 'Tekstiviestejä käyttävät tapahtumat'
 
 
+class SMSCreditEntry(models.Model):
+    """
+    Credit used by a sent message. Appending entries here instead of updating SMSEventMeta.used_credit
+    keeps senders from contending for the lock on the event row. Entries are rolled up into used_credit
+    by SMSEventMeta.roll_up_credit.
+    """
+
+    event = models.ForeignKey(SMSEventMeta, related_name='credit_entries')
+    message = models.ForeignKey('sms.SMSMessageOut', null=True, blank=True, on_delete=models.SET_NULL)
+    amount = models.IntegerField(verbose_name='Krediittiä (senttiä)')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class SMSMessageIn(models.Model):
     message = models.ForeignKey('nexmo.InboundMessage')
     SMSEventMeta = models.ForeignKey(SMSEventMeta)
@@ -137,51 +290,215 @@ class SMSMessageIn(models.Model):
 
 
 class SMSMessageOut(models.Model):
+    """
+    An outgoing SMS message. Messages are queued and sent by .dispatch at the rate allowed by Nexmo.
+    """
+
     message = models.TextField()
     to = models.CharField(max_length=20)
     event = models.ForeignKey(SMSEventMeta)
     ref = models.ForeignKey('nexmo.OutboundMessage', blank=True, null=True)
 
+    state = models.CharField(
+        max_length=max(len(key) for (key, label) in SMS_MESSAGE_OUT_STATE_CHOICES),
+        choices=SMS_MESSAGE_OUT_STATE_CHOICES,
+        default='queued',
+        verbose_name='Tila',
+    )
+    num_attempts = models.IntegerField(default=0, verbose_name='Yrityksiä')
+    next_attempt_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(default=timezone.now, verbose_name='Luotu')
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name='Lähetetty')
+
     @classmethod
     def send(cls, *args, **kwargs):
+        """
+        Queues a message and starts the dispatcher. Pass dispatch=False when queuing many messages at once
+        and call dispatch_async afterwards.
+        """
+        dispatch = kwargs.pop('dispatch', True)
+
         message = SMSMessageOut(*args, **kwargs)
         message.save()
-        return message._send()
+
+        if dispatch:
+            cls.dispatch_async()
+
+        return message
+
+    @classmethod
+    def dispatch_async(cls, countdown=0):
+        if 'background_tasks' in settings.INSTALLED_APPS:
+            from .tasks import sms_dispatch
+            transaction.on_commit(lambda: sms_dispatch.apply_async(countdown=countdown))
+        else:
+            # Nobody would come back for what the token bucket holds up, so wait for it here
+            seconds = cls.dispatch()
+            while seconds is not None:
+                time.sleep(seconds)
+                seconds = cls.dispatch()
+
+    @classmethod
+    def dispatch(cls, batch_size=None):
+        """
+        Sends queued messages as fast as the token bucket (KOMPASSI_SMS_FRAGMENTS_PER_SECOND,
+        KOMPASSI_SMS_BURST_FRAGMENTS) allows without waiting for it. Messages are claimed in batches.
+
+        Returns the number of seconds after which dispatch should be called again, or None if there is
+        nothing left to send.
+        """
+        if batch_size is None:
+            batch_size = settings.KOMPASSI_SMS_DISPATCH_BATCH_SIZE
+
+        bucket = TokenBucket(
+            'sms:token_bucket',
+            rate=settings.KOMPASSI_SMS_FRAGMENTS_PER_SECOND,
+            capacity=settings.KOMPASSI_SMS_BURST_FRAGMENTS,
+        )
+
+        try:
+            while True:
+                messages = cls._claim_batch(batch_size)
+                if not messages:
+                    return cls._get_seconds_until_next_attempt()
+
+                for i, message in enumerate(messages):
+                    if not bucket.take(estimate_num_fragments(message.message)):
+                        # Come back when the bucket is full again instead of sleeping
+                        cls._release(messages[i:])
+                        return bucket.seconds_until(bucket.capacity)
+
+                    try:
+                        message._send()
+                    except RetryError as e:
+                        # Nexmo says we are going too fast. Give it a break.
+                        bucket.empty()
+                        message._mark_failed(e)
+                        cls._release(messages[i + 1:])
+                        return RETRY_DELAY_SECONDS
+                    except Exception as e:
+                        logger.exception('Failed to send SMSMessageOut(id=%s)', message.id)
+                        message._mark_failed(e)
+        finally:
+            bucket.save()
+
+    @classmethod
+    def _claim_batch(cls, batch_size):
+        t = timezone.now()
+
+        with transaction.atomic():
+            messages = list(
+                cls.objects
+                .select_for_update()
+                .filter(state__in=['queued', 'sending'], next_attempt_at__lte=t)
+                .select_related('event')
+                .order_by('next_attempt_at', 'id')
+                [:batch_size]
+            )
+
+            cls.objects.filter(id__in=[message.id for message in messages]).update(
+                state='sending',
+                num_attempts=F('num_attempts') + 1,
+                next_attempt_at=t + SENDING_TIMEOUT,
+            )
+
+        for message in messages:
+            message.state = 'sending'
+            message.num_attempts += 1
+
+        return messages
+
+    @classmethod
+    def _release(cls, messages):
+        """
+        Puts claimed but unsent messages back in the queue as they were.
+        """
+        if not messages:
+            return
+
+        cls.objects.filter(id__in=[message.id for message in messages]).update(
+            state='queued',
+            num_attempts=F('num_attempts') - 1,
+            next_attempt_at=timezone.now(),
+        )
+
+    @classmethod
+    def _get_seconds_until_next_attempt(cls):
+        next_attempt_at = cls.objects.filter(state__in=['queued', 'sending']).aggregate(
+            next_attempt_at=models.Min('next_attempt_at'),
+        )['next_attempt_at']
+
+        if next_attempt_at is None:
+            return None
+
+        return max(0, (next_attempt_at - timezone.now()).total_seconds())
+
+    @classmethod
+    def get_queue_stats(cls, event=None):
+        """
+        Returns the number of queued messages and the number of messages sent during the last minute.
+        """
+        messages = cls.objects.all()
+        if event is not None:
+            messages = messages.filter(event__event=event)
+
+        t = timezone.now()
+
+        return dict(
+            queue_depth=messages.filter(state__in=['queued', 'sending']).count(),
+            num_sent_last_minute=messages.filter(state='sent', sent_at__gt=t - timedelta(minutes=1)).count(),
+            num_failed=messages.filter(state='failed').count(),
+        )
+
+    def _mark_failed(self, error):
+        self.last_error = str(error)
+
+        if isinstance(error, RetryError) and self.num_attempts < MAX_TRIES:
+            self.state = 'queued'
+            self.next_attempt_at = timezone.now() + timedelta(seconds=RETRY_DELAY_SECONDS)
+        else:
+            self.state = 'failed'
+
+        self.save(update_fields=['state', 'next_attempt_at', 'last_error'])
 
     def _send(self, *args, **kwargs):
-        from time import sleep
+        """
+        Sends the message right away. Rate limiting is up to the caller, see .dispatch. Raises RetryError
+        if Nexmo asks us to slow down.
+        """
         if not self.event.sms_enabled:
+            self.state = 'failed'
+            self.last_error = 'SMS not enabled for event'
+            self.save(update_fields=['state', 'last_error'])
             return False
 
         # TODO replace this with a generic phone number normalization code (perhaps a library)
         to = regex.match(r'\d{9,15}', self.to.replace(' ','').replace('-','').replace('+',''))
         if to is None:
+            self.state = 'failed'
+            self.last_error = 'Invalid phone number'
+            self.save(update_fields=['state', 'last_error'])
             return False
         if to[0].startswith('0'):
             actual_to = '+358' + to[0][1:]
         else:
             actual_to = '+' + to[0]
 
-        nexmo_message = OutboundMessage(message=self.message, to=actual_to)
-        nexmo_message.save()
+        if self.ref is None:
+            nexmo_message = OutboundMessage(message=self.message, to=actual_to)
+            nexmo_message.save()
 
-        self.to = actual_to
-        self.ref = nexmo_message
-        self.save()
+            self.to = actual_to
+            self.ref = nexmo_message
+            self.save(update_fields=['to', 'ref'])
 
-        succeeded = False
-        for i in range(MAX_TRIES):
-            try:
-                sent_message = self.ref._send()
-            except RetryError:
-                # Back off! Stop everything for a while.
-                sleep(RETRY_DELAY_SECONDS)
-            else:
-                succeeded = True
-                break
+        sent_message = self.ref._send()
 
-        if not succeeded:
-            raise RuntimeError('Max retries exceeded for SMSMessageOut(id={})'.format(self.id))
+        self.state = 'sent'
+        self.sent_at = timezone.now()
+        self.last_error = ''
+        self.save(update_fields=['state', 'sent_at', 'last_error'])
 
         used_credit = sum(
             float(sent['message-price']) * 100
@@ -189,22 +506,15 @@ class SMSMessageOut(models.Model):
             if int(sent['status']) == 0
         )
 
-        meta = SMSEventMeta.objects.get(event=self.event.event)
-        meta.used_credit = F('used_credit') + int(used_credit)
-        meta.save()
-
-        if 'background_tasks' in settings.INSTALLED_APPS:
-            # This assumes that if background_tasks is installed, it will be used in sms sending.
-            # Otherwise you will be hitting RetryError constantly.
-            pass
-        else:
-            sleep(0.25 * float(sent_message['message-count']))
+        if used_credit:
+            SMSCreditEntry.objects.create(event=self.event, amount=int(used_credit), message=self)
 
         return True
 
     class Meta:
         verbose_name = 'Lähetetty viesti'
         verbose_name_plural = 'Lähetetyt viestit'
+        index_together = [('state', 'next_attempt_at')]
 
 
 from . import signal_handlers
@@ -1,6 +1,10 @@
 # encoding: utf-8
 
-from django.conf import settings
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
@@ -9,114 +13,121 @@ from nexmo.models import InboundMessage, message_received
 
 from .models import (
     Hotword,
-    InboundMessage,
     Nominee,
     SMSEventMeta,
     SMSMessageIn,
     Vote,
-    VoteCategory,
+    VoteTally,
 )
 
 
-# TODO Needs massive refactoring.
-# Now this has two responsibilities intertwined:
-# - determine which facility should handle the incoming message
-# - implement the SMS voting system
-# These should be split into two different facilities:
-# 1. a generic inbound SMS handler that looks up a list of eg. (regex, handler) pairs
-# 2. an SMS voting handler
+HOTWORD_MESSAGE_REGEX = regex.compile(r'(?P<hotword>[a-z]+) ((?P<category>[a-z]*)(?:\s?)(?P<vote>\d+))')
+HOTWORD_ROUTES_CACHE_KEY = 'sms:hotword_routes'
+
+
+def get_hotword_routes():
+    """
+    Returns a dict of hotword slug -> list of (valid_from, valid_to, hotword_id). Cached until a Hotword
+    is saved or deleted. Validity is checked when routing so that the cache needs no expiry.
+    """
+    routes = cache.get(HOTWORD_ROUTES_CACHE_KEY)
+
+    if routes is None:
+        routes = defaultdict(list)
+        for slug, valid_from, valid_to, hotword_id in (
+            Hotword.objects.order_by('id').values_list('slug', 'valid_from', 'valid_to', 'id')
+        ):
+            routes[slug].append((valid_from, valid_to, hotword_id))
+
+        routes = dict(routes)
+        cache.set(HOTWORD_ROUTES_CACHE_KEY, routes, None)
+
+    return routes
+
+
+def route_hotword(slug, t=None):
+    """
+    Returns the id of the hotword that is valid at t and has the given slug, or None.
+    """
+    if t is None:
+        t = timezone.now()
+
+    for valid_from, valid_to, hotword_id in get_hotword_routes().get(slug, []):
+        if valid_from <= t <= valid_to:
+            return hotword_id
+
+    return None
+
+
+@receiver(post_save, sender=Hotword)
+@receiver(post_delete, sender=Hotword)
+def invalidate_hotword_routes(sender, **kwargs):
+    cache.delete(HOTWORD_ROUTES_CACHE_KEY)
+
+
+@receiver(post_delete, sender=Vote)
+def remove_vote_from_tally(sender, instance, **kwargs):
+    # Only update: when the category or nominee is being deleted, so is the tally.
+    VoteTally.objects.filter(
+        category_id=instance.category_id,
+        nominee_id=instance.vote_id,
+    ).update(votes=F('votes') - 1)
+
+
+def handle_vote(message, hotword_id, category_slug, number):
+    """
+    Finds the nominee the message votes for among the categories of the hotword and casts the vote.
+    Without a category slug the nominee is looked up by number in all the categories of the hotword,
+    preferring the primary category if the number is ambiguous. Returns the Vote, or None if rejected.
+    """
+    candidates = list(
+        Nominee.category.through.objects
+        .filter(votecategory__hotword_id=hotword_id, nominee__number=number)
+        .order_by('votecategory_id')
+        .values_list('nominee_id', 'votecategory_id', 'votecategory__slug', 'votecategory__primary')
+    )
+
+    if category_slug:
+        candidates = [candidate for candidate in candidates if candidate[2] == category_slug]
+    elif len(set(nominee_id for (nominee_id, category_id, slug, primary) in candidates)) > 1:
+        candidates = [candidate for candidate in candidates if candidate[3]]
+
+    if not candidates:
+        # No such nominee or vote value out of scope, vote rejected.
+        return None
+
+    nominee_id, category_id, unused_slug, unused_primary = candidates[0]
+
+    return Vote.cast(message, category_id, nominee_id)
+
+
+def handle_regular_message(message):
+    try:
+        event = SMSEventMeta.objects.get(current=True, sms_enabled=True)
+    except SMSEventMeta.DoesNotExist:
+        # Don't know to which event point the new message, ignored.
+        pass
+    else:
+        SMSMessageIn.objects.create(message=message, SMSEventMeta=event)
+
+
+def route_inbound_message(message):
+    match = HOTWORD_MESSAGE_REGEX.match(message.message.lower())
+
+    if match is not None:
+        hotword_id = route_hotword(match.group('hotword'))
+
+        if hotword_id is not None:
+            return handle_vote(message, hotword_id, match.group('category'), int(match.group('vote')))
+
+    # Regular message or voting message with non-valid hotword.
+    # It is very unlikely to someone start their message with "I am 13" or something like it (word [word] digit)
+    # But handle it anyway as regular message
+    return handle_regular_message(message)
+
+
 @receiver(message_received)
 def sms_received_handler(sender, **kwargs):
     messages = InboundMessage.objects.filter(nexmo_message_id=kwargs['nexmo_message_id'])
     message = messages[0]  # If nexmo has delivered same message multiple times.
-    now = timezone.now()
-    hotwords = Hotword.objects.filter(valid_from__lte=now, valid_to__gte=now)
-    match = regex.match(r'(?P<hotword>[a-z]+) ((?P<category>[a-z]*)(?:\s?)(?P<vote>\d+))', message.message.lower())  # doesn't work with pythons re. Recursive patterns are not allowed.
-    if match is not None:
-        # Message with hotword
-        found = False
-        for hotword in hotwords:
-            if hotword.slug == match.group('hotword'):
-                found = hotword
-                break
-        if found is not False:
-            # Valid hotword found, check category.
-            if match.group('category') == '':
-                # no category, checking if there should be
-                try:
-                    nominee = Nominee.objects.get(number=int(match.group('vote')), category__hotword=found)
-                except Nominee.DoesNotExist:
-                    # Ok,  there was none,  or vote value out of scope, vote rejected.
-                    vote = "rejected"
-                except Nominee.MultipleObjectsReturned:
-                    try:
-                        nominee = Nominee.objects.get(number=match.group('vote'), category__primary=True, category__hotword=found)
-                    except Nominee.DoesNotExist:
-                        vote = "rejected"
-                    else:
-                        try:
-                            category = VoteCategory.objects.get(nominee=nominee,primary=True)
-                            existing_vote = Vote.objects.get(message__sender=message.sender,category=category)
-                        except Vote.DoesNotExist:
-                            # No old vote
-                            vote = Vote(category=category,vote=nominee,message=message)
-                            vote.save()
-                        else:
-                            existing_vote.vote = nominee
-                            existing_vote.message = message
-                            existing_vote.category = category
-                            existing_vote.save()
-                else:
-                    try:
-                        category = nominee.category.all()[0]
-                        existing_vote = Vote.objects.get(message__sender=message.sender,category=category)
-                    except Vote.DoesNotExist:
-                        # No old vote
-                        vote = Vote(category=category,vote=nominee,message=message)
-                        vote.save()
-                    else:
-                        existing_vote.vote = nominee
-                        existing_vote.message = message
-                        existing_vote.category = category
-                        existing_vote.save()
-
-            else:
-                try:
-                    nominee = Nominee.objects.get(number=match.group('vote'), category__slug=match.group('category'), category__hotword=found)
-                except Nominee.DoesNotExist:
-                    vote = "rejected"
-                else:
-                    try:
-                        category = VoteCategory.objects.get(slug=match.group('category'))
-                        existing_vote = Vote.objects.get(message__sender=message.sender,vote=nominee)
-                    except Vote.DoesNotExist:
-                        # No old vote
-                        vote = Vote(category=category,vote=nominee,message=message)
-                        vote.save()
-                    else:
-                        existing_vote.vote = nominee
-                        existing_vote.message = message
-                        existing_vote.category = category
-                        existing_vote.save()
-        else:
-            # Voting message with non-valid hotword.
-            # It is very unlikely to someone start their message with "I am 13" or something like it (word [word] digit)
-            # But hadle it anyway as regular message
-            try:
-                event = SMSEventMeta.objects.get(current=True, sms_enabled=True)
-            except SMSEventMeta.DoesNotExist:
-                # Don't know to which event point the new message, ignored.
-                pass
-            else:
-                new_message = SMSMessageIn(message=message, SMSEventMeta=event)
-                new_message.save()
-    else:
-        #regular message with no hotword.
-        try:
-            event = SMSEventMeta.objects.get(current=True, sms_enabled=True)
-        except SMSEventMeta.DoesNotExist:
-            # Don't know to which event point the new message, ignored.
-            pass
-        else:
-            new_message = SMSMessageIn(message=message, SMSEventMeta=event)
-            new_message.save()
+    route_inbound_message(message)
@@ -1,11 +1,37 @@
-
+from django.core.cache import cache
 
 from celery import shared_task
 
 
+DISPATCH_LOCK_CACHE_KEY = 'sms:dispatch:lock'
+DISPATCH_LOCK_TIMEOUT = 10 * 60
+
+
 @shared_task(ignore_result=True)
 def message_send(message_id):
+    # Left for messages queued before the dispatcher. New messages go through sms_dispatch.
     from .models import SMSMessageOut
+    SMSMessageOut.dispatch_async()
+
+
+@shared_task(ignore_result=True)
+def sms_dispatch():
+    from .models import SMSEventMeta, SMSMessageOut
+
+    # Only one dispatcher at a time. The one running will take care of any new messages.
+    if not cache.add(DISPATCH_LOCK_CACHE_KEY, True, DISPATCH_LOCK_TIMEOUT):
+        return
+
+    try:
+        seconds = SMSMessageOut.dispatch()
+    finally:
+        cache.delete(DISPATCH_LOCK_CACHE_KEY)
+
+    SMSEventMeta.roll_up_credit()
+
+    if seconds is None:
+        # Something may have been queued while we were holding the lock
+        seconds = SMSMessageOut._get_seconds_until_next_attempt()
 
-    smsmessage = SMSMessageOut.objects.get(pk=message_id)
-    smsmessage._send()
+    if seconds is not None:
+        sms_dispatch.apply_async(countdown=seconds)
@@ -1,3 +1,103 @@
+from datetime import timedelta
+from unittest import skipIf
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.cache import cache
 from django.test import TestCase
+from django.utils import timezone
+
+from core.models import Event
+
+from .models import (
+    Hotword,
+    Nominee,
+    SMSCreditEntry,
+    SMSEventMeta,
+    SMSMessageOut,
+    Vote,
+    VoteCategory,
+    VoteTally,
+)
+from .signal_handlers import route_inbound_message
+from .utils import TokenBucket, fake_inbound_message
+
+
+class TokenBucketTestCase(TestCase):
+    def test_token_bucket(self):
+        cache.delete('sms:test_token_bucket')
+
+        bucket = TokenBucket('sms:test_token_bucket', rate=1, capacity=3)
+        assert bucket.take(2)
+        assert not bucket.take(2)
+        assert 0 < bucket.seconds_until(2) <= 1
+
+        bucket.save()
+        bucket = TokenBucket('sms:test_token_bucket', rate=1, capacity=3)
+        assert bucket.take(1)
+
+        bucket.empty()
+        assert not bucket.take(1)
+
+
+@skipIf('background_tasks' in settings.INSTALLED_APPS, 'dispatches in the background')
+class DispatchTestCase(TestCase):
+    def test_dispatch_async_waits_for_the_token_bucket(self):
+        with patch.object(SMSMessageOut, 'dispatch', side_effect=[2.5, 0, None]) as dispatch, \
+                patch('sms.models.time.sleep') as sleep:
+            SMSMessageOut.dispatch_async()
+
+        assert dispatch.call_count == 3
+        assert [call[0][0] for call in sleep.call_args_list] == [2.5, 0]
+
+
+class SMSCreditTestCase(TestCase):
+    def test_roll_up_credit(self):
+        meta, unused = SMSEventMeta.get_or_create_dummy()
+
+        SMSCreditEntry.objects.create(event=meta, amount=7)
+        SMSCreditEntry.objects.create(event=meta, amount=5)
+
+        meta = SMSEventMeta.objects.get(pk=meta.pk)
+        assert meta.used_credit == 0
+        assert meta.total_used_credit == 12
+
+        assert SMSEventMeta.roll_up_credit() == 2
+
+        meta = SMSEventMeta.objects.get(pk=meta.pk)
+        assert meta.used_credit == 12
+        assert meta.total_used_credit == 12
+        assert not SMSCreditEntry.objects.exists()
+
+
+class VoteTestCase(TestCase):
+    def test_vote(self):
+        event, unused = Event.get_or_create_dummy()
+        t = timezone.now()
+        hotword = Hotword.objects.create(
+            hotword='Test vote',
+            slug='testvote',
+            valid_from=t - timedelta(days=1),
+            valid_to=t + timedelta(days=1),
+            assigned_event=event,
+        )
+        category = VoteCategory.objects.create(category='Test category', slug='cat', hotword=hotword, primary=True)
+        nominee1 = Nominee.objects.create(number=1, name='One')
+        nominee2 = Nominee.objects.create(number=2, name='Two')
+        nominee1.category.add(category)
+        nominee2.category.add(category)
+
+        route_inbound_message(fake_inbound_message('358401234567', 'testvote 1'))
+        route_inbound_message(fake_inbound_message('358401234567', 'testvote cat 2'))
+        route_inbound_message(fake_inbound_message('358407654321', 'testvote 2'))
+
+        assert Vote.objects.filter(category=category).count() == 2
+        assert VoteTally.objects.get(category=category, nominee=nominee1).votes == 0
+        assert VoteTally.objects.get(category=category, nominee=nominee2).votes == 2
+
+        # not a valid nominee
+        assert route_inbound_message(fake_inbound_message('358401234567', 'testvote 3')) is None
+        assert VoteTally.objects.get(category=category, nominee=nominee2).votes == 2
 
-# Create your tests here.
+        Vote.objects.filter(sender='358407654321').delete()
+        assert VoteTally.objects.get(category=category, nominee=nominee2).votes == 1
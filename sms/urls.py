@@ -4,6 +4,7 @@ from django.shortcuts import redirect
 from .views import (
     sms_admin_votes_view,
     sms_admin_received_view,
+    sms_admin_sent_view,
 )
 
 
@@ -19,4 +20,10 @@ urlpatterns = [
         sms_admin_received_view,
         name='sms_admin_received_view',
     ),
+
+    url(
+        r'^events/(?P<event_slug>[a-z0-9-]+)/sms/admin/sent/?$',
+        sms_admin_sent_view,
+        name='sms_admin_sent_view',
+    ),
 ]
\ No newline at end of file
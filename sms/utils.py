@@ -1,7 +1,9 @@
 # encoding: utf-8
 
 from random import randint
+from time import time
 
+from django.core.cache import cache
 from django.utils.timezone import now
 
 from nexmo.models import InboundMessage
@@ -17,3 +19,45 @@ def fake_inbound_message(sender, message):
         concat_total=None,
         nexmo_timestamp=now(),
     )
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` tokens per second on average and bursts of up to `capacity` tokens. The state is kept
+    in the cache under `cache_key` between uses. Call .save() when done.
+    """
+
+    def __init__(self, cache_key, rate, capacity):
+        self.cache_key = cache_key
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens, self.updated_at = cache.get(cache_key) or (self.capacity, time())
+
+    def refill(self):
+        t = time()
+        self.tokens = min(self.capacity, self.tokens + (t - self.updated_at) * self.rate)
+        self.updated_at = t
+
+    def take(self, num_tokens):
+        """
+        Takes num_tokens (but at most capacity) tokens if available. Returns True if they were taken.
+        """
+        self.refill()
+        num_tokens = min(num_tokens, self.capacity)
+
+        if self.tokens < num_tokens:
+            return False
+
+        self.tokens -= num_tokens
+        return True
+
+    def seconds_until(self, num_tokens):
+        self.refill()
+        return max(0, (min(num_tokens, self.capacity) - self.tokens) / self.rate)
+
+    def empty(self):
+        self.refill()
+        self.tokens = 0
+
+    def save(self):
+        cache.set(self.cache_key, (self.tokens, self.updated_at), None)
@@ -1,27 +1,47 @@
 # encoding: utf-8
 
+from collections import defaultdict
+
 from django.shortcuts import render
 
 from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
 from django.views.decorators.http import require_http_methods, require_safe
-from django.db.models import Count
 from django.conf import settings
 
 from core.utils import url, initialize_form
 
-from .models import VoteCategory, Vote, Hotword, Nominee, SMSMessageIn
+from .models import VoteCategory, VoteTally, Hotword, Nominee, SMSMessageIn, SMSMessageOut
 from .helpers import sms_admin_required
 
 
 @sms_admin_required
 @require_safe
 def sms_admin_votes_view(request, vars, event):
+    tallies = dict(
+        ((category_id, nominee_id), votes)
+        for (category_id, nominee_id, votes) in VoteTally.objects.filter(
+            category__hotword__assigned_event=event,
+        ).values_list('category_id', 'nominee_id', 'votes')
+    )
+
+    nominees = [
+        dict(category=category_id, name=name, number=number, votes=tallies.get((category_id, nominee_id), 0))
+        for (category_id, nominee_id, name, number) in Nominee.category.through.objects.filter(
+            votecategory__hotword__assigned_event=event,
+        ).values_list('votecategory_id', 'nominee_id', 'nominee__name', 'nominee__number')
+    ]
+    nominees.sort(key=lambda nominee: -nominee['votes'])
+
+    total_votes = defaultdict(int)
+    for (category_id, nominee_id), votes in tallies.items():
+        total_votes[category_id] += votes
+
     vars.update(
         hotwords=Hotword.objects.filter(assigned_event=event),
-        categories=VoteCategory.objects.filter(hotword__assigned_event=event),
-        nominees=Nominee.objects.filter(category__hotword__assigned_event=event).values('category','name','number').annotate(votes=Count('vote__vote__category')).order_by('-votes'),
-        total_votes=Vote.objects.filter(category__hotword__assigned_event=event).values('category').annotate(votes=Count('vote')),
+        categories=VoteCategory.objects.filter(hotword__assigned_event=event).select_related('hotword'),
+        nominees=nominees,
+        total_votes=[dict(category=category_id, votes=votes) for (category_id, votes) in total_votes.items()],
         number=settings.NEXMO_FROM
     )
 
@@ -37,6 +57,18 @@ def sms_admin_received_view(request, vars, event):
     return render(request, 'sms_admin_received_view.jade', vars)
 
 
+@sms_admin_required
+@require_safe
+def sms_admin_sent_view(request, vars, event):
+    vars.update(
+        queue_stats=SMSMessageOut.get_queue_stats(),
+        event_queue_stats=SMSMessageOut.get_queue_stats(event=event),
+        used_credit='{0},{1:02d}'.format(*divmod(vars['meta'].total_used_credit, 100)),
+        sent_messages=SMSMessageOut.objects.filter(event__event=event).order_by('-created_at')[:100],
+    )
+    return render(request, 'sms_admin_sent_view.jade', vars)
+
+
 def sms_admin_menu_items(request, event):
     votes_url = url('sms_admin_votes_view', event.slug)
     votes_active = request.path == votes_url
@@ -46,9 +78,14 @@ def sms_admin_menu_items(request, event):
     received_active = request.path == received_url
     received_text = 'Vastaanotetut viestit'
 
+    sent_url = url('sms_admin_sent_view', event.slug)
+    sent_active = request.path == sent_url
+    sent_text = 'Lähetetyt viestit'
+
     return [
         (votes_active, votes_url, votes_text),
         (received_active, received_url, received_text),
+        (sent_active, sent_url, sent_text),
     ]
 
 
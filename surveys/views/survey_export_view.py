@@ -3,7 +3,7 @@ from django.shortcuts import get_object_or_404
 from django.utils.timezone import now
 from django.views.decorators.http import require_safe
 
-from core.csv_export import CSV_EXPORT_FORMATS, csv_response
+from core.csv_export import CSV_EXPORT_FORMATS, export_job_response
 from core.models import Event
 
 from ..models import EventSurvey, EventSurveyResult, GlobalSurvey, GlobalSurveyResult
@@ -29,7 +29,8 @@ def survey_export_view(request, event_slug='', survey_slug='', format='xlsx'):
 
     filename = f'{slug}-results-{timestamp}.{format}'
 
-    return csv_response(
+    return export_job_response(
+        request,
         event,
         SurveyResult,
         results,
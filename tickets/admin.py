@@ -46,6 +46,7 @@ class LimitGroupAdmin(admin.ModelAdmin):
     list_display = (
       'event',
       'description',
+      'amount_sold',
       'amount_available',
       'limit',
     )
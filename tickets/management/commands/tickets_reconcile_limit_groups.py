@@ -0,0 +1,25 @@
+# encoding: utf-8
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Recompute the amount sold of limit groups from confirmed orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('event_slugs', nargs='*', metavar='EVENT_SLUG')
+
+    def handle(self, *args, **options):
+        from ...models import LimitGroup
+
+        criteria = dict()
+        if options['event_slugs']:
+            criteria.update(event__slug__in=options['event_slugs'])
+
+        for limit_group, old_amount_sold, new_amount_sold in LimitGroup.reconcile_amount_sold(**criteria):
+            self.stdout.write('{event}: {description}: {old} -> {new}'.format(
+                event=limit_group.event.slug,
+                description=limit_group.description,
+                old=old_amount_sold,
+                new=new_amount_sold,
+            ))
@@ -0,0 +1,139 @@
+# encoding: utf-8
+
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+
+class Command(BaseCommand):
+    help = (
+        'Fire concurrent order confirmations against a single limit group and verify it is not '
+        'oversold. Creates and afterwards deletes its own test data in the dummy event. Requires '
+        'PostgreSQL. Do NOT run against a production database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000, help='Number of orders to confirm')
+        parser.add_argument('--threads', type=int, default=50, help='Number of concurrent confirmations')
+        parser.add_argument('--limit', type=int, default=100, help='Limit of the limit group')
+        parser.add_argument('--count', type=int, default=1, help='Number of tickets per order')
+
+    def handle(self, *args, **options):
+        from ...models import Customer, LimitGroup, Order, Product, SoldOutError, TicketsEventMeta
+
+        if connection.vendor != 'postgresql':
+            raise CommandError('This load test requires PostgreSQL (got {vendor})'.format(vendor=connection.vendor))
+
+        num_orders = options['orders']
+        num_threads = options['threads']
+        count = options['count']
+
+        meta, unused = TicketsEventMeta.get_or_create_dummy()
+        event = meta.event
+
+        run_id = int(time() * 1000)
+        limit_group = LimitGroup.objects.create(
+            event=event,
+            description='Reservation load test {run_id}'.format(run_id=run_id),
+            limit=options['limit'],
+        )
+        product = Product.objects.create(
+            event=event,
+            name='Reservation load test {run_id}'.format(run_id=run_id),
+            description='Product for the reservation load test',
+            price_cents=0,
+            requires_shipping=False,
+        )
+        product.limit_groups = [limit_group]
+
+        order_ids = []
+        try:
+            for i in range(num_orders):
+                customer = Customer.objects.create(
+                    first_name='Load',
+                    last_name='Test {i}'.format(i=i),
+                    email='loadtest@example.com',
+                    address='Testikuja 5 A 19',
+                    zip_code='12354',
+                    city='Testilä',
+                )
+                order = Order.objects.create(event=event, customer=customer)
+                order.order_product_set.create(product=product, count=count)
+                order_ids.append(order.pk)
+
+            queue = Queue()
+            for order_id in order_ids:
+                queue.put(order_id)
+
+            results = dict(confirmed=0, sold_out=0, errors=0)
+            results_lock = Lock()
+
+            def record(result):
+                with results_lock:
+                    results[result] += 1
+
+            def worker():
+                try:
+                    while True:
+                        try:
+                            order_id = queue.get_nowait()
+                        except Empty:
+                            return
+
+                        try:
+                            Order.objects.get(pk=order_id).confirm_order()
+                            record('confirmed')
+                        except SoldOutError:
+                            record('sold_out')
+                        except Exception as exc:
+                            record('errors')
+                            self.stderr.write('Order {order_id}: {exc}'.format(order_id=order_id, exc=exc))
+                finally:
+                    connection.close()
+
+            threads = [Thread(target=worker) for i in range(num_threads)]
+
+            t0 = time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time() - t0
+
+            limit_group.refresh_from_db()
+            num_confirmed = Order.objects.filter(pk__in=order_ids, confirm_time__isnull=False).count()
+            out_of_sync = LimitGroup.reconcile_amount_sold(pk=limit_group.pk)
+
+            self.stdout.write(
+                '{num_orders} confirmations in {elapsed:.2f} s ({rate:.0f}/s) with {num_threads} threads: '
+                '{confirmed} confirmed, {sold_out} sold out, {errors} errors. '
+                'Limit group: {amount_sold}/{limit} sold.'.format(
+                    num_orders=num_orders,
+                    elapsed=elapsed,
+                    rate=num_orders / elapsed if elapsed else 0,
+                    num_threads=num_threads,
+                    amount_sold=limit_group.amount_sold,
+                    limit=limit_group.limit,
+                    **results
+                )
+            )
+
+            if limit_group.amount_sold > limit_group.limit:
+                raise CommandError('Limit group was oversold')
+
+            if out_of_sync or limit_group.amount_sold != num_confirmed * count:
+                raise CommandError('Amount sold does not match the confirmed orders')
+
+            if results['errors']:
+                raise CommandError('Some confirmations failed unexpectedly')
+        finally:
+            for order in Order.objects.filter(pk__in=order_ids).select_related('customer'):
+                customer = order.customer
+                order.delete()
+                customer.delete()
+
+            product.delete()
+            limit_group.delete()
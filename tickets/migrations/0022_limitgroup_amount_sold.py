@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+def populate_amount_sold(apps, schema_editor):
+    LimitGroup = apps.get_model('tickets', 'limitgroup')
+    OrderProduct = apps.get_model('tickets', 'orderproduct')
+
+    amounts_sold = dict(
+        OrderProduct.objects.filter(
+            order__confirm_time__isnull=False,
+            order__cancellation_time__isnull=True,
+        ).values_list('product__limit_groups').annotate(models.Sum('count'))
+    )
+
+    for limit_group in LimitGroup.objects.all():
+        limit_group.amount_sold = amounts_sold.get(limit_group.pk) or 0
+        limit_group.save(update_fields=['amount_sold'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tickets', '0021_auto_20161211_1549'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='limitgroup',
+            name='amount_sold',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Amount sold'),
+        ),
+        migrations.RunPython(populate_amount_sold, migrations.RunPython.noop, elidable=True),
+    ]
@@ -4,9 +4,11 @@ from datetime import datetime, timedelta, date
 from datetime import time as dtime
 from time import time, mktime
 
-from django.db import models, IntegrityError
+from django.db import models, IntegrityError, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, m2m_changed
+from django.dispatch import receiver
 from django.template.loader import render_to_string
-from django.core.mail import EmailMessage
 from django.conf import settings
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -14,7 +16,7 @@ from django.utils.translation import ugettext_lazy as _
 from dateutil.tz import tzlocal
 
 from core.csv_export import CsvExportMixin
-from core.models import EventMetaBase, ContactEmailMixin, contact_email_validator
+from core.models import EventMetaBase, ContactEmailMixin, OutboxEmail, contact_email_validator
 from core.utils import url, code_property, slugify, NONUNIQUE_SLUG_FIELD_PARAMS, phone_number_validator
 from payments.utils import compute_payment_request_mac
 
@@ -26,6 +28,10 @@ LOW_AVAILABILITY_THRESHOLD = 10
 UNPAID_CANCEL_DAYS = 1
 
 
+class SoldOutError(RuntimeError):
+    pass
+
+
 class TicketsEventMeta(ContactEmailMixin, EventMetaBase):
     shipping_and_handling_cents = models.IntegerField(
         verbose_name=_('Shipping and handling (cents)'),
@@ -283,6 +289,10 @@ class LimitGroup(models.Model):
     description = models.CharField(max_length=255, verbose_name=_('Description'))
     limit = models.IntegerField(verbose_name=_('Maximum amount to sell'))
 
+    # Maintained by Order and OrderProduct using atomic updates. Use reconcile_amount_sold or the
+    # tickets_reconcile_limit_groups management command to recompute it from OrderProducts.
+    amount_sold = models.IntegerField(default=0, editable=False, verbose_name=_('Amount sold'))
+
     def __str__(self):
         return "{self.description} ({self.amount_available}/{self.limit})".format(self=self)
 
@@ -290,15 +300,80 @@ class LimitGroup(models.Model):
         verbose_name = _('limit group')
         verbose_name_plural = _('limit groups')
 
-    @property
-    def amount_sold(self):
-        amount_sold = OrderProduct.objects.filter(
-            product__limit_groups=self,
-            order__confirm_time__isnull=False,
-            order__cancellation_time__isnull=True
-        ).aggregate(models.Sum('count'))['count__sum']
+    def save(self, *args, **kwargs):
+        if self.pk is not None and 'update_fields' not in kwargs:
+            # never overwrite the counter with a possibly stale in-memory value
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'amount_sold'
+            ]
 
-        return amount_sold if amount_sold is not None else 0
+        return super(LimitGroup, self).save(*args, **kwargs)
+
+    @classmethod
+    def adjust_amount_sold(cls, deltas):
+        """
+        Atomically adjusts the amount sold of limit groups. deltas is an iterable of
+        (limit_group_id, delta) pairs.
+        """
+        for limit_group_id, delta in deltas:
+            if delta:
+                cls.objects.filter(pk=limit_group_id).update(amount_sold=F('amount_sold') + delta)
+
+    @classmethod
+    def reserve(cls, amounts):
+        """
+        Atomically takes up capacity in limit groups. amounts is an iterable of (limit_group_id, count)
+        pairs. Raises SoldOutError if any of the limit groups would go over its limit, in which case
+        none of the reservations are made.
+
+        The check and the increment are a single conditional UPDATE, so concurrent reservations
+        cannot both pass the check. Limit groups are updated in primary key order so that concurrent
+        reservations touching the same limit groups do not deadlock.
+        """
+        with transaction.atomic():
+            for limit_group_id, count in sorted(amounts):
+                if count <= 0:
+                    continue
+
+                num_updated = cls.objects.filter(
+                    pk=limit_group_id,
+                    amount_sold__lte=F('limit') - count,
+                ).update(amount_sold=F('amount_sold') + count)
+
+                if not num_updated:
+                    raise SoldOutError(limit_group_id)
+
+    @classmethod
+    def reconcile_amount_sold(cls, **criteria):
+        """
+        Recomputes the amount sold of the matching limit groups from OrderProducts of active orders.
+        Returns a list of (limit_group, old_amount_sold, new_amount_sold) for the limit groups that
+        were out of sync.
+        """
+        result = []
+
+        with transaction.atomic():
+            limit_groups = list(cls.objects.filter(**criteria).select_for_update())
+
+            amounts_sold = dict(
+                OrderProduct.objects.filter(
+                    product__limit_groups__in=limit_groups,
+                    order__confirm_time__isnull=False,
+                    order__cancellation_time__isnull=True,
+                ).values_list('product__limit_groups').annotate(models.Sum('count'))
+            )
+
+            for limit_group in limit_groups:
+                old_amount_sold = limit_group.amount_sold
+                new_amount_sold = amounts_sold.get(limit_group.pk) or 0
+
+                if old_amount_sold != new_amount_sold:
+                    cls.objects.filter(pk=limit_group.pk).update(amount_sold=new_amount_sold)
+                    limit_group.amount_sold = new_amount_sold
+                    result.append((limit_group, old_amount_sold, new_amount_sold))
+
+        return result
 
     @property
     def amount_available(self):
@@ -681,23 +756,60 @@ class Order(models.Model):
     def clean_up_shirt_orders(self):
         self.shirt_orders.filter(count__lte=0).delete()
 
+    @property
+    def limit_group_amounts(self):
+        """
+        Returns a list of (limit_group_id, count) pairs telling how many items this order takes up
+        in each limit group.
+        """
+        return list(
+            self.order_product_set.filter(count__gt=0, product__limit_groups__isnull=False)
+                .values_list('product__limit_groups')
+                .annotate(models.Sum('count'))
+        )
+
+    def _save_and_update_limit_groups(self, was_active):
+        """
+        Saves the order and, if the order became active or inactive, updates the amount sold of
+        the limit groups of its products in the same transaction.
+        """
+        with transaction.atomic():
+            self.save()
+
+            if self.is_active != was_active:
+                sign = 1 if self.is_active else -1
+                LimitGroup.adjust_amount_sold(
+                    (limit_group_id, sign * count)
+                    for (limit_group_id, count) in self.limit_group_amounts
+                )
+
     def confirm_order(self):
+        """
+        Confirms the order, reserving its products from their limit groups. Raises SoldOutError and
+        leaves the order unconfirmed if there is not enough left of a product.
+        """
         assert self.customer is not None
         assert not self.is_confirmed
 
         self.clean_up_order_products()
         self.clean_up_shirt_orders()
 
-        self.reference_number = self._make_reference_number()
-        self.confirm_time = timezone.now()
-        self.save()
+        with transaction.atomic():
+            if not self.is_cancelled:
+                LimitGroup.reserve(self.limit_group_amounts)
+
+            self.reference_number = self._make_reference_number()
+            self.confirm_time = timezone.now()
+            self.save()
 
     def deconfirm_order(self):
         assert self.is_confirmed
 
+        was_active = self.is_active
+
         self.reference_number = self._make_reference_number()
         self.confirm_time = None
-        self.save()
+        self._save_and_update_limit_groups(was_active)
 
     def confirm_payment(self, payment_date=None, send_email=True):
         assert self.is_confirmed and not self.is_paid
@@ -721,8 +833,9 @@ class Order(models.Model):
         if 'lippukala' in settings.INSTALLED_APPS:
             self.lippukala_revoke_codes()
 
+        was_active = self.is_active
         self.cancellation_time = timezone.now()
-        self.save()
+        self._save_and_update_limit_groups(was_active)
 
         if send_email:
             self.send_confirmation_message("cancellation_notice")
@@ -733,8 +846,9 @@ class Order(models.Model):
         if 'lippukala' in settings.INSTALLED_APPS:
             self.lippukala_reinstate_codes()
 
+        was_active = self.is_active
         self.cancellation_time = None
-        self.save()
+        self._save_and_update_limit_groups(was_active)
 
         if send_email:
             self.send_confirmation_message("uncancellation_notice")
@@ -952,19 +1066,15 @@ class Order(models.Model):
         if settings.DEBUG:
             print(msgbody)
 
-        message = EmailMessage(
+        OutboxEmail.enqueue(
             subject=msgsubject,
             body=msgbody,
             from_email=self.event.tickets_event_meta.cloaked_contact_email,
             to=(self.customer.name_and_email,),
-            bcc=msgbcc
+            bcc=msgbcc,
+            attachments=attachments,
         )
 
-        for attachment in attachments:
-            message.attach(*attachment)
-
-        message.send(fail_silently=True)
-
     def render(self, c):
         render_receipt(self, c)
 
@@ -1043,11 +1153,59 @@ class OrderProduct(models.Model):
     def __str__(self):
         return self.description
 
+    def _update_limit_groups(self, delta):
+        if delta:
+            LimitGroup.adjust_amount_sold(
+                (limit_group_id, delta)
+                for limit_group_id in self.product.limit_groups.values_list('id', flat=True)
+            )
+
+    def save(self, *args, **kwargs):
+        # OrderProducts of unconfirmed orders do not count towards limit groups
+        if not self.order.is_active:
+            return super(OrderProduct, self).save(*args, **kwargs)
+
+        with transaction.atomic():
+            old_count = 0
+            if self.pk is not None:
+                old_count = OrderProduct.objects.filter(pk=self.pk).values_list('count', flat=True).first() or 0
+
+            result = super(OrderProduct, self).save(*args, **kwargs)
+            self._update_limit_groups(self.count - old_count)
+
+        return result
+
     class Meta:
         verbose_name = 'tilausrivi'
         verbose_name_plural = 'tilausrivit'
 
 
+@receiver(m2m_changed, sender=Product.limit_groups.through)
+def reconcile_limit_groups_on_product_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Changing the limit groups of a Product that has already been sold changes what has been sold in
+    those limit groups, so recompute them.
+    """
+    if reverse:
+        limit_group_pks = [instance.pk]
+    elif action == 'pre_clear':
+        instance._cleared_limit_group_pks = list(instance.limit_groups.values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        limit_group_pks = getattr(instance, '_cleared_limit_group_pks', [])
+    else:
+        limit_group_pks = pk_set
+
+    if action in ('post_add', 'post_remove', 'post_clear') and limit_group_pks:
+        LimitGroup.reconcile_amount_sold(pk__in=limit_group_pks)
+
+
+@receiver(post_delete, sender=OrderProduct)
+def update_limit_groups_on_order_product_delete(sender, instance, **kwargs):
+    if instance.count and instance.order.is_active:
+        instance._update_limit_groups(-instance.count)
+
+
 class AccommodationInformation(models.Model, CsvExportMixin):
     order_product = models.ForeignKey(OrderProduct, blank=True, null=True, related_name="accommodation_information_set")
 
@@ -1,6 +1,10 @@
-from django.test import TestCase
+from unittest import skipUnless
 
-from .models import LimitGroup, Product, Order
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from .models import LimitGroup, Product, Order, SoldOutError
 
 
 class LimitGroupsTestCase(TestCase):
@@ -30,3 +34,56 @@ class LimitGroupsTestCase(TestCase):
         assert not weekend.in_stock
         assert not saturday.in_stock
         assert sunday.in_stock
+
+    def test_amount_sold_counter(self):
+        limit_saturday, limit_sunday = LimitGroup.get_or_create_dummies()
+        weekend, saturday, sunday = Product.get_or_create_dummies()
+
+        def amounts_sold():
+            return [
+                LimitGroup.objects.get(pk=limit_group.pk).amount_sold
+                for limit_group in (limit_saturday, limit_sunday)
+            ]
+
+        order, unused = Order.get_or_create_dummy()
+        order.order_product_set.create(product=saturday, count=2)
+        order.order_product_set.create(product=weekend, count=3)
+        assert amounts_sold() == [0, 0]
+
+        order.confirm_order()
+        assert amounts_sold() == [5, 3]
+
+        order.cancel(send_email=False)
+        assert amounts_sold() == [0, 0]
+
+        order.uncancel(send_email=False)
+        assert amounts_sold() == [5, 3]
+
+        LimitGroup.objects.filter(pk=limit_saturday.pk).update(amount_sold=1000)
+        out_of_sync = LimitGroup.reconcile_amount_sold(event=order.event)
+        assert [(limit_group.pk, old, new) for (limit_group, old, new) in out_of_sync] == [
+            (limit_saturday.pk, 1000, 5),
+        ]
+        assert amounts_sold() == [5, 3]
+
+    def test_confirm_order_sold_out(self):
+        limit_saturday, limit_sunday = LimitGroup.get_or_create_dummies()
+        weekend, saturday, sunday = Product.get_or_create_dummies()
+
+        order, unused = Order.get_or_create_dummy()
+        order.order_product_set.create(product=weekend, count=4000)
+        order.order_product_set.create(product=sunday, count=1001)
+
+        with self.assertRaises(SoldOutError):
+            order.confirm_order()
+
+        order = Order.objects.get(pk=order.pk)
+        assert not order.is_confirmed
+        assert LimitGroup.objects.get(pk=limit_saturday.pk).amount_sold == 0
+        assert LimitGroup.objects.get(pk=limit_sunday.pk).amount_sold == 0
+
+
+@skipUnless(connection.vendor == 'postgresql', 'requires PostgreSQL')
+class ReservationLoadTestCase(TransactionTestCase):
+    def test_no_oversell_under_concurrent_confirmations(self):
+        call_command('tickets_reservation_load_test', orders=40, threads=10, limit=15, count=2)
@@ -16,6 +16,7 @@ from ..models import (
     OrderProduct,
     ShirtOrder,
     ShirtSize,
+    SoldOutError,
 )
 from ..utils import *
 
@@ -106,8 +107,10 @@ class Phase(object):
             errors = self.validate(request, event, form)
 
             if not errors:
-                self.save(request, event, form)
+                # Saving may still fail, eg. when products sell out during confirmation.
+                errors = self.save(request, event, form) or []
 
+            if not errors:
                 # The "Next" button should only proceed with valid data.
                 if action == "next":
                     if not self.delay_complete:
@@ -460,7 +463,11 @@ class ConfirmPhase(Phase):
         order = get_order(request, event)
 
         if not order.is_confirmed:
-            order.confirm_order()
+            try:
+                order.confirm_order()
+            except SoldOutError:
+                messages.error(request, 'Valitsemasi tuote on valitettavasti juuri myyty loppuun.')
+                return ["soldout_confirm"]
 
 
 tickets_confirm_phase = ConfirmPhase()